@@ -0,0 +1,310 @@
+"""
+Limite de concorrência adaptativo (AIMD) para chamadas à LLM.
+
+O único limite de gerações simultâneas era o --concurrency do Celery, que
+também vale para o OCR: ao escalar workers para OCR o Ollama ficava
+sobrecarregado. Cada par provedor+modelo tem agora um limite distribuído
+(contado no Redis para API e workers) ajustado pelo comportamento observado:
+
+- aumento aditivo: +1 no limite a cada "limite" chamadas bem-sucedidas
+- redução multiplicativa: o limite cai (ADMISSION_DECREASE_FACTOR) quando há
+  erro de sobrecarga (timeout, conexão, 429, 5xx) ou quando a latência por
+  token gerado passa de ADMISSION_LATENCY_TOLERANCE vezes a latência de
+  referência (percentil ADMISSION_BASELINE_PERCENTILE das últimas
+  ADMISSION_BASELINE_WINDOW chamadas)
+
+A latência por token usa os tokens de saída informados pelo provedor (no
+Ollama, eval_duration / eval_count: só a geração, sem o prompt) - o tamanho do
+prompt não faz um documento longo parecer sobrecarga. Como a referência é um
+percentil de uma janela, ela acompanha troca de hardware/modelo e um único
+valor baixo anômalo não fixa o limite para sempre.
+
+O tempo de espera pela admissão (fila) e o tempo da chamada (serviço) são
+medidos separadamente.
+"""
+import os
+import time
+import uuid
+import asyncio
+import httpx
+from collections import deque
+from contextlib import asynccontextmanager
+from loguru import logger
+from dotenv import load_dotenv
+from redis_client import get_redis
+import metrics
+
+load_dotenv()
+
+# Configuration
+ADMISSION_ENABLED = os.getenv("ADMISSION_ENABLED", "true").lower() == "true"
+# Limite máximo por provedor, ex: "ollama=8,gemini=16"
+ADMISSION_MAX_CONCURRENCY = os.getenv("ADMISSION_MAX_CONCURRENCY", "ollama=8,gemini=16")
+ADMISSION_MIN_CONCURRENCY = int(os.getenv("ADMISSION_MIN_CONCURRENCY", "1"))
+# Limite inicial baixo: a latência de referência é medida sem contenção e o limite sobe aditivamente
+ADMISSION_INITIAL_CONCURRENCY = int(os.getenv("ADMISSION_INITIAL_CONCURRENCY", "2"))
+ADMISSION_WAIT_SECONDS = int(os.getenv("ADMISSION_WAIT_SECONDS", "120"))
+ADMISSION_LATENCY_TOLERANCE = float(os.getenv("ADMISSION_LATENCY_TOLERANCE", "2.0"))
+ADMISSION_DECREASE_FACTOR = float(os.getenv("ADMISSION_DECREASE_FACTOR", "0.7"))
+# Latência de referência: percentil baixo (sem fila) das últimas chamadas bem-sucedidas
+ADMISSION_BASELINE_WINDOW = int(os.getenv("ADMISSION_BASELINE_WINDOW", "200"))
+ADMISSION_BASELINE_PERCENTILE = float(os.getenv("ADMISSION_BASELINE_PERCENTILE", "10"))
+
+# Sem limite configurado para o provedor
+DEFAULT_MAX_CONCURRENCY = 8
+# Uma redução por janela: várias respostas lentas da mesma rajada contam uma vez só
+DECREASE_COOLDOWN_SECONDS = 2
+# Amostras necessárias antes de comparar com a referência
+BASELINE_MIN_SAMPLES = 5
+# Chamadas em andamento mais antigas que isso são consideradas perdidas (worker morto)
+LEASE_TTL_SECONDS = 600
+POLL_INTERVAL_SECONDS = 0.2
+
+class AdmissionTimeoutError(Exception):
+    """Raised when a call waited ADMISSION_WAIT_SECONDS without being admitted"""
+
+    def __init__(self, message: str, retry_after: float = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+def parse_provider_limits(raw: str) -> dict:
+    """Parse ADMISSION_MAX_CONCURRENCY ("provider=N,...")"""
+    limits = {}
+    for item in raw.split(","):
+        if "=" in item:
+            provider, limit = item.rsplit("=", 1)
+            limits[provider.strip().lower()] = int(limit)
+    return limits
+
+PROVIDER_MAX_CONCURRENCY = parse_provider_limits(ADMISSION_MAX_CONCURRENCY)
+
+def is_overload_error(error: Exception) -> bool:
+    """Timeouts, connection errors, 429 and 5xx signal an overloaded provider; other errors do not"""
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code == 429 or error.response.status_code >= 500
+    if isinstance(error, httpx.TransportError):
+        return True
+    # google-genai APIError expõe o status HTTP em "code"
+    code = getattr(error, "code", None)
+    return isinstance(code, int) and (code == 429 or code >= 500)
+
+class AdaptiveLimiter:
+    """Distributed AIMD concurrency limit for one provider+model"""
+
+    def __init__(self, provider: str, model: str):
+        self.provider = provider
+        self.model = model
+        self.label = f"{provider}:{model}"
+        self.max_limit = PROVIDER_MAX_CONCURRENCY.get(provider, DEFAULT_MAX_CONCURRENCY)
+        self.min_limit = min(ADMISSION_MIN_CONCURRENCY, self.max_limit)
+        self.state_key = f"admission:state:{self.label}"
+        self.inflight_key = f"admission:inflight:{self.label}"
+        self.latencies_key = f"admission:latencies:{self.label}"
+        initial = max(self.min_limit, min(ADMISSION_INITIAL_CONCURRENCY, self.max_limit))
+        self._local = {"limit": float(initial)}
+        self._local_latencies = deque(maxlen=ADMISSION_BASELINE_WINDOW)
+
+    def _load(self) -> dict:
+        try:
+            data = get_redis().hgetall(self.state_key)
+            if data:
+                return {"limit": float(data.get("limit", self._local["limit"]))}
+        except Exception as e:
+            logger.debug(f"⚠️ VERBOSE: Redis unavailable for admission control, using local state: {e}")
+        return dict(self._local)
+
+    def _save(self, **fields):
+        self._local.update(fields)
+        try:
+            get_redis().hset(self.state_key, mapping={k: "" if v is None else v for k, v in fields.items()})
+        except Exception as e:
+            logger.debug(f"⚠️ VERBOSE: Could not store admission state: {e}")
+
+    def limit(self) -> int:
+        return max(self.min_limit, min(self.max_limit, int(self._load()["limit"])))
+
+    def in_flight(self) -> int:
+        """Calls currently admitted (across all processes)"""
+        try:
+            client = get_redis()
+            client.zremrangebyscore(self.inflight_key, 0, time.time() - LEASE_TTL_SECONDS)
+            return client.zcard(self.inflight_key)
+        except Exception:
+            return 0
+
+    def try_acquire(self, lease_id: str) -> bool:
+        """Admit the call if it fits in the current limit"""
+        try:
+            client = get_redis()
+            client.zremrangebyscore(self.inflight_key, 0, time.time() - LEASE_TTL_SECONDS)
+            # Entra no conjunto e verifica a posição: quem passou do limite sai (sem Lua, sem admitir a mais)
+            client.zadd(self.inflight_key, {lease_id: time.time()})
+            rank = client.zrank(self.inflight_key, lease_id)
+            if rank is not None and rank < self.limit():
+                return True
+            client.zrem(self.inflight_key, lease_id)
+            return False
+        except Exception as e:
+            logger.debug(f"⚠️ VERBOSE: Redis unavailable for admission control, admitting call: {e}")
+            return True
+
+    def release(self, lease_id: str):
+        try:
+            get_redis().zrem(self.inflight_key, lease_id)
+        except Exception as e:
+            logger.debug(f"⚠️ VERBOSE: Could not release admission lease: {e}")
+
+    def _decrease(self, reason: str):
+        try:
+            # Uma redução por janela entre todos os processos
+            if not get_redis().set(f"{self.state_key}:decrease", "1", nx=True, ex=DECREASE_COOLDOWN_SECONDS):
+                return
+        except Exception:
+            pass
+        current = self._load()["limit"]
+        new_limit = max(float(self.min_limit), current * ADMISSION_DECREASE_FACTOR)
+        self._save(limit=new_limit)
+        logger.warning(f"📉 VERBOSE: Admission limit for {self.label} {current:.1f} -> {new_limit:.1f} ({reason})")
+        metrics.incr(f"admission.{self.label}.decreases")
+
+    def _increase(self, current: float):
+        if current >= self.max_limit:
+            return
+        try:
+            new_limit = get_redis().hincrbyfloat(self.state_key, "limit", 1.0 / max(current, 1.0))
+            if new_limit > self.max_limit:
+                get_redis().hset(self.state_key, "limit", self.max_limit)
+        except Exception:
+            self._local["limit"] = min(self.max_limit, current + 1.0 / max(current, 1.0))
+
+    def _recent_latencies(self) -> list:
+        try:
+            return [float(value) for value in get_redis().lrange(self.latencies_key, 0, -1)]
+        except Exception:
+            return list(self._local_latencies)
+
+    def _add_latency(self, latency: float):
+        self._local_latencies.append(latency)
+        try:
+            with get_redis().pipeline() as pipe:
+                pipe.lpush(self.latencies_key, latency)
+                pipe.ltrim(self.latencies_key, 0, ADMISSION_BASELINE_WINDOW - 1)
+                pipe.execute()
+        except Exception as e:
+            logger.debug(f"⚠️ VERBOSE: Could not store admission latency: {e}")
+
+    def baseline(self) -> float:
+        """Reference latency per output token: low percentile of the recent window (None until enough samples)"""
+        latencies = sorted(self._recent_latencies())
+        if len(latencies) < BASELINE_MIN_SAMPLES:
+            return None
+        index = min(len(latencies) - 1, int(len(latencies) * ADMISSION_BASELINE_PERCENTILE / 100))
+        return latencies[index]
+
+    def record_success(self, service_seconds: float, output_tokens: int = None, decode_seconds: float = None):
+        """Additive increase, or multiplicative decrease when latency per output token degrades
+
+        decode_seconds: tempo só da geração informado pelo provedor (Ollama eval_duration); sem ele usa o tempo da chamada.
+        """
+        seconds = decode_seconds if decode_seconds else service_seconds
+        latency = seconds / max(output_tokens, 1) * 1000 if output_tokens else seconds
+        baseline = self.baseline()
+        self._add_latency(latency)
+        if baseline is not None and latency > baseline * ADMISSION_LATENCY_TOLERANCE:
+            self._decrease(f"latency {latency:.3f} > {ADMISSION_LATENCY_TOLERANCE}x baseline {baseline:.3f}")
+        else:
+            self._increase(self._load()["limit"])
+
+    def record_failure(self, error: Exception):
+        if is_overload_error(error):
+            self._decrease(f"overload error: {error}")
+
+    def snapshot(self) -> dict:
+        data = self._load()
+        baseline = self.baseline()
+        return {
+            "limit": self.limit(),
+            "limit_exact": round(data["limit"], 2),
+            "max_limit": self.max_limit,
+            "in_flight": self.in_flight(),
+            "baseline_latency": round(baseline, 4) if baseline is not None else None,
+        }
+
+_limiters = {}
+
+def get_limiter(provider: str, model: str) -> AdaptiveLimiter:
+    key = (provider, model)
+    if key not in _limiters:
+        _limiters[key] = AdaptiveLimiter(provider, model)
+    return _limiters[key]
+
+@asynccontextmanager
+async def admit(provider: str, model: str, output_tokens: int = None, call_info: dict = None):
+    """Wait for a slot under the provider+model limit, then time the call
+
+    Yields a usage dict: the caller fills "output_tokens" (and "decode_seconds"
+    when the provider reports it) from the response, so latency is measured per
+    generated token. output_tokens is the estimate used when the response has no
+    usage. call_info receives queue/service times.
+    """
+    usage = {}
+    if not ADMISSION_ENABLED:
+        yield usage
+        return
+
+    limiter = get_limiter(provider, model)
+    lease_id = uuid.uuid4().hex
+    queued_at = time.time()
+    while not limiter.try_acquire(lease_id):
+        if time.time() - queued_at >= ADMISSION_WAIT_SECONDS:
+            metrics.incr(f"admission.{limiter.label}.timeouts")
+            raise AdmissionTimeoutError(
+                f"No admission slot for {limiter.label} after {ADMISSION_WAIT_SECONDS}s (limit {limiter.limit()})",
+                retry_after=POLL_INTERVAL_SECONDS * 50
+            )
+        await asyncio.sleep(POLL_INTERVAL_SECONDS)
+
+    queue_seconds = time.time() - queued_at
+    started_at = time.time()
+    if queue_seconds >= 1:
+        logger.info(f"🚦 VERBOSE: Admitted {limiter.label} after {queue_seconds:.2f}s in queue (limit {limiter.limit()})")
+    try:
+        yield usage
+    except Exception as e:
+        limiter.record_failure(e)
+        metrics.incr(f"admission.{limiter.label}.errors")
+        raise
+    else:
+        limiter.record_success(time.time() - started_at, usage.get("output_tokens") or output_tokens,
+                               usage.get("decode_seconds"))
+    finally:
+        service_seconds = time.time() - started_at
+        limiter.release(lease_id)
+        metrics.incr(f"admission.{limiter.label}.requests")
+        metrics.incr(f"admission.{limiter.label}.queue_seconds", queue_seconds)
+        metrics.incr(f"admission.{limiter.label}.service_seconds", service_seconds)
+        if call_info is not None:
+            call_info["admission"] = {
+                "queue_seconds": round(queue_seconds, 3),
+                "service_seconds": round(service_seconds, 3),
+                "limit": limiter.limit(),
+            }
+
+def get_admission_stats() -> dict:
+    """Current limit and average queue/service time per provider+model"""
+    counters = metrics.get_counters("admission.")
+    labels = {name[len("admission."):].rsplit(".", 1)[0] for name in counters}
+    stats = {}
+    for label in sorted(labels):
+        provider, _, model = label.partition(":")
+        prefix = f"admission.{label}."
+        stats[label] = {
+            **get_limiter(provider, model).snapshot(),
+            "requests": counters.get(prefix + "requests", 0),
+            "errors": counters.get(prefix + "errors", 0),
+            "timeouts": counters.get(prefix + "timeouts", 0),
+            "decreases": counters.get(prefix + "decreases", 0),
+            "avg_queue_seconds": metrics.rate(counters, prefix + "queue_seconds", prefix + "requests"),
+            "avg_service_seconds": metrics.rate(counters, prefix + "service_seconds", prefix + "requests"),
+        }
+    return stats
@@ -0,0 +1,166 @@
+"""
+Micro-benchmark do formatador de respostas da LLM.
+
+Compara a extração antiga (regex não-guloso + ~10 regex por chave) com o
+scanner de passada única (json.JSONDecoder.raw_decode + matcher multi-chave
+pré-compilado) sobre um corpus de saídas reais da LLM.
+
+Corpus: respostas gravadas em documents.db (documents e document_queries) e,
+opcionalmente, um arquivo JSONL com {"llm_response", "format_response", "example"}.
+Sem dados reais, usa amostras representativas embutidas.
+
+Uso: python benchmark_formatter.py [corpus.jsonl] [--iterations N]
+"""
+import re
+import sys
+import json
+import time
+import sqlite3
+import argparse
+from loguru import logger
+from utils import find_json_value, extract_template_values
+
+DATABASE_PATH = "documents.db"
+
+SAMPLE_CORPUS = [
+    {
+        "llm_response": '{"cnpj": "12.345.678/0001-95", "data_emissao": "15/03/2024", "valor_total": "1.250,00"}',
+        "format_response": '{"cnpj": "", "data_emissao": "", "valor_total": ""}',
+    },
+    {
+        "llm_response": 'Claro! Aqui está a resposta:\n```json\n{"empresa": {"nome": "ACME LTDA", "cnpj": "12.345.678/0001-95"}, '
+                        '"itens": [{"descricao": "Serviço", "valor": 100.5}, {"descricao": "Peça", "valor": 20}]}\n```\nEspero ter ajudado.',
+        "format_response": '{"empresa": {"nome": "", "cnpj": ""}, "itens": [{"descricao": "", "valor": 0}]}',
+    },
+    {
+        "llm_response": 'Resultado da análise: [{"norma": "ISO 14001", "versao": "2004"}, {"norma": "ISO 9001", "versao": "2008"}] '
+                        'Observação: as datas {ver anexo} não foram encontradas.',
+        "format_response": '[{"norma": "", "versao": ""}]',
+    },
+    {
+        "llm_response": "Com base no documento, o CNPJ: 12.345.678/0001-95\nData de emissão: 15/03/2024\n"
+                        "valor_total = 1250,00\nnumero_nota: 000123",
+        "format_response": '{"CNPJ": "", "data_emissao": "", "valor_total": "", "numero_nota": ""}',
+    },
+    {
+        "llm_response": "O documento trata de gestão ambiental " * 80 + '{"titulo": "Sistema de Gestão Ambiental", "ano": 2004}',
+        "format_response": '{"titulo": "", "ano": 0}',
+    },
+    {
+        "llm_response": "Não encontrei as informações solicitadas no documento fornecido. { incompleto [ também",
+        "format_response": '{"data": "", "responsavel": ""}',
+        "example": '[{"data": "01/01/2024", "responsavel": "Fulano"}]',
+    },
+]
+
+def load_corpus(jsonl_path: str = None) -> list:
+    """Load real LLM outputs from the database and/or a JSONL file"""
+    corpus = []
+    try:
+        conn = sqlite3.connect(DATABASE_PATH)
+        for table in ["documents", "document_queries"]:
+            try:
+                rows = conn.execute(
+                    f"SELECT llm_response, format_response, example FROM {table} "
+                    "WHERE llm_response IS NOT NULL AND format_response IS NOT NULL"
+                ).fetchall()
+            except sqlite3.OperationalError:
+                continue
+            corpus += [{"llm_response": r[0], "format_response": r[1], "example": r[2]} for r in rows]
+        conn.close()
+    except sqlite3.Error as e:
+        print(f"⚠️ Não foi possível ler {DATABASE_PATH}: {e}")
+
+    if jsonl_path:
+        with open(jsonl_path, encoding="utf-8") as f:
+            corpus += [json.loads(line) for line in f if line.strip()]
+
+    return corpus
+
+# --- Implementação anterior (referência) ---
+
+def legacy_find_json(text: str, format_template: str):
+    pattern = r'\[.*?\]' if format_template.startswith('[') else r'\{.*?\}'
+    for match in re.findall(pattern, text, re.DOTALL):
+        try:
+            json.loads(match)
+            return match
+        except json.JSONDecodeError:
+            continue
+    return None
+
+def legacy_extract_value(text: str, key: str):
+    patterns = [
+        rf"{re.escape(key)}:\s*([^\n,}}]+)",
+        rf"{re.escape(key)}\s*:\s*([^\n,}}]+)",
+        rf"{re.escape(key)}\s*=\s*([^\n,}}]+)",
+        r"(\d{1,2}[/\-\.]\d{1,2}[/\-\.]\d{2,4})",
+        r"(\d{2,4}[/\-\.]\d{1,2}[/\-\.]\d{1,2})",
+        r"(\d{2}\.\d{3}\.\d{3}/\d{4}-\d{2})",
+        r"(\d{14})",
+        r"(\d+[,\.]\d+)",
+        r"(\d+)",
+    ]
+    for pattern in patterns:
+        matches = re.findall(pattern, text, re.IGNORECASE)
+        if matches:
+            value = re.sub(r'[,;\.]+$', '', matches[0].strip())
+            if value:
+                return value
+    return None
+
+def template_keys(format_template: str) -> list:
+    try:
+        template = json.loads(format_template)
+    except json.JSONDecodeError:
+        return []
+    if isinstance(template, list) and template and isinstance(template[0], dict):
+        return list(template[0].keys())
+    return list(template.keys()) if isinstance(template, dict) else []
+
+def legacy_extraction(item: dict):
+    found = legacy_find_json(item["llm_response"], item["format_response"])
+    if found is None:
+        return {key: legacy_extract_value(item["llm_response"], key) for key in template_keys(item["format_response"])}
+    return found
+
+def single_pass_extraction(item: dict):
+    expected_type = list if item["format_response"].startswith('[') else dict
+    found = find_json_value(item["llm_response"], expected_type)
+    if found is None:
+        return extract_template_values(item["llm_response"], template_keys(item["format_response"]))
+    return found
+
+def run_benchmark(corpus: list, function, iterations: int) -> float:
+    """Return the mean time per response in microseconds"""
+    start = time.perf_counter()
+    for _ in range(iterations):
+        for item in corpus:
+            function(item)
+    elapsed = time.perf_counter() - start
+    return elapsed / (iterations * len(corpus)) * 1e6
+
+def main():
+    parser = argparse.ArgumentParser(description="Micro-benchmark do formatador de respostas da LLM")
+    parser.add_argument("corpus", nargs="?", help="arquivo JSONL com llm_response/format_response/example")
+    parser.add_argument("--iterations", type=int, default=2000)
+    args = parser.parse_args()
+
+    logger.remove()  # Sem logs verbose durante a medição
+
+    corpus = load_corpus(args.corpus)
+    source = "respostas reais"
+    if not corpus:
+        corpus = SAMPLE_CORPUS
+        source = "amostras embutidas"
+
+    print(f"📊 Corpus: {len(corpus)} respostas ({source}), {args.iterations} iterações")
+    legacy = run_benchmark(corpus, legacy_extraction, args.iterations)
+    single_pass = run_benchmark(corpus, single_pass_extraction, args.iterations)
+
+    print(f"⏱️ Regex antigo:      {legacy:10.1f} µs/resposta")
+    print(f"⚡ Passada única:     {single_pass:10.1f} µs/resposta")
+    print(f"🚀 Speedup:           {legacy / single_pass:10.2f}x")
+
+if __name__ == "__main__":
+    sys.exit(main())
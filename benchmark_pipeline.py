@@ -0,0 +1,89 @@
+"""
+Benchmark de latência ponta a ponta: pipeline em tarefa única (fused) vs cadeia de tarefas (chained).
+
+Envia o mesmo documento pequeno N vezes em cada modo (header Pipeline-Mode),
+acompanha /response/{id} até a conclusão e compara p50/p95 do tempo entre o
+upload e o status "completed". Cache-Bypass evita que o cache de respostas da
+LLM esconda a diferença entre os modos.
+
+Para isolar o overhead do broker, use um Ollama falso com latência fixa:
+
+    python ollama_stub.py --delay 0.2 &
+    python benchmark_pipeline.py --file teste.jpg --n 20
+
+Uso: python benchmark_pipeline.py [--url URL] [--key KEY] [--file ARQUIVO] [--n N] [--model MODELO]
+"""
+import os
+import sys
+import time
+import argparse
+import statistics
+import httpx
+from dotenv import load_dotenv
+
+load_dotenv()
+
+POLL_INTERVAL_SECONDS = 0.05
+TIMEOUT_SECONDS = 300
+
+def percentile(values: list, pct: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+def upload_document(client: httpx.Client, key: str, filename: str, content: bytes, model: str, mode: str) -> int:
+    """Upload a document in the given pipeline mode and return its id"""
+    headers = {
+        "Key": key,
+        "Prompt": "Qual o assunto do documento?",
+        "Format-Response": '{"assunto": ""}',
+        "Model": model,
+        "Cache-Bypass": "1",
+        "Pipeline-Mode": mode,
+    }
+    upload = client.post("/upload", headers=headers, files={"file": (filename, content)})
+    upload.raise_for_status()
+    return upload.json()["document_id"]
+
+def wait_for_completion(client: httpx.Client, key: str, document_id: int, started: float) -> float:
+    """Poll /response/{id} and return seconds since started when the document completes"""
+    while time.perf_counter() - started < TIMEOUT_SECONDS:
+        status = client.get(f"/response/{document_id}", headers={"Key": key}).json()["data"]["status"].lower()
+        if status == "completed":
+            return time.perf_counter() - started
+        if status == "error":
+            raise RuntimeError(f"Document {document_id} failed")
+        time.sleep(POLL_INTERVAL_SECONDS)
+    raise TimeoutError(f"Document {document_id} did not complete in {TIMEOUT_SECONDS}s")
+
+def run_once(client: httpx.Client, args, mode: str) -> float:
+    """Upload the file in the given pipeline mode and return seconds until it completes"""
+    with open(args.file, "rb") as f:
+        content = f.read()
+    started = time.perf_counter()
+    document_id = upload_document(client, args.key, os.path.basename(args.file), content, args.model, mode)
+    return wait_for_completion(client, args.key, document_id, started)
+
+def main():
+    parser = argparse.ArgumentParser(description="Latência ponta a ponta: pipeline fused vs chained")
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--key", default=os.getenv("API_KEY", "your-super-secret-api-key-here"))
+    parser.add_argument("--file", default="teste.jpg", help="documento pequeno usado em todas as requisições")
+    parser.add_argument("--n", type=int, default=20, help="documentos por modo")
+    parser.add_argument("--model", default="gemma3:1b")
+    args = parser.parse_args()
+
+    print(f"📊 {args.n} documentos por modo ({args.file}, modelo {args.model})")
+    results = {}
+    with httpx.Client(base_url=args.url, timeout=60) as client:
+        for mode in ("chained", "fused"):
+            # Sequencial: mede a latência de um documento, não a vazão da fila
+            results[mode] = [run_once(client, args, mode) for _ in range(args.n)]
+            latencies = results[mode]
+            print(f"⏱️ {mode:8s} p50 {percentile(latencies, 50):6.3f}s  p95 {percentile(latencies, 95):6.3f}s  "
+                  f"média {statistics.mean(latencies):6.3f}s")
+
+    saved = statistics.median(results["chained"]) - statistics.median(results["fused"])
+    print(f"🚀 Fused economiza {saved * 1000:.0f} ms na mediana")
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,95 @@
+"""
+Benchmark de vazão com carga mista: PDFs escaneados longos (OCR, CPU) e
+documentos pequenos (quase só espera pela LLM, I/O).
+
+Envia todos os documentos de uma vez pelo /upload (Pipeline-Mode chained por
+padrão, para que cada etapa passe pela sua fila), espera todos concluírem e
+mostra a vazão total e a latência de cada classe. Rode uma vez com cada layout
+de workers e compare:
+
+    # layout antigo: um worker, duas filas, dois slots para tudo
+    celery -A workers worker -Q ocr,llm --concurrency=2
+    python benchmark_queues.py
+
+    # layout novo (supervisord.conf): OCR em prefork, LLM em threads
+    celery -A workers worker -Q ocr -n ocr@%h --pool=prefork &
+    celery -A workers worker -Q llm -n llm@%h --pool=threads --concurrency=16 &
+    python benchmark_queues.py
+
+Com --mode fused --small-file teste.jpg os documentos pequenos são imagens no
+pipeline fused: mede quanto tempo a espera pela LLM ocupa os processos de OCR.
+
+Uso: python benchmark_queues.py [--url URL] [--key KEY] [--ocr-file PDF] [--ocr-pages N] [--ocr-n N] [--small-n N]
+                                [--small-file ARQUIVO] [--mode chained|fused|auto]
+"""
+import io
+import os
+import sys
+import time
+import argparse
+import statistics
+from concurrent.futures import ThreadPoolExecutor
+import fitz
+import docx
+import httpx
+from dotenv import load_dotenv
+from benchmark_pipeline import percentile, upload_document, wait_for_completion
+
+load_dotenv()
+
+def build_scanned_pdf(source: str, pages: int) -> bytes:
+    """A PDF with the given number of pages, repeating the pages of source"""
+    with fitz.open(source) as original, fitz.open() as output:
+        while len(output) < pages:
+            output.insert_pdf(original, to_page=min(len(original), pages - len(output)) - 1)
+        return output.tobytes()
+
+def build_small_docx() -> bytes:
+    document = docx.Document()
+    document.add_paragraph("Recibo nº 123 - ACME LTDA - CNPJ 12.345.678/0001-95 - Valor R$ 150,00 - Data 15/03/2024")
+    buffer = io.BytesIO()
+    document.save(buffer)
+    return buffer.getvalue()
+
+def main():
+    parser = argparse.ArgumentParser(description="Vazão com carga mista de OCR e LLM")
+    parser.add_argument("--url", default="http://localhost:8000")
+    parser.add_argument("--key", default=os.getenv("API_KEY", "your-super-secret-api-key-here"))
+    parser.add_argument("--ocr-file", default="iso-14001 Antiga.pdf", help="PDF usado para montar os documentos longos")
+    parser.add_argument("--ocr-pages", type=int, default=10, help="páginas de cada documento longo")
+    parser.add_argument("--ocr-n", type=int, default=4, help="documentos longos (OCR)")
+    parser.add_argument("--small-n", type=int, default=20, help="documentos pequenos (LLM)")
+    parser.add_argument("--small-file", help="arquivo usado como documento pequeno (padrão: DOCX gerado)")
+    parser.add_argument("--mode", default="chained", choices=["chained", "fused", "auto"], help="Pipeline-Mode")
+    parser.add_argument("--model", default="gemma3:1b")
+    args = parser.parse_args()
+
+    jobs = [("ocr", "scan.pdf", build_scanned_pdf(args.ocr_file, args.ocr_pages))] * args.ocr_n
+    if args.small_file:
+        with open(args.small_file, "rb") as small_file:
+            small = (os.path.basename(args.small_file), small_file.read())
+    else:
+        small = ("recibo.docx", build_small_docx())
+    jobs += [("small", *small)] * args.small_n
+    print(f"📊 {args.ocr_n} PDFs de {args.ocr_pages} páginas + {args.small_n} documentos pequenos ({small[0]}, {args.mode})")
+
+    started = time.perf_counter()
+    with httpx.Client(base_url=args.url, timeout=60) as client:
+        # PDFs longos chegam primeiro: com slots compartilhados, os pequenos esperam o OCR
+        document_ids = [(kind, upload_document(client, args.key, name, content, args.model, args.mode))
+                        for kind, name, content in jobs]
+        with ThreadPoolExecutor(max_workers=16) as executor:
+            latencies = list(executor.map(
+                lambda job: (job[0], wait_for_completion(client, args.key, job[1], started)), document_ids
+            ))
+    makespan = time.perf_counter() - started
+
+    print(f"⏱️ Tempo total:  {makespan:7.2f}s  ({len(jobs) / makespan * 60:.1f} documentos/min)")
+    for kind in ("ocr", "small"):
+        values = [seconds for job_kind, seconds in latencies if job_kind == kind]
+        if values:
+            print(f"   {kind:6s} p50 {percentile(values, 50):7.2f}s  p95 {percentile(values, 95):7.2f}s  "
+                  f"média {statistics.mean(values):7.2f}s")
+
+if __name__ == "__main__":
+    sys.exit(main())
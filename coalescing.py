@@ -0,0 +1,108 @@
+"""
+Coalescência de envios idênticos em andamento (single-flight).
+
+Clientes que repetem o upload, ou vários sistemas enviando o mesmo arquivo e
+prompt ao mesmo tempo, criavam um Document por cópia e rodavam o pipeline
+inteiro para cada um. Agora o primeiro envio de uma combinação (hash do
+arquivo, prompt, formato, modelo, provedor) vira líder e toma uma trava no
+Redis; cópias idênticas que chegam enquanto ele está em andamento recebem o
+próprio document_id, ligado ao líder, e não são processadas. Quando o líder
+termina (concluído ou erro), o resultado é copiado para as cópias.
+
+As operações usam transações do Redis (WATCH), então funcionam entre vários
+processos da API: uma cópia nunca se registra em um líder que já terminou.
+"""
+import os
+import json
+import hashlib
+import redis
+from loguru import logger
+from dotenv import load_dotenv
+from redis_client import get_redis
+import metrics
+
+load_dotenv()
+
+# Configuration
+COALESCING_ENABLED = os.getenv("COALESCING_ENABLED", "true").lower() == "true"
+# Validade da trava do líder (um líder que morreu não segura as cópias para sempre)
+COALESCING_LOCK_TTL_SECONDS = int(os.getenv("COALESCING_LOCK_TTL_SECONDS", "1800"))
+
+LOCK_KEY_PREFIX = "coalesce:lock:"
+FOLLOWERS_KEY_PREFIX = "coalesce:followers:"
+
+def coalescing_key(file_content: bytes, prompt: str, format_response: str, model: str, ai_provider: str,
+                   **options) -> str:
+    """Identity of a submission: file hash plus everything that changes the answer
+    
+    options: demais parâmetros que mudam o resultado (exemplo, perguntas, opções do Deadline).
+    """
+    file_hash = hashlib.sha256(file_content).hexdigest()
+    request = json.dumps([prompt, format_response, model, ai_provider, options], ensure_ascii=False, sort_keys=True)
+    return f"{file_hash}:{hashlib.sha256(request.encode('utf-8')).hexdigest()}"
+
+def _followers_key(leader_id: int) -> str:
+    return f"{FOLLOWERS_KEY_PREFIX}{leader_id}"
+
+def join_or_lead(key: str, document_id: int) -> int:
+    """Become the leader of the key (returns None) or register as a follower (returns the leader id)"""
+    if not COALESCING_ENABLED:
+        return None
+    lock_key = f"{LOCK_KEY_PREFIX}{key}"
+    try:
+        client = get_redis()
+        with client.pipeline() as pipe:
+            while True:
+                if client.set(lock_key, document_id, nx=True, ex=COALESCING_LOCK_TTL_SECONDS):
+                    return None
+                try:
+                    pipe.watch(lock_key)
+                    leader_id = pipe.get(lock_key)
+                    if leader_id is None:
+                        # Líder terminou entre o SET e o GET: tenta liderar de novo
+                        pipe.unwatch()
+                        continue
+                    pipe.multi()
+                    pipe.sadd(_followers_key(leader_id), document_id)
+                    pipe.expire(_followers_key(leader_id), COALESCING_LOCK_TTL_SECONDS)
+                    pipe.execute()
+                    metrics.incr("coalescing.followers")
+                    logger.info(f"🤝 VERBOSE: Document {document_id} coalesced with in-flight document {leader_id}")
+                    return int(leader_id)
+                except redis.WatchError:
+                    continue
+    except Exception as e:
+        # Sem Redis: processa normalmente, só não coalesce
+        logger.debug(f"⚠️ VERBOSE: Could not coalesce document {document_id}: {e}")
+        return None
+
+def release_leadership(key: str, leader_id: int) -> list:
+    """Drop the leader lock and return the follower ids waiting on the leader"""
+    lock_key = f"{LOCK_KEY_PREFIX}{key}"
+    followers_key = _followers_key(leader_id)
+    try:
+        with get_redis().pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(lock_key)
+                    is_current = pipe.get(lock_key) == str(leader_id)
+                    pipe.multi()
+                    if is_current:
+                        # Trava expirada e retomada por outro líder: não é mais nossa
+                        pipe.delete(lock_key)
+                    pipe.smembers(followers_key)
+                    pipe.delete(followers_key)
+                    results = pipe.execute()
+                    return sorted(int(follower_id) for follower_id in results[-2])
+                except redis.WatchError:
+                    continue
+    except Exception as e:
+        logger.warning(f"⚠️ VERBOSE: Could not release coalesced followers of document {leader_id}: {e}")
+        return []
+
+def get_coalescing_stats() -> dict:
+    counters = metrics.get_counters("coalescing.")
+    return {
+        "followers": counters.get("coalescing.followers", 0),
+        "released": counters.get("coalescing.released", 0),
+    }
@@ -46,17 +46,36 @@ def migrate_database():
         conn = sqlite3.connect('documents.db')
         cursor = conn.cursor()
         
-        # Verificar se o campo full_prompt_sent existe
-        cursor.execute('PRAGMA table_info(documents)')
-        columns = cursor.fetchall()
-        column_names = [col[1] for col in columns]
+        # Campos adicionados depois da criação original de cada tabela
+        new_columns = {
+            'documents': {
+                'full_prompt_sent': 'TEXT',
+                'processing_info': 'TEXT',
+                'cache_bypass': 'BOOLEAN',
+                'questions': 'TEXT',
+                'questions_mode': 'VARCHAR(20)',
+                'hedge_policy': 'VARCHAR(20)',
+                'extractor_version': 'VARCHAR(50)',
+            },
+            'document_queries': {
+                'hedge_policy': 'VARCHAR(20)',
+            },
+        }
         
-        # Adicionar campo full_prompt_sent se não existir
-        if 'full_prompt_sent' not in column_names:
-            logger.info("🔧 Adicionando campo full_prompt_sent ao banco de dados...")
-            cursor.execute('ALTER TABLE documents ADD COLUMN full_prompt_sent TEXT')
-            conn.commit()
-            logger.info("✅ Campo full_prompt_sent adicionado com sucesso")
+        for table_name, table_columns in new_columns.items():
+            # Verificar quais campos já existem
+            cursor.execute(f'PRAGMA table_info({table_name})')
+            column_names = [col[1] for col in cursor.fetchall()]
+            if not column_names:
+                # Tabela ainda não existe: será criada completa pelo create_all
+                continue
+            
+            for column_name, column_type in table_columns.items():
+                if column_name not in column_names:
+                    logger.info(f"🔧 Adicionando campo {column_name} à tabela {table_name}...")
+                    cursor.execute(f'ALTER TABLE {table_name} ADD COLUMN {column_name} {column_type}')
+                    conn.commit()
+                    logger.info(f"✅ Campo {column_name} adicionado com sucesso")
         
         conn.close()
         
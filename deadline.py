@@ -0,0 +1,163 @@
+"""
+Degradação por prazo (header Deadline).
+
+Algumas integrações precisam de uma resposta dentro de um SLA fixo. Com o header
+Deadline (segundos a partir do upload), o custo de cada etapa é estimado pelos
+tempos históricos (latência de OCR por página e da LLM por modelo, gravadas no
+Redis) e, se não couber no prazo, opções mais baratas são aplicadas em ordem,
+até caber:
+
+1. text_layer_only: PDF digital - usa o texto embutido em vez do OCR
+2. lower_ocr_dpi: OCR com resolução menor (DEADLINE_LOW_OCR_ZOOM)
+3. fewer_tokens: menos contexto enviado à LLM (DEADLINE_CONTEXT_TOKEN_BUDGET)
+4. smaller_model: modelo Ollama menor (DEADLINE_SMALL_MODEL)
+5. fewer_pages: OCR só das primeiras páginas que cabem no prazo
+
+O plano fica em processing_info["deadline"]; o resultado é best-effort e vem
+marcado como degradado quando alguma opção foi aplicada.
+"""
+import os
+from loguru import logger
+from dotenv import load_dotenv
+from hedging import record_latency, latency_percentile
+from retrieval import RETRIEVAL_TOKEN_BUDGET
+from sizing import estimate_output_tokens
+from utils import OCR_ZOOM, pdf_has_text_layer
+from scheduling import (SCHEDULER_OCR_SECONDS_PER_PAGE, SCHEDULER_PARSE_SECONDS_PER_MB, SCHEDULER_GEMINI_SECONDS,
+                        estimate_llm_seconds, model_billions)
+
+load_dotenv()
+
+# Configuration
+DEADLINE_SMALL_MODEL = os.getenv("DEADLINE_SMALL_MODEL", "gemma3:1b")
+DEADLINE_LOW_OCR_ZOOM = float(os.getenv("DEADLINE_LOW_OCR_ZOOM", "1.25"))
+DEADLINE_CONTEXT_TOKEN_BUDGET = int(os.getenv("DEADLINE_CONTEXT_TOKEN_BUDGET", "600"))
+# Fração do prazo usada no plano (o resto absorve a espera na fila e a variação dos tempos)
+DEADLINE_SAFETY_FACTOR = float(os.getenv("DEADLINE_SAFETY_FACTOR", "0.8"))
+# Percentil dos tempos históricos usado na estimativa
+DEADLINE_TIMING_PERCENTILE = float(os.getenv("DEADLINE_TIMING_PERCENTILE", "90"))
+
+# Leitura do texto embutido no PDF: praticamente instantânea
+TEXT_LAYER_SECONDS_PER_PAGE = 0.02
+OCR_PROVIDER = "tesseract"
+
+def record_ocr_page(seconds: float, zoom: float = OCR_ZOOM):
+    """Store the OCR time of one page, per rendering zoom"""
+    record_latency(OCR_PROVIDER, f"zoom:{zoom:g}", seconds)
+
+def parse_deadline(value: str) -> float:
+    """Deadline header in seconds ("30" or "30s"). Raises ValueError"""
+    seconds = float(value.strip().lower().rstrip("s"))
+    if seconds <= 0:
+        raise ValueError(f"deadline must be positive: {seconds}")
+    return seconds
+
+def ocr_seconds_per_page(zoom: float) -> tuple[float, str]:
+    """Historical OCR seconds per page at the zoom
+    
+    Sem amostras nesse zoom, usa o histórico do zoom padrão (ou o padrão do
+    escalonador) proporcional à área renderizada.
+    """
+    observed = latency_percentile(OCR_PROVIDER, f"zoom:{zoom:g}", DEADLINE_TIMING_PERCENTILE)
+    if observed is not None:
+        return observed, "history"
+    area = (zoom / OCR_ZOOM) ** 2
+    observed = latency_percentile(OCR_PROVIDER, f"zoom:{OCR_ZOOM:g}", DEADLINE_TIMING_PERCENTILE)
+    if observed is not None:
+        return observed * area, "history"
+    return SCHEDULER_OCR_SECONDS_PER_PAGE * area, "default"
+
+def llm_seconds(model: str, ai_provider: str) -> tuple[float, str]:
+    """Historical LLM latency of the model, or the scheduler estimate by model size"""
+    observed = latency_percentile(ai_provider, model, DEADLINE_TIMING_PERCENTILE)
+    if observed is not None:
+        return observed, "history"
+    if ai_provider == "gemini":
+        return SCHEDULER_GEMINI_SECONDS, "default"
+    return estimate_llm_seconds(model, ai_provider), "default"
+
+def plan_for_deadline(deadline_seconds: float, file_path: str, file_type: str, file_size: int, pages: int,
+                      model: str, ai_provider: str, format_response: str = None, example: str = None) -> dict:
+    """Pick the cheaper options needed to finish within the deadline (processing_info["deadline"])"""
+    file_type = file_type.lower()
+    is_ocr = file_type in ("pdf", "jpg", "jpeg", "png")
+    budget = deadline_seconds * DEADLINE_SAFETY_FACTOR
+    output_tokens = estimate_output_tokens(format_response, example)
+    options = {}
+    sources = set()
+
+    def ocr_pages() -> int:
+        return min(pages, options.get("max_pages", pages))
+
+    def extraction_estimate() -> float:
+        if options.get("text_layer_only"):
+            return TEXT_LAYER_SECONDS_PER_PAGE * pages
+        if not is_ocr:
+            return SCHEDULER_PARSE_SECONDS_PER_MB * file_size / (1024 * 1024)
+        per_page, source = ocr_seconds_per_page(options.get("ocr_zoom", OCR_ZOOM))
+        sources.add(source)
+        return per_page * max(ocr_pages(), 1)
+
+    def llm_estimate() -> float:
+        seconds, source = llm_seconds(options.get("model", model), ai_provider)
+        sources.add(source)
+        if "context_token_budget" in options:
+            # Tempo da LLM proporcional aos tokens processados (contexto + resposta)
+            seconds *= (options["context_token_budget"] + output_tokens) / (RETRIEVAL_TOKEN_BUDGET + output_tokens)
+        return seconds
+
+    def estimate() -> float:
+        return extraction_estimate() + llm_estimate()
+
+    baseline = estimate()
+    degradations = []
+    steps = [
+        ("text_layer_only", lambda: file_type == "pdf" and pdf_has_text_layer(file_path),
+         lambda: {"text_layer_only": True}),
+        ("lower_ocr_dpi", lambda: is_ocr and not options.get("text_layer_only") and DEADLINE_LOW_OCR_ZOOM < OCR_ZOOM,
+         lambda: {"ocr_zoom": DEADLINE_LOW_OCR_ZOOM}),
+        ("fewer_tokens", lambda: DEADLINE_CONTEXT_TOKEN_BUDGET < RETRIEVAL_TOKEN_BUDGET,
+         lambda: {"context_token_budget": DEADLINE_CONTEXT_TOKEN_BUDGET}),
+        ("smaller_model", lambda: ai_provider == "ollama" and model_billions(DEADLINE_SMALL_MODEL) < model_billions(model),
+         lambda: {"model": DEADLINE_SMALL_MODEL}),
+        ("fewer_pages", lambda: file_type == "pdf" and not options.get("text_layer_only") and pages > 1,
+         lambda: {"max_pages": _pages_within(budget - llm_estimate(), options.get("ocr_zoom", OCR_ZOOM), pages)}),
+    ]
+    for name, applies, apply in steps:
+        if estimate() <= budget:
+            break
+        if not applies():
+            continue
+        before = estimate()
+        change = apply()
+        previous = dict(options)
+        options.update(change)
+        if estimate() >= before:
+            # Não ficou mais barato (ex: histórico do DPI menor mais lento): descarta a opção
+            options.clear()
+            options.update(previous)
+            continue
+        degradations.append({"step": name, **change, "estimated_seconds_before": round(before, 2),
+                             "estimated_seconds_after": round(estimate(), 2)})
+
+    estimated = estimate()
+    plan = {
+        "deadline_seconds": deadline_seconds,
+        "budget_seconds": round(budget, 2),
+        "baseline_seconds": round(baseline, 2),
+        "estimated_seconds": round(estimated, 2),
+        "meets_deadline": estimated <= budget,
+        "degraded": bool(degradations),
+        "degradations": degradations,
+        "options": options,
+        "timings": "history" if sources == {"history"} else "defaults" if sources == {"default"} else "mixed",
+    }
+    if degradations:
+        logger.info(f"⏱️ VERBOSE: Deadline {deadline_seconds}s - degraded with {[d['step'] for d in degradations]} "
+                    f"({plan['baseline_seconds']}s -> {plan['estimated_seconds']}s)")
+    return plan
+
+def _pages_within(seconds: float, zoom: float, pages: int) -> int:
+    """How many PDF pages can be OCRed in the given seconds (at least one)"""
+    per_page, _ = ocr_seconds_per_page(zoom)
+    return max(1, min(pages, int(seconds // per_page)))
@@ -0,0 +1,74 @@
+"""
+Classificação de erros do pipeline e política de novas tentativas por classe.
+
+Antes toda exceção era repetida com countdown=60 * 2^tentativa (até ~7 min), inclusive
+falhas que nunca vão passar (arquivo inexistente, tipo não suportado, modelo
+inválido). Agora cada erro cai em uma classe:
+
+- transient: rede/timeout, banco ocupado, 5xx genérico, corpo de resposta truncado
+  (JSON/UTF-8 inválido) - backoff curto com jitter
+- overload: provedor saturado (429/503, circuito aberto, sem slot de admissão) -
+  respeita o retry_after do provedor, com jitter
+- permanent: erro de entrada (arquivo, tipo, modelo, API key, 4xx) - falha na hora
+- unknown: demais exceções - poucas tentativas com backoff moderado
+"""
+import json
+import random
+import httpx
+from sqlalchemy.exc import OperationalError
+from admission import AdmissionTimeoutError
+from ollama_health import OllamaUnavailableError
+
+TRANSIENT = "transient"
+OVERLOAD = "overload"
+PERMANENT = "permanent"
+UNKNOWN = "unknown"
+
+# Classe: (máximo de novas tentativas, base em segundos, teto em segundos)
+RETRY_POLICIES = {
+    TRANSIENT: (5, 2, 30),
+    OVERLOAD: (6, 5, 120),
+    PERMANENT: (0, 0, 0),
+    UNKNOWN: (3, 10, 120),
+}
+
+class PermanentError(Exception):
+    """Input error that no retry can fix (missing file, unsupported type, bad configuration)"""
+
+def classify_error(error: Exception) -> str:
+    """Error class used to pick the retry policy"""
+    if isinstance(error, (OllamaUnavailableError, AdmissionTimeoutError)):
+        return OVERLOAD
+    if isinstance(error, (PermanentError, FileNotFoundError)):
+        # Erros de entrada viram PermanentError onde são validados (ValueError genérico não é permanente)
+        return PERMANENT
+    if isinstance(error, httpx.HTTPStatusError):
+        return _classify_status(error.response.status_code)
+    if isinstance(error, (httpx.TransportError, ConnectionError, TimeoutError, OperationalError,
+                          json.JSONDecodeError, UnicodeDecodeError)):
+        # JSON/UTF-8 inválido: corpo truncado ou corrompido na resposta do provedor
+        return TRANSIENT
+    # google-genai APIError expõe o status HTTP em "code"
+    code = getattr(error, "code", None)
+    if isinstance(code, int) and 400 <= code < 600:
+        return _classify_status(code)
+    return UNKNOWN
+
+def _classify_status(status_code: int) -> str:
+    if status_code in (429, 503):
+        return OVERLOAD
+    if status_code >= 500 or status_code == 408:
+        return TRANSIENT
+    # 4xx: modelo inexistente (404), requisição inválida, API key recusada
+    return PERMANENT
+
+def max_retries_for(error_class: str) -> int:
+    return RETRY_POLICIES[error_class][0]
+
+def retry_countdown(error_class: str, attempt: int, retry_after: float = None) -> float:
+    """Jittered exponential backoff for the class; overload waits at least the provider's retry_after"""
+    _, base, cap = RETRY_POLICIES[error_class]
+    delay = random.uniform(base, max(base, min(cap, base * (2 ** attempt))))
+    if error_class == OVERLOAD and retry_after:
+        delay = max(delay, min(float(retry_after), cap))
+    return round(delay, 1)
@@ -0,0 +1,113 @@
+"""
+Cliente Gemini compartilhado.
+
+- Um genai.Client por API key, reutilizado entre chamadas (antes era criado
+  um cliente novo a cada prompt)
+- Chamadas pela interface assíncrona do SDK (client.aio), sem bloquear o
+  event loop durante a chamada remota
+- Concorrência limitada pelo controle de admissão (admission.py) e novas
+  tentativas com backoff exponencial e jitter para erros transitórios
+  (429, 5xx, timeout, conexão)
+- Lista de modelos em cache por GEMINI_MODELS_CACHE_SECONDS
+- GEMINI_BASE_URL aponta o SDK para outro endpoint (ex: gemini_stub.py)
+"""
+import os
+import time
+import random
+import asyncio
+import hashlib
+import threading
+from loguru import logger
+from dotenv import load_dotenv
+from admission import admit, is_overload_error
+from errors import PermanentError
+import metrics
+
+load_dotenv()
+
+# Configuration
+GEMINI_BASE_URL = os.getenv("GEMINI_BASE_URL", "")  # vazio = API do Google
+GEMINI_MAX_RETRIES = int(os.getenv("GEMINI_MAX_RETRIES", "3"))
+GEMINI_RETRY_BASE_SECONDS = float(os.getenv("GEMINI_RETRY_BASE_SECONDS", "1.0"))
+GEMINI_RETRY_MAX_SECONDS = float(os.getenv("GEMINI_RETRY_MAX_SECONDS", "30"))
+GEMINI_MODELS_CACHE_SECONDS = int(os.getenv("GEMINI_MODELS_CACHE_SECONDS", "3600"))
+
+_clients = {}
+_clients_lock = threading.Lock()
+_models_cache = {}
+
+def _key_id(api_key: str) -> str:
+    # A API key nunca aparece em logs nem como chave de cache em texto puro
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:16]
+
+def get_gemini_client(api_key: str):
+    """Shared genai.Client for an API key"""
+    key_id = _key_id(api_key)
+    with _clients_lock:
+        client = _clients.get(key_id)
+        if client is None:
+            from google import genai
+            http_options = {"base_url": GEMINI_BASE_URL} if GEMINI_BASE_URL else None
+            client = genai.Client(api_key=api_key, http_options=http_options)
+            _clients[key_id] = client
+            logger.info(f"🌟 VERBOSE: Created Gemini client {key_id}" + (f" ({GEMINI_BASE_URL})" if GEMINI_BASE_URL else ""))
+        return client
+
+def retry_delay(attempt: int) -> float:
+    """Full jitter: random wait between 0 and base * 2^attempt (capped)"""
+    return random.uniform(0, min(GEMINI_RETRY_MAX_SECONDS, GEMINI_RETRY_BASE_SECONDS * (2 ** attempt)))
+
+async def generate_content(api_key: str, model: str, contents: str, config: dict,
+                           output_tokens: int = None, call_info: dict = None):
+    """Async generate_content with admission control and retries on transient errors
+
+    output_tokens: resposta esperada, usada pelo limitador quando a resposta não traz usage_metadata.
+    """
+    if not api_key:
+        raise PermanentError("Gemini API key is not configured")
+    client = get_gemini_client(api_key)
+    attempt = 0
+    while True:
+        try:
+            # Cada tentativa passa pela admissão: o slot não fica preso durante o backoff
+            async with admit("gemini", model, output_tokens, call_info) as usage:
+                response = await client.aio.models.generate_content(model=model, contents=contents, config=config)
+                usage_metadata = getattr(response, "usage_metadata", None)
+                if usage_metadata is not None and usage_metadata.candidates_token_count:
+                    usage["output_tokens"] = usage_metadata.candidates_token_count
+                return response
+        except Exception as e:
+            if not is_overload_error(e) or attempt >= GEMINI_MAX_RETRIES:
+                raise
+            delay = retry_delay(attempt)
+            attempt += 1
+            if call_info is not None:
+                call_info["retries"] = attempt
+            metrics.incr("gemini.retries")
+            logger.warning(f"🔄 VERBOSE: Transient Gemini error ({e}) - retry {attempt}/{GEMINI_MAX_RETRIES} in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+async def list_models(api_key: str) -> list:
+    """Gemini models that support generateContent (cached per API key)"""
+    key_id = _key_id(api_key)
+    cached = _models_cache.get(key_id)
+    if cached and time.time() - cached["fetched_at"] < GEMINI_MODELS_CACHE_SECONDS:
+        metrics.incr("gemini.models_cache.hits")
+        return cached["models"]
+
+    metrics.incr("gemini.models_cache.misses")
+    client = get_gemini_client(api_key)
+    models = []
+    async for model in await client.aio.models.list(config={"query_base": True, "page_size": 100}):
+        if "generateContent" not in (model.supported_actions or []):
+            continue
+        models.append({
+            'name': (model.name or '').replace('models/', ''),
+            'description': (model.description or '').split('.')[0],  # First sentence only
+            'version': model.version or 'latest',
+            'input_token_limit': model.input_token_limit or 'unknown',
+            'output_token_limit': model.output_token_limit or 'unknown'
+        })
+
+    _models_cache[key_id] = {"models": models, "fetched_at": time.time()}
+    return models
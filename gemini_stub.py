@@ -0,0 +1,90 @@
+"""
+Servidor Gemini falso para testes locais do cliente Gemini.
+
+Implementa a listagem de modelos e generateContent da API v1beta com latência e
+taxa de erros transitórios (429/503) configuráveis, sem API key real nem
+custo. Exemplo:
+
+    python gemini_stub.py --port 11500 --delay 0.5 --fail-rate 0.2 &
+    GEMINI_BASE_URL=http://localhost:11500 celery -A workers worker
+"""
+import json
+import random
+import asyncio
+import argparse
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+from ollama_stub import _sample_value
+
+def create_app(models: list, delay: float, fail_rate: float) -> FastAPI:
+    app = FastAPI(title="Gemini stub")
+    stats = {"requests": 0, "failures": 0, "in_flight": 0, "max_in_flight": 0, "list_calls": 0}
+
+    @app.get("/v1beta/models")
+    async def list_models():
+        stats["list_calls"] += 1
+        return {"models": [
+            {
+                "name": f"models/{model}",
+                "version": "001",
+                "description": f"Stub model {model}. Local testing only",
+                "inputTokenLimit": 1048576,
+                "outputTokenLimit": 8192,
+                "supportedGenerationMethods": ["generateContent", "countTokens"],
+            }
+            for model in models
+        ]}
+
+    @app.get("/stats")
+    async def get_stats():
+        return stats
+
+    @app.post("/v1beta/models/{model}:generateContent")
+    async def generate_content(model: str, request: Request):
+        body = await request.json()
+        if model not in models:
+            return JSONResponse(status_code=404, content={"error": {"code": 404, "message": f"models/{model} is not found", "status": "NOT_FOUND"}})
+
+        if random.random() < fail_rate:
+            stats["failures"] += 1
+            code, status = random.choice([(429, "RESOURCE_EXHAUSTED"), (503, "UNAVAILABLE")])
+            return JSONResponse(status_code=code, content={"error": {"code": code, "message": "stub transient error", "status": status}})
+
+        stats["requests"] += 1
+        stats["in_flight"] += 1
+        stats["max_in_flight"] = max(stats["max_in_flight"], stats["in_flight"])
+        try:
+            await asyncio.sleep(delay)
+        finally:
+            stats["in_flight"] -= 1
+
+        config = body.get("generationConfig") or {}
+        schema = config.get("responseSchema")
+        text = json.dumps(_sample_value(schema)) if isinstance(schema, dict) else f'{{"model": "{model}"}}'
+        prompt = " ".join(part.get("text", "") for content in body.get("contents", []) for part in content.get("parts", []))
+        return {
+            "candidates": [{"content": {"parts": [{"text": text}], "role": "model"}, "finishReason": "STOP", "index": 0}],
+            "usageMetadata": {
+                "promptTokenCount": len(prompt) // 4,
+                "candidatesTokenCount": len(text) // 4,
+                "totalTokenCount": (len(prompt) + len(text)) // 4,
+            },
+            "modelVersion": model,
+        }
+
+    return app
+
+def main():
+    parser = argparse.ArgumentParser(description="Servidor Gemini falso para testes locais")
+    parser.add_argument("--port", type=int, default=11500)
+    parser.add_argument("--models", default="gemini-2.0-flash,gemini-1.5-flash", help="modelos disponíveis, separados por vírgula")
+    parser.add_argument("--delay", type=float, default=0.5, help="latência de cada geração em segundos")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="fração de gerações que retornam 429/503")
+    args = parser.parse_args()
+
+    app = create_app(args.models.split(","), args.delay, args.fail_rate)
+    uvicorn.run(app, host="127.0.0.1", port=args.port, log_level="warning")
+
+if __name__ == "__main__":
+    main()
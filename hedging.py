@@ -0,0 +1,225 @@
+"""
+Requisições duplicadas (hedged requests) para gerações no Ollama.
+
+Se a geração não terminar dentro de um prazo baseado no percentil de latência
+histórico do modelo (HEDGE_PERCENTILE), a mesma requisição é enviada a um
+destino secundário. A primeira resposta válida vence e a outra é cancelada.
+
+Políticas (header Hedge-Policy, padrão HEDGE_DEFAULT_POLICY):
+- off: sem duplicação
+- instance: outro backend Ollama do pool, mesmo modelo
+- gemini: Gemini (HEDGE_GEMINI_MODEL), requer GEMINI_API_KEY
+- auto: instance se houver mais de um backend, senão gemini se houver API key
+
+O custo extra (tempo de provedor e tokens da requisição perdedora, custo
+estimado no Gemini) é contabilizado nas métricas.
+"""
+import os
+import time
+import asyncio
+from loguru import logger
+from dotenv import load_dotenv
+from redis_client import get_redis
+from retrieval import estimate_tokens
+from sizing import estimate_output_tokens
+from ollama_pool import get_pool
+from utils import send_prompt_to_ollama, send_prompt_to_gemini
+import metrics
+
+load_dotenv()
+
+# Configuration
+HEDGE_DEFAULT_POLICY = os.getenv("HEDGE_DEFAULT_POLICY", "off").lower()
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "95"))
+HEDGE_MIN_DEADLINE_SECONDS = float(os.getenv("HEDGE_MIN_DEADLINE_SECONDS", "1.0"))
+# Prazo usado enquanto não há amostras suficientes de latência
+HEDGE_DEFAULT_DEADLINE_SECONDS = float(os.getenv("HEDGE_DEFAULT_DEADLINE_SECONDS", "15"))
+HEDGE_GEMINI_MODEL = os.getenv("HEDGE_GEMINI_MODEL", os.getenv("OLLAMA_FALLBACK_MODEL", "gemini-2.0-flash"))
+# Preço do Gemini em USD por milhão de tokens (para o custo extra estimado)
+HEDGE_GEMINI_INPUT_PRICE_PER_1M = float(os.getenv("HEDGE_GEMINI_INPUT_PRICE_PER_1M", "0.10"))
+HEDGE_GEMINI_OUTPUT_PRICE_PER_1M = float(os.getenv("HEDGE_GEMINI_OUTPUT_PRICE_PER_1M", "0.40"))
+GEMINI_API_KEY = os.getenv("GEMINI_API_KEY", "")
+
+HEDGE_POLICIES = ("off", "instance", "gemini", "auto")
+
+LATENCY_KEY_PREFIX = "latency:"
+# Amostras mantidas por provedor+modelo e mínimo para calcular o percentil
+LATENCY_HISTORY_SIZE = 200
+LATENCY_MIN_SAMPLES = 20
+
+def record_latency(provider: str, model: str, seconds: float):
+    """Store the latency of a completed (non-cached) generation"""
+    try:
+        key = f"{LATENCY_KEY_PREFIX}{provider}:{model}"
+        pipe = get_redis().pipeline()
+        pipe.lpush(key, round(seconds, 3))
+        pipe.ltrim(key, 0, LATENCY_HISTORY_SIZE - 1)
+        pipe.execute()
+    except Exception as e:
+        logger.debug(f"⚠️ VERBOSE: Could not record latency: {e}")
+
+def latency_percentile(provider: str, model: str, percentile: float = HEDGE_PERCENTILE) -> float:
+    """Latency percentile of recent generations (None without enough samples)"""
+    try:
+        samples = sorted(float(value) for value in get_redis().lrange(f"{LATENCY_KEY_PREFIX}{provider}:{model}", 0, -1))
+    except Exception:
+        return None
+    if len(samples) < LATENCY_MIN_SAMPLES:
+        return None
+    index = min(len(samples) - 1, int(round(percentile / 100 * (len(samples) - 1))))
+    return samples[index]
+
+def hedge_deadline(model: str) -> float:
+    """Seconds to wait for the primary before launching the duplicate"""
+    observed = latency_percentile("ollama", model)
+    if observed is None:
+        return HEDGE_DEFAULT_DEADLINE_SECONDS
+    return max(HEDGE_MIN_DEADLINE_SECONDS, observed)
+
+def resolve_policy(policy: str, gemini_api_key: str = None) -> str:
+    """Turn the requested policy into the one that can actually run here"""
+    policy = (policy or HEDGE_DEFAULT_POLICY).lower()
+    has_instances = len(get_pool().backends) > 1
+    has_gemini = bool(gemini_api_key or GEMINI_API_KEY)
+    if policy == "auto":
+        policy = "instance" if has_instances else "gemini" if has_gemini else "off"
+    if (policy == "instance" and not has_instances) or (policy == "gemini" and not has_gemini):
+        return "off"
+    return policy if policy in HEDGE_POLICIES else "off"
+
+def _is_valid(result) -> bool:
+    llm_response, _ = result
+    return bool(llm_response and llm_response.strip())
+
+async def _wait_admitted(primary: asyncio.Future, admitted: asyncio.Event) -> float:
+    """Wait until the primary holds its admission slot and backend lease (or finished). Returns that moment"""
+    waiter = asyncio.ensure_future(admitted.wait())
+    await asyncio.wait({primary, waiter}, return_when=asyncio.FIRST_COMPLETED)
+    waiter.cancel()
+    return time.time()
+
+def _estimate_cost(full_prompt_tokens: int, output_tokens: int) -> float:
+    return (full_prompt_tokens * HEDGE_GEMINI_INPUT_PRICE_PER_1M + output_tokens * HEDGE_GEMINI_OUTPUT_PRICE_PER_1M) / 1_000_000
+
+async def generate_with_policy(prompt: str, context: str, model: str, format_response: str = None, example: str = None,
+                               use_cache: bool = True, call_info: dict = None, reuse_key: str = None,
+                               policy: str = None, gemini_api_key: str = None) -> tuple[str, str]:
+    """Ollama generation with an optional hedged duplicate. Returns (llm_response, full_prompt)"""
+    if call_info is None:
+        call_info = {}
+    policy = resolve_policy(policy, gemini_api_key)
+    # Latência e prazo contam a partir da admissão: espera na fila de admissão ou do pool não é lentidão do modelo
+    admitted = asyncio.Event()
+    primary = asyncio.ensure_future(send_prompt_to_ollama(prompt, context, model, format_response, example,
+                                                          use_cache=use_cache, call_info=call_info, reuse_key=reuse_key,
+                                                          admitted=admitted))
+    started = await _wait_admitted(primary, admitted)
+
+    if policy == "off":
+        result = await primary
+        if call_info.get("cache") != "hit":
+            record_latency("ollama", model, time.time() - started)
+        return result
+
+    deadline = hedge_deadline(model)
+    hedge_info = {"policy": policy, "deadline_seconds": round(deadline, 3), "launched": False, "winner": "primary"}
+    call_info["hedge"] = hedge_info
+    metrics.incr("hedge.calls")
+
+    done, _ = await asyncio.wait({primary}, timeout=deadline)
+    if primary in done:
+        result = primary.result()
+        if call_info.get("cache") != "hit":
+            record_latency("ollama", model, time.time() - started)
+        return result
+
+    # Primária passou do prazo: dispara a duplicata e fica com a primeira resposta válida
+    secondary_info = {}
+    hedge_info["launched"] = True
+    hedge_info["secondary_call"] = secondary_info
+    metrics.incr("hedge.launched")
+    if policy == "instance":
+        target = "instance"
+        secondary = asyncio.ensure_future(send_prompt_to_ollama(
+            prompt, context, model, format_response, example, use_cache=use_cache, call_info=secondary_info,
+            exclude_backends=[call_info["backend"]] if call_info.get("backend") else None
+        ))
+    else:
+        target = "gemini"
+        secondary = asyncio.ensure_future(send_prompt_to_gemini(
+            prompt, context, HEDGE_GEMINI_MODEL, gemini_api_key or GEMINI_API_KEY, format_response, example,
+            use_cache=use_cache, call_info=secondary_info
+        ))
+    hedge_started = time.time()
+    logger.info(f"🪁 VERBOSE: '{model}' slower than {deadline:.1f}s (p{HEDGE_PERCENTILE:g}) - hedging on {target}")
+
+    winner, loser = None, None
+    pending = {primary, secondary}
+    errors = []
+    while pending:
+        done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        for task in done:
+            if task.exception() is not None:
+                errors.append(task.exception())
+            elif winner is None and _is_valid(task.result()):
+                winner = task
+        if winner is not None:
+            break
+
+    loser = secondary if winner is primary else primary
+    # Primária que perdeu: o tempo até aqui é um limite inferior da latência real. Sem ele o
+    # histórico perderia justamente as amostras lentas e o percentil (prazo do hedge) cairia sozinho
+    primary_failed = primary.done() and primary.exception() is not None
+    primary_elapsed = time.time() - started
+    if not loser.done():
+        loser.cancel()
+        try:
+            await loser
+        except (asyncio.CancelledError, Exception):
+            pass
+        metrics.incr("hedge.cancelled")
+
+    if winner is None:
+        if errors:
+            raise errors[0]
+        # Nenhuma resposta válida: devolve a da primária (vazia) como antes
+        winner = primary
+
+    # Custo extra: o trabalho da requisição que não foi usada
+    extra_seconds = time.time() - (hedge_started if winner is primary else started)
+    full_prompt = winner.result()[1]
+    extra_tokens = estimate_tokens(full_prompt) + estimate_output_tokens(format_response, example)
+    extra_cost = 0.0
+    if target == "gemini":
+        # Toda duplicata no Gemini é gasto a mais (o SDK não interrompe a chamada em andamento ao cancelar)
+        extra_cost = _estimate_cost(estimate_tokens(full_prompt), estimate_output_tokens(format_response, example))
+    hedge_info.update({
+        "winner": "primary" if winner is primary else target,
+        "extra_seconds": round(extra_seconds, 3),
+        "extra_tokens": extra_tokens,
+        "extra_cost_usd": round(extra_cost, 6),
+    })
+    metrics.incr(f"hedge.wins.{'primary' if winner is primary else 'secondary'}")
+    metrics.incr("hedge.extra_seconds", extra_seconds)
+    metrics.incr("hedge.extra_tokens", extra_tokens)
+    metrics.incr("hedge.extra_cost_usd", extra_cost)
+    logger.info(f"🏁 VERBOSE: Hedge winner: {hedge_info['winner']} (extra {extra_seconds:.2f}s, ~{extra_tokens} tokens)")
+
+    if winner is primary:
+        record_latency("ollama", model, time.time() - started)
+    elif not primary_failed and call_info.get("cache") != "hit":
+        record_latency("ollama", model, primary_elapsed)
+    return winner.result()
+
+def get_hedge_stats() -> dict:
+    """Hedging rate, winners and extra cost"""
+    counters = metrics.get_counters("hedge.")
+    return {
+        "calls": counters.get("hedge.calls", 0),
+        "launched": counters.get("hedge.launched", 0),
+        "hedge_rate": metrics.rate(counters, "hedge.launched", "hedge.calls"),
+        "secondary_win_rate": metrics.rate(counters, "hedge.wins.secondary", "hedge.launched"),
+        "extra_seconds": counters.get("hedge.extra_seconds", 0),
+        "extra_tokens": counters.get("hedge.extra_tokens", 0),
+        "extra_cost_usd": counters.get("hedge.extra_cost_usd", 0),
+    }
@@ -0,0 +1,188 @@
+"""
+Cache de respostas da LLM.
+
+A chave combina provider, modelo, hash do full_prompt exato e as opções de
+geração. Suporta TTL e despejo LRU, com backend Redis (o mesmo já usado pelo
+Celery) ou SQLite local.
+"""
+import os
+import json
+import time
+import hashlib
+import sqlite3
+import threading
+from loguru import logger
+from dotenv import load_dotenv
+from redis_client import get_redis
+import metrics
+
+load_dotenv()
+
+# Configuration
+LLM_CACHE_ENABLED = os.getenv("LLM_CACHE_ENABLED", "true").lower() == "true"
+LLM_CACHE_BACKEND = os.getenv("LLM_CACHE_BACKEND", "redis").lower()  # "redis" ou "sqlite"
+LLM_CACHE_TTL_SECONDS = int(os.getenv("LLM_CACHE_TTL_SECONDS", "86400"))
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "1000"))
+LLM_CACHE_SQLITE_PATH = os.getenv("LLM_CACHE_SQLITE_PATH", "llm_cache.db")
+
+def make_cache_key(provider: str, model: str, full_prompt: str, options: dict = None) -> str:
+    """Build the cache key from provider, model, prompt hash and generation options"""
+    prompt_hash = hashlib.sha256(full_prompt.encode("utf-8")).hexdigest()
+    key_data = json.dumps(
+        {"provider": provider, "model": model, "prompt": prompt_hash, "options": options or {}},
+        sort_keys=True,
+        default=str
+    )
+    return hashlib.sha256(key_data.encode("utf-8")).hexdigest()
+
+class RedisCacheBackend:
+    """Redis backend: values with native TTL and a sorted set ordered by last access for LRU"""
+
+    DATA_PREFIX = "llm_cache:data:"
+    LRU_KEY = "llm_cache:lru"
+
+    def get(self, key: str):
+        client = get_redis()
+        value = client.get(self.DATA_PREFIX + key)
+        if value is None:
+            client.zrem(self.LRU_KEY, key)
+            return None
+        client.zadd(self.LRU_KEY, {key: time.time()})
+        return value
+
+    def set(self, key: str, value: str):
+        client = get_redis()
+        pipe = client.pipeline()
+        pipe.set(self.DATA_PREFIX + key, value, ex=LLM_CACHE_TTL_SECONDS)
+        pipe.zadd(self.LRU_KEY, {key: time.time()})
+        pipe.execute()
+        self._evict(client)
+
+    def _evict(self, client):
+        excess = client.zcard(self.LRU_KEY) - LLM_CACHE_MAX_ENTRIES
+        if excess > 0:
+            oldest = client.zrange(self.LRU_KEY, 0, excess - 1)
+            pipe = client.pipeline()
+            pipe.delete(*[self.DATA_PREFIX + k for k in oldest])
+            pipe.zrem(self.LRU_KEY, *oldest)
+            pipe.execute()
+            metrics.incr("llm_cache.evictions", len(oldest))
+
+    def entries(self) -> int:
+        return get_redis().zcard(self.LRU_KEY)
+
+class SQLiteCacheBackend:
+    """SQLite backend: TTL checked on read and LRU by last_access column"""
+
+    def __init__(self, path: str = LLM_CACHE_SQLITE_PATH):
+        self.path = path
+        self.lock = threading.Lock()
+        with self._connect() as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS llm_cache ("
+                "key TEXT PRIMARY KEY, response TEXT NOT NULL, "
+                "created_at REAL NOT NULL, last_access REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_llm_cache_last_access ON llm_cache(last_access)")
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=5)
+
+    def get(self, key: str):
+        now = time.time()
+        with self.lock, self._connect() as conn:
+            row = conn.execute("SELECT response, created_at FROM llm_cache WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if now - row[1] > LLM_CACHE_TTL_SECONDS:
+                conn.execute("DELETE FROM llm_cache WHERE key = ?", (key,))
+                return None
+            conn.execute("UPDATE llm_cache SET last_access = ? WHERE key = ?", (now, key))
+            return row[0]
+
+    def set(self, key: str, value: str):
+        now = time.time()
+        with self.lock, self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, response, created_at, last_access) VALUES (?, ?, ?, ?)",
+                (key, value, now, now)
+            )
+            conn.execute("DELETE FROM llm_cache WHERE created_at < ?", (now - LLM_CACHE_TTL_SECONDS,))
+            excess = conn.execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0] - LLM_CACHE_MAX_ENTRIES
+            if excess > 0:
+                conn.execute(
+                    "DELETE FROM llm_cache WHERE key IN (SELECT key FROM llm_cache ORDER BY last_access LIMIT ?)",
+                    (excess,)
+                )
+                metrics.incr("llm_cache.evictions", excess)
+
+    def entries(self) -> int:
+        with self._connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM llm_cache").fetchone()[0]
+
+_backend = None
+
+def get_cache_backend():
+    """Get the configured cache backend (created on first use)"""
+    global _backend
+    if _backend is None:
+        _backend = SQLiteCacheBackend() if LLM_CACHE_BACKEND == "sqlite" else RedisCacheBackend()
+        logger.info(f"🗃️ VERBOSE: LLM response cache using {type(_backend).__name__}")
+    return _backend
+
+def get_cached_response(provider: str, model: str, full_prompt: str, options: dict = None):
+    """Return the cached LLM response for this request, or None on miss"""
+    if not LLM_CACHE_ENABLED:
+        return None
+
+    key = make_cache_key(provider, model, full_prompt, options)
+    try:
+        cached = get_cache_backend().get(key)
+    except Exception as e:
+        logger.warning(f"⚠️ VERBOSE: LLM cache lookup failed: {e}")
+        metrics.incr("llm_cache.errors")
+        return None
+
+    metrics.incr("llm_cache.lookups")
+    if cached is None:
+        metrics.incr("llm_cache.misses")
+        logger.info(f"🗃️ VERBOSE: LLM cache MISS ({provider}/{model}, key {key[:12]})")
+        return None
+
+    metrics.incr("llm_cache.hits")
+    logger.info(f"⚡ VERBOSE: LLM cache HIT ({provider}/{model}, key {key[:12]})")
+    return cached
+
+def store_cached_response(provider: str, model: str, full_prompt: str, options: dict, response: str):
+    """Store an LLM response in the cache"""
+    if not LLM_CACHE_ENABLED or not response:
+        return
+
+    key = make_cache_key(provider, model, full_prompt, options)
+    try:
+        get_cache_backend().set(key, response)
+        metrics.incr("llm_cache.stores")
+    except Exception as e:
+        logger.warning(f"⚠️ VERBOSE: Failed to store LLM response in cache: {e}")
+        metrics.incr("llm_cache.errors")
+
+def get_cache_stats() -> dict:
+    """Cache configuration and hit-rate metrics"""
+    counters = metrics.get_counters("llm_cache.")
+    try:
+        entries = get_cache_backend().entries() if LLM_CACHE_ENABLED else 0
+    except Exception:
+        entries = None
+
+    return {
+        "enabled": LLM_CACHE_ENABLED,
+        "backend": LLM_CACHE_BACKEND,
+        "ttl_seconds": LLM_CACHE_TTL_SECONDS,
+        "max_entries": LLM_CACHE_MAX_ENTRIES,
+        "entries": entries,
+        "hits": counters.get("llm_cache.hits", 0),
+        "misses": counters.get("llm_cache.misses", 0),
+        "hit_rate": metrics.rate(counters, "llm_cache.hits", "llm_cache.lookups"),
+        "evictions": counters.get("llm_cache.evictions", 0),
+        "errors": counters.get("llm_cache.errors", 0),
+    }
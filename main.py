@@ -2,12 +2,25 @@ from fastapi import FastAPI, File, UploadFile, Header, HTTPException, Depends, s
 from fastapi.responses import JSONResponse
 from pydantic import BaseModel, Field
 from database import get_async_db, init_database, close_database, SessionLocal
-from models import Document, DocumentStatus
-from utils import is_allowed_file, save_uploaded_file, validate_file_size, list_gemini_models
-from workers import extract_text_task
+from models import Document, DocumentQuery, DocumentStatus, load_processing_info
+from utils import is_allowed_file, save_uploaded_file, validate_file_size, list_gemini_models, count_document_pages
+from workers import start_document_pipeline, enqueue_prompt_task, PIPELINE_MODES
+from llm_cache import get_cache_stats
+from model_residency import list_loaded_models, get_pending_by_model, OLLAMA_PRELOAD_MODELS
+from ollama_health import start_health_monitor
+from ollama_pool import get_pool
+from admission import get_admission_stats
+from hedging import HEDGE_POLICIES, get_hedge_stats
+from scheduling import parse_priority, plan_job, priority_for_cost, get_scheduler_stats
+from deadline import parse_deadline, plan_for_deadline
+from progressive import EXTRACTION_MODE, EXTRACTION_MODES
+from coalescing import coalescing_key, join_or_lead, get_coalescing_stats
+from questions import QUESTIONS_MODES, parse_questions, summarize_questions, build_packed_request
+import metrics
 from loguru import logger
 from dotenv import load_dotenv
 import os
+import json
 from typing import Optional, List
 import uvicorn
 
@@ -80,6 +93,17 @@ class UploadResponse(BaseModel):
     ai_provider: str = Field(description="Provedor de AI utilizado (ollama/gemini)")
     extraction_tool: str = Field(description="Ferramenta de extração utilizada")
     file_type: str = Field(description="Tipo do arquivo detectado")
+    pipeline_mode: Optional[str] = Field(None, description="Modo do pipeline: 'fused' (tarefa única) ou 'chained' (uma tarefa por etapa)")
+    priority: Optional[int] = Field(None, description="Prioridade na fila (0 = mais urgente, 9 = menos)")
+    estimated_seconds: Optional[float] = Field(None, description="Custo estimado do processamento em segundos")
+    degraded: Optional[bool] = Field(None, description="Opções mais baratas aplicadas para cumprir o Deadline (resultado best-effort)")
+    coalesced_with: Optional[int] = Field(None, description="ID do envio idêntico em andamento cujo resultado este documento vai receber")
+
+class AskResponse(BaseModel):
+    """Resposta da criação de novas perguntas sobre documentos já extraídos"""
+    status: str = Field(description="Status da operação")
+    message: str = Field(description="Mensagem descritiva")
+    queries: List[dict] = Field(description="Perguntas criadas (query_id e document_id)")
 
 class DocumentResponse(BaseModel):
     """Resposta com resultado da análise do documento"""
@@ -102,6 +126,7 @@ class HealthCheck(BaseModel):
     """Status de saúde da aplicação"""
     status: str = Field(description="Status geral da aplicação")
     message: str = Field(description="Mensagem descritiva")
+    ollama: Optional[dict] = Field(None, description="Estado dos backends Ollama e seus circuit breakers")
 
 class ModelInfo(BaseModel):
     """Informações sobre um modelo"""
@@ -134,6 +159,7 @@ class ErrorResponse(BaseModel):
 @app.on_event("startup")
 async def startup_event():
     await init_database()
+    start_health_monitor()
     logger.info("Application started successfully")
 
 # Shutdown event
@@ -177,11 +203,19 @@ def get_extraction_tool_name(file_type: str) -> str:
 )
 async def upload_document(
     file: UploadFile = File(..., description="Arquivo para upload (JPG, PNG, PDF, DOCX, XLSX)"),
-    prompt: str = Header(..., alias="Prompt", description="Pergunta/prompt para análise do documento"),
-    format_response: str = Header(..., alias="Format-Response", description="Formato esperado da resposta (ex: JSON, texto)"),
+    prompt: Optional[str] = Header(None, alias="Prompt", description="Pergunta/prompt para análise do documento (obrigatório sem Questions)"),
+    format_response: Optional[str] = Header(None, alias="Format-Response", description="Formato esperado da resposta (ex: JSON, texto) (obrigatório sem Questions)"),
     model: str = Header(..., alias="Model", description="Modelo a usar (ex: gemma3:1b para Ollama, gemini-2.0-flash para Gemini)"),
     example: Optional[str] = Header(None, alias="Example", description="Exemplo opcional do formato de resposta esperado"),
     ai_provider: Optional[str] = Header("ollama", alias="AI-Provider", description="Provedor de AI: 'ollama' (padrão) ou 'gemini'"),
+    cache_bypass: Optional[str] = Header(None, alias="Cache-Bypass", description="'1' para ignorar o cache de respostas da LLM"),
+    hedge_policy: Optional[str] = Header(None, alias="Hedge-Policy", description="Duplicar a geração no Ollama se demorar: 'off', 'instance' (outro backend), 'gemini' ou 'auto'"),
+    questions: Optional[str] = Header(None, alias="Questions", description='Lista JSON de perguntas: [{"id": "cnpj", "prompt": "...", "format": "...", "example": "..."}]'),
+    questions_mode: Optional[str] = Header("packed", alias="Questions-Mode", description="'packed' (um único prompt) ou 'concurrent' (uma chamada por pergunta em paralelo)"),
+    pipeline_mode: Optional[str] = Header(None, alias="Pipeline-Mode", description="'auto' (padrão), 'fused' (todas as etapas em uma tarefa) ou 'chained' (uma tarefa por etapa)"),
+    priority: Optional[str] = Header(None, alias="Priority", description="'high', 'normal', 'low' ou 0-9 (0 = mais urgente); sem o header a prioridade vem do custo estimado"),
+    deadline: Optional[str] = Header(None, alias="Deadline", description="Prazo em segundos a partir do upload (ex: 30); opções mais baratas são usadas para cumpri-lo"),
+    extraction_mode: Optional[str] = Header(None, alias="Extraction-Mode", description="'full' (padrão) ou 'progressive' (PDF lido em lotes de páginas, para assim que os campos forem respondidos)"),
 
     key: str = Depends(validate_api_key)
 ):
@@ -195,6 +229,14 @@ async def upload_document(
     - Model: Model to use (e.g., gemma3:1b for Ollama, gemini-2.0-flash for Gemini)
     - Example: Optional example of expected response format
     - AI-Provider: "ollama" (default) or "gemini"
+    - Cache-Bypass: Optional "1" to skip the LLM response cache
+    - Hedge-Policy: Optional "off", "instance", "gemini" or "auto" - duplicate slow Ollama generations
+    - Questions: Optional JSON list of questions (replaces Prompt/Format-Response), each with id, prompt, format and example
+    - Questions-Mode: "packed" (default, one structured prompt) or "concurrent" (one call per question in parallel)
+    - Pipeline-Mode: Optional "auto" (default), "fused" (one task for all stages) or "chained" (one task per stage)
+    - Priority: Optional "high", "normal", "low" or 0-9 (0 = most urgent); default comes from the estimated cost
+    - Deadline: Optional seconds from upload; cheaper options are used to meet it (best-effort, flagged as degraded)
+    - Extraction-Mode: Optional "full" (default) or "progressive" (PDF pages in batches, stops once every field is answered)
     - GEMINI_API_KEY: Required in .env when AI-Provider is "gemini"
     
     📋 Supported file types with automatic detection:
@@ -228,6 +270,53 @@ async def upload_document(
                 detail="AI-Provider must be either 'ollama' or 'gemini'"
             )
         
+        # Validate multi-question request or single Prompt/Format-Response
+        parsed_questions = None
+        if questions:
+            if questions_mode not in QUESTIONS_MODES:
+                raise HTTPException(
+                    status_code=400,
+                    detail=f"Questions-Mode must be one of: {', '.join(QUESTIONS_MODES)}"
+                )
+            try:
+                parsed_questions = parse_questions(questions)
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=f"Invalid Questions header: {e}")
+            
+            logger.info(f"❓ VERBOSE: {len(parsed_questions)} questions ({questions_mode} mode)")
+            prompt = summarize_questions(parsed_questions)
+            _, format_response, packed_example = build_packed_request(parsed_questions)
+            example = example or packed_example
+        elif not prompt or not format_response:
+            raise HTTPException(
+                status_code=400,
+                detail="Prompt and Format-Response headers are required when Questions is not provided"
+            )
+        
+        if hedge_policy and hedge_policy.lower() not in HEDGE_POLICIES:
+            raise HTTPException(status_code=400, detail=f"Hedge-Policy must be one of: {', '.join(HEDGE_POLICIES)}")
+        
+        if pipeline_mode and pipeline_mode.lower() not in PIPELINE_MODES:
+            raise HTTPException(status_code=400, detail=f"Pipeline-Mode must be one of: {', '.join(PIPELINE_MODES)}")
+        
+        requested_priority = None
+        if priority:
+            try:
+                requested_priority = parse_priority(priority)
+            except ValueError:
+                raise HTTPException(status_code=400, detail="Priority must be 'high', 'normal', 'low' or an integer from 0 to 9")
+        
+        deadline_seconds = None
+        if deadline:
+            try:
+                deadline_seconds = parse_deadline(deadline)
+            except ValueError:
+                raise HTTPException(status_code=400, detail="Deadline must be a positive number of seconds")
+        
+        extraction_mode = (extraction_mode or EXTRACTION_MODE).lower()
+        if extraction_mode not in EXTRACTION_MODES:
+            raise HTTPException(status_code=400, detail=f"Extraction-Mode must be one of: {', '.join(EXTRACTION_MODES)}")
+        
         # Validate Gemini API key when using Gemini
         if ai_provider == "gemini" and not GEMINI_API_KEY:
             logger.error(f"❌ VERBOSE: Gemini API key required when using Gemini provider")
@@ -274,12 +363,35 @@ async def upload_document(
         extraction_tool = get_extraction_tool_name(file_type)
         logger.info(f"🛠️ VERBOSE: Will use extraction tool: {extraction_tool}")
         
+        # Shortest job first: custo estimado pelo número de páginas, tamanho, tipo e modelo
+        try:
+            num_pages = count_document_pages(file_path, file_type)
+        except Exception:
+            num_pages = 1
+        scheduling_info = plan_job(file_type, len(file_content), num_pages, model, ai_provider, requested_priority)
+        logger.info(f"⏳ VERBOSE: Estimated cost {scheduling_info['estimated_seconds']}s ({num_pages} page(s)) - priority {scheduling_info['priority']}")
+        
+        # Deadline: opções mais baratas (texto embutido, DPI menor, menos contexto, modelo menor, menos páginas)
+        deadline_plan = None
+        if deadline_seconds:
+            deadline_plan = plan_for_deadline(deadline_seconds, file_path, file_type, len(file_content), num_pages,
+                                              model, ai_provider, format_response, example)
+            if requested_priority is None:
+                scheduling_info["priority"] = min(scheduling_info["priority"], priority_for_cost(deadline_plan["estimated_seconds"]))
+        
+        # Single-flight: mesmo arquivo e pedido de um envio ainda em andamento
+        request_key = coalescing_key(file_content, prompt, format_response,
+                                     deadline_plan["options"].get("model", model) if deadline_plan else model, ai_provider,
+                                     example=example, questions=parsed_questions, questions_mode=questions_mode if parsed_questions else None,
+                                     degradation=deadline_plan["options"] if deadline_plan else None)
+        
         # Get database connection
         database = await get_async_db()
         
         # Create document record using SQLAlchemy ORM for consistency
         logger.info(f"🗄️ VERBOSE: Creating database record...")
         from sqlalchemy.orm import Session
+        leader_id = None
         db = SessionLocal()
         try:
             document = Document(
@@ -289,33 +401,58 @@ async def upload_document(
                 prompt=prompt,
                 format_response=format_response,
                 example=example,
-                model=model,
+                model=deadline_plan["options"].get("model", model) if deadline_plan else model,
                 ai_provider=ai_provider,
                 gemini_api_key=GEMINI_API_KEY if ai_provider == "gemini" else None,
+                cache_bypass=cache_bypass in ["1", "true", "True"],
+                hedge_policy=hedge_policy.lower() if hedge_policy else None,
+                questions=json.dumps(parsed_questions, ensure_ascii=False) if parsed_questions else None,
+                questions_mode=questions_mode if parsed_questions else None,
                 status=DocumentStatus.UPLOADED
             )
+            document.set_processing_info("scheduling", scheduling_info)
+            if deadline_plan:
+                document.set_processing_info("deadline", deadline_plan)
+            document.set_processing_info("extraction", {"mode": extraction_mode})
+            document.set_processing_info("coalescing", {"key": request_key})
             db.add(document)
             db.commit()
             db.refresh(document)
             document_id = document.id
             logger.info(f"✅ VERBOSE: Document record created with ID: {document_id}")
+            
+            # Cópia de um envio em andamento: não é processada, recebe o resultado do líder
+            leader_id = join_or_lead(request_key, document_id)
+            if leader_id:
+                document.set_processing_info("coalescing", {"key": request_key, "leader_id": leader_id})
+                db.commit()
         finally:
             db.close()
         
-        # Start processing chain
-        logger.info(f"🚀 VERBOSE: Starting Celery task for document {document_id}")
-        extract_text_task.delay(document_id)
+        if leader_id:
+            logger.info(f"🤝 VERBOSE: Document {document_id} will receive the result of in-flight document {leader_id}")
+            used_pipeline_mode = None
+        else:
+            # Start processing (tarefa única para documentos pequenos, cadeia de tarefas para os demais)
+            logger.info(f"🚀 VERBOSE: Starting Celery task for document {document_id}")
+            used_pipeline_mode = start_document_pipeline(document_id, file_path, file_type, pipeline_mode,
+                                                         priority=scheduling_info["priority"])
         
         logger.info(f"🎉 VERBOSE: Document uploaded successfully: {document_id}")
         
         return UploadResponse(
             status="success",
-            message="Document uploaded and processing started",
+            message=f"Document uploaded - identical request {leader_id} already in progress" if leader_id else "Document uploaded and processing started",
             document_id=document_id,
             filename=file.filename,
             ai_provider=ai_provider,
             extraction_tool=extraction_tool,
-            file_type=file_type.upper()
+            file_type=file_type.upper(),
+            pipeline_mode=used_pipeline_mode,
+            priority=scheduling_info["priority"],
+            estimated_seconds=deadline_plan["estimated_seconds"] if deadline_plan else scheduling_info["estimated_seconds"],
+            degraded=deadline_plan["degraded"] if deadline_plan else None,
+            coalesced_with=leader_id
         )
         
     except HTTPException:
@@ -324,6 +461,224 @@ async def upload_document(
         logger.error(f"Error uploading document: {e}")
         raise HTTPException(status_code=500, detail="Internal server error")
 
+@app.post(
+    "/documents/ask",
+    response_model=AskResponse,
+    tags=["📤 Upload de Documentos"],
+    summary="Nova pergunta sobre documentos já extraídos",
+    description="Cria uma nova consulta reutilizando o texto já extraído de um ou mais documentos (sem novo upload/OCR)",
+    responses={
+        200: {"description": "Consultas criadas com sucesso", "model": AskResponse},
+        400: {"description": "Erro de validação", "model": ErrorResponse},
+        401: {"description": "Chave API inválida", "model": ErrorResponse},
+        404: {"description": "Documento não encontrado", "model": ErrorResponse},
+    }
+)
+async def ask_document(
+    document_ids: str = Header(..., alias="Document-Ids", description="IDs dos documentos separados por vírgula (ex: 12 ou 12,13,14)"),
+    prompt: str = Header(..., alias="Prompt", description="Nova pergunta sobre o documento"),
+    format_response: str = Header(..., alias="Format-Response", description="Formato esperado da resposta (ex: JSON)"),
+    model: str = Header(..., alias="Model", description="Modelo a usar (ex: gemma3:1b para Ollama, gemini-2.0-flash para Gemini)"),
+    example: Optional[str] = Header(None, alias="Example", description="Exemplo opcional do formato de resposta esperado"),
+    ai_provider: Optional[str] = Header("ollama", alias="AI-Provider", description="Provedor de AI: 'ollama' (padrão) ou 'gemini'"),
+    cache_bypass: Optional[str] = Header(None, alias="Cache-Bypass", description="'1' para ignorar o cache de respostas da LLM"),
+    hedge_policy: Optional[str] = Header(None, alias="Hedge-Policy", description="Duplicar a geração no Ollama se demorar: 'off', 'instance' (outro backend), 'gemini' ou 'auto'"),
+    priority: Optional[str] = Header(None, alias="Priority", description="'high', 'normal', 'low' ou 0-9 (0 = mais urgente); sem o header a prioridade vem do custo estimado"),
+    key: str = Depends(validate_api_key)
+):
+    """
+    🔁 RE-ASK - New question about documents whose text was already extracted
+    
+    Headers required:
+    - Key: API authentication key
+    - Document-Ids: One or more document ids (comma separated)
+    - Prompt, Format-Response, Model: Same meaning as in /upload
+    - Example, AI-Provider, Cache-Bypass, Hedge-Policy, Priority: Optional, same meaning as in /upload
+    
+    Only the LLM and formatting stages run: the extracted text is reused from
+    the original document. Results are available at /query/{query_id}.
+    """
+    try:
+        logger.info(f"🔁 VERBOSE: Re-ask requested for documents: {document_ids}")
+        
+        if ai_provider not in ["ollama", "gemini"]:
+            raise HTTPException(status_code=400, detail="AI-Provider must be either 'ollama' or 'gemini'")
+        
+        if hedge_policy and hedge_policy.lower() not in HEDGE_POLICIES:
+            raise HTTPException(status_code=400, detail=f"Hedge-Policy must be one of: {', '.join(HEDGE_POLICIES)}")
+        
+        requested_priority = None
+        if priority:
+            try:
+                requested_priority = parse_priority(priority)
+            except ValueError:
+                raise HTTPException(status_code=400, detail="Priority must be 'high', 'normal', 'low' or an integer from 0 to 9")
+        
+        if ai_provider == "gemini" and not GEMINI_API_KEY:
+            raise HTTPException(
+                status_code=400,
+                detail="GEMINI_API_KEY not configured in environment when AI-Provider is 'gemini'"
+            )
+        
+        try:
+            ids = [int(value) for value in document_ids.split(",") if value.strip()]
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Document-Ids must be a comma separated list of integers")
+        
+        if not ids:
+            raise HTTPException(status_code=400, detail="No document id provided")
+        
+        db = SessionLocal()
+        try:
+            documents = {doc.id: doc for doc in db.query(Document).filter(Document.id.in_(ids)).all()}
+            
+            missing = [doc_id for doc_id in ids if doc_id not in documents]
+            if missing:
+                raise HTTPException(status_code=404, detail=f"Documents not found: {missing}")
+            
+            not_extracted = [doc_id for doc_id in ids if not (documents[doc_id].extracted_text or "").strip()]
+            if not_extracted:
+                raise HTTPException(
+                    status_code=400,
+                    detail=f"Text not extracted yet for documents: {not_extracted}"
+                )
+            
+            # Texto já extraído: o custo estimado é só o da LLM
+            scheduling_info = plan_job("", 0, 0, model, ai_provider, requested_priority)
+            queries = []
+            for doc_id in ids:
+                query = DocumentQuery(
+                    document_id=doc_id,
+                    prompt=prompt,
+                    format_response=format_response,
+                    example=example,
+                    model=model,
+                    ai_provider=ai_provider,
+                    gemini_api_key=GEMINI_API_KEY if ai_provider == "gemini" else None,
+                    cache_bypass=cache_bypass in ["1", "true", "True"],
+                    hedge_policy=hedge_policy.lower() if hedge_policy else None,
+                    status=DocumentStatus.TEXT_EXTRACTED
+                )
+                query.set_processing_info("scheduling", scheduling_info)
+                db.add(query)
+                queries.append(query)
+            db.commit()
+            
+            created = [{"query_id": query.id, "document_id": query.document_id} for query in queries]
+        finally:
+            db.close()
+        
+        # Apenas as etapas de LLM e formatação - o texto já foi extraído
+        for item in created:
+            logger.info(f"🚀 VERBOSE: Starting prompt task for document {item['document_id']} (query {item['query_id']})")
+            enqueue_prompt_task(item["document_id"], model, ai_provider, query_id=item["query_id"],
+                                priority=scheduling_info["priority"])
+        
+        return AskResponse(
+            status="success",
+            message=f"{len(created)} queries created and processing started",
+            queries=created
+        )
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error creating queries: {e}")
+        raise HTTPException(status_code=500, detail="Internal server error")
+
+@app.get(
+    "/query/{query_id}",
+    response_model=DocumentDebugResponse,
+    tags=["📄 Resultados"],
+    summary="Obter resultado de uma nova pergunta",
+    description="Retorna o resultado de uma consulta criada via /documents/ask. Use header 'debug=1' para informações detalhadas de debug",
+    responses={
+        200: {"description": "Resultado obtido com sucesso", "model": DocumentDebugResponse},
+        404: {"description": "Consulta não encontrada", "model": ErrorResponse},
+        401: {"description": "Chave API inválida", "model": ErrorResponse},
+        500: {"description": "Erro interno do servidor", "model": ErrorResponse},
+    }
+)
+async def get_query_response(
+    query_id: int = Path(..., description="ID da consulta"),
+    debug: Optional[str] = Header(None, alias="debug", description="Modo debug: '1' para informações detalhadas, '0' ou ausente para resposta normal"),
+    key: str = Depends(validate_api_key)
+):
+    """
+    Get the response for a query created with /documents/ask
+    """
+    try:
+        database = await get_async_db()
+        
+        query = """
+        SELECT q.id, q.document_id, q.status, q.created_at, q.completed_at, q.formatted_response, q.llm_response,
+               q.error_message, q.model, q.ai_provider, q.prompt, q.format_response, q.example,
+               q.full_prompt_sent, q.processing_info, d.filename
+        FROM document_queries q
+        JOIN documents d ON d.id = q.document_id
+        WHERE q.id = :query_id
+        """
+        
+        row = await database.fetch_one(query, {"query_id": query_id})
+        
+        if not row:
+            raise HTTPException(status_code=404, detail="Query not found")
+        
+        response_data = {
+            "query_id": row["id"],
+            "document_id": row["document_id"],
+            "filename": row["filename"],
+            "status": row["status"],
+            "created_at": row["created_at"],
+            "completed_at": row["completed_at"]
+        }
+        
+        query_status = row["status"]
+        if query_status in [DocumentStatus.COMPLETED.value, "COMPLETED", DocumentStatus.COMPLETED]:
+            response_data["response"] = row["formatted_response"]
+            response_data["llm_response"] = row["llm_response"]
+        elif query_status in [DocumentStatus.ERROR.value, "ERROR", DocumentStatus.ERROR]:
+            response_data["error_message"] = row["error_message"]
+        elif query_status in [DocumentStatus.RETRYING.value, "RETRYING", DocumentStatus.RETRYING]:
+            response_data["message"] = "Query is being retried after a recoverable error"
+            response_data["last_error"] = row["error_message"]
+        else:
+            response_data["message"] = "Query is still being processed"
+        
+        debug_info = None
+        if debug == "1":
+            processing_info = load_processing_info(row["processing_info"])
+            debug_info = {
+                "prompt_sent_to_llm": {
+                    "ai_provider": row["ai_provider"],
+                    "model": row["model"],
+                    "original_prompt": row["prompt"],
+                    "format_requested": row["format_response"],
+                    "example_provided": row["example"],
+                    "full_prompt_sent": row["full_prompt_sent"] or "Prompt ainda não enviado",
+                    "prompt_length": len(row["full_prompt_sent"]) if row["full_prompt_sent"] else 0,
+                    "context_selection": processing_info.get("context_selection"),
+                    "rule_extraction": processing_info.get("rule_extraction"),
+                    "llm_call": processing_info.get("llm_call")
+                },
+                "raw_llm_response": {
+                    "raw_response": row["llm_response"] or "Resposta ainda não recebida",
+                    "final_formatted_response": row["formatted_response"] or "Resposta ainda não formatada"
+                }
+            }
+        
+        return DocumentDebugResponse(
+            status="success",
+            data=response_data,
+            debug_info=debug_info
+        )
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"Error getting query response: {e}")
+        raise HTTPException(status_code=500, detail="Internal server error")
+
 @app.get(
     "/queue",
     response_model=QueueStatus,
@@ -410,7 +765,7 @@ async def get_document_response(
         query = """
         SELECT id, filename, status, created_at, completed_at, formatted_response, llm_response, error_message,
                model, ai_provider, gemini_api_key, file_type, file_path, prompt, format_response, example,
-               extracted_text, full_prompt_sent
+               extracted_text, full_prompt_sent, processing_info
         FROM documents 
         WHERE id = :document_id
         """
@@ -428,6 +783,16 @@ async def get_document_response(
             "completed_at": document["completed_at"]
         }
         
+        # Deadline: resultado best-effort quando opções mais baratas foram usadas
+        deadline_plan = load_processing_info(document["processing_info"]).get("deadline")
+        if deadline_plan:
+            response_data["degraded"] = deadline_plan["degraded"]
+        
+        # Envio idêntico coalescido: resultado copiado do documento líder
+        leader_id = load_processing_info(document["processing_info"]).get("coalescing", {}).get("leader_id")
+        if leader_id:
+            response_data["coalesced_with"] = leader_id
+        
         # Handle both enum and string status formats
         doc_status = document["status"]
         if doc_status in [DocumentStatus.COMPLETED.value, "COMPLETED", DocumentStatus.COMPLETED]:
@@ -447,12 +812,16 @@ async def get_document_response(
                 response_data["llm_response"] = document["llm_response"]
         elif doc_status in [DocumentStatus.ERROR.value, "ERROR", DocumentStatus.ERROR]:
             response_data["error_message"] = document["error_message"]
+        elif doc_status in [DocumentStatus.RETRYING.value, "RETRYING", DocumentStatus.RETRYING]:
+            response_data["message"] = "Document is being retried after a recoverable error"
+            response_data["last_error"] = document["error_message"]
         else:
             response_data["message"] = "Document is still being processed"
         
         # Adicionar informações de debug se solicitado
         debug_info = None
         if debug == "1":
+            processing_info = load_processing_info(document["processing_info"])
             debug_info = {
                 "1_extracted_content": {
                     "description": "Texto extraído do documento pelo OCR/Parser",
@@ -463,7 +832,12 @@ async def get_document_response(
                         "filename": document["filename"],
                         "file_type": document["file_type"],
                         "file_path": document["file_path"]
-                    }
+                    },
+                    "pipeline": processing_info.get("pipeline"),
+                    "scheduling": processing_info.get("scheduling"),
+                    "deadline": processing_info.get("deadline"),
+                    "progressive": processing_info.get("progressive"),
+                    "coalescing": processing_info.get("coalescing")
                 },
                 "2_prompt_sent_to_llm": {
                     "description": "Prompt completo enviado para a LLM (incluindo contexto, instruções e formatação)",
@@ -473,7 +847,10 @@ async def get_document_response(
                     "format_requested": document["format_response"],
                     "example_provided": document["example"],
                     "full_prompt_sent": document["full_prompt_sent"] or "Prompt ainda não enviado",
-                    "prompt_length": len(document["full_prompt_sent"]) if document["full_prompt_sent"] else 0
+                    "prompt_length": len(document["full_prompt_sent"]) if document["full_prompt_sent"] else 0,
+                    "context_selection": processing_info.get("context_selection"),
+                    "rule_extraction": processing_info.get("rule_extraction"),
+                    "llm_call": processing_info.get("llm_call")
                 },
                 "3_raw_llm_response": {
                     "description": "Resposta raw/bruta da LLM antes da formatação",
@@ -507,9 +884,71 @@ async def get_document_response(
 )
 async def health_check():
     """Health check endpoint"""
+    ollama = get_pool().snapshot()
     return {
-        "status": "healthy",
-        "message": "Document OCR LLM API is running"
+        "status": "healthy" if ollama["state"] == "closed" else "degraded",
+        "message": "Document OCR LLM API is running",
+        "ollama": ollama
+    }
+
+@app.get(
+    "/metrics",
+    tags=["📊 Monitoramento"],
+    summary="Métricas de processamento",
+    description="Retorna contadores de processamento e a taxa de acerto do cache de respostas da LLM",
+    responses={
+        200: {"description": "Métricas obtidas com sucesso"},
+        401: {"description": "Chave API inválida", "model": ErrorResponse},
+    }
+)
+async def get_metrics(
+    key: str = Depends(validate_api_key)
+):
+    """
+    Get processing counters and LLM response cache hit-rate
+    """
+    counters = metrics.get_counters()
+    
+    # prompt_eval_duration médio: perguntas completas vs. perguntas que reutilizaram o prefixo do documento
+    avg_full = metrics.rate(counters, "ollama.prompt_eval.full.seconds", "ollama.prompt_eval.full.count")
+    avg_followup = metrics.rate(counters, "ollama.prompt_eval.followup.seconds", "ollama.prompt_eval.followup.count")
+    
+    return {
+        "status": "success",
+        "counters": counters,
+        "llm_cache": get_cache_stats(),
+        "prompt_eval": {
+            "avg_full_prompt_eval_s": avg_full,
+            "avg_followup_prompt_eval_s": avg_followup,
+            "followup_reduction": round(1 - avg_followup / avg_full, 4) if avg_full and avg_followup else None
+        },
+        # Taxa de falha de parse: heurística (texto livre) vs. structured outputs (JSON Schema)
+        "response_parsing": {
+            mode: {
+                "responses": counters.get(f"formatter.{mode}.responses", 0),
+                "parse_failure_rate": metrics.rate(counters, f"formatter.{mode}.parse_failures", f"formatter.{mode}.responses"),
+                "unrecovered_rate": metrics.rate(counters, f"formatter.{mode}.unrecovered", f"formatter.{mode}.responses"),
+            }
+            for mode in ["heuristic", "structured"]
+        },
+        # Regras determinísticas que dispensaram a chamada à LLM
+        "rule_engine": {
+            "evaluations": counters.get("rules.evaluations", 0),
+            "llm_calls_avoided": counters.get("rules.llm_calls_avoided", 0),
+            "avoided_rate": metrics.rate(counters, "rules.llm_calls_avoided", "rules.evaluations"),
+        },
+        # Limite adaptativo por provedor+modelo: tempo na fila de admissão vs. tempo da chamada
+        "admission": get_admission_stats(),
+        # Requisições duplicadas no Ollama: taxa, quem venceu e custo extra
+        "hedging": get_hedge_stats(),
+        # Falhas das tarefas por classe de erro (transient, overload, permanent, unknown)
+        "errors": metrics.get_counters("errors."),
+        # Escalonamento por custo: jobs na fila, promoções por envelhecimento e espera média
+        "scheduler": get_scheduler_stats(),
+        # Envios idênticos em andamento atendidos por um único processamento
+        "coalescing": get_coalescing_stats(),
+        # Documentos travados (worker morto no meio da etapa) recuperados pelo reaper
+        "reaper": metrics.get_counters("reaper.")
     }
 
 @app.post(
@@ -736,6 +1175,37 @@ async def list_models(
         logger.error(f"Error listing models: {e}")
         raise HTTPException(status_code=500, detail=f"Error listing models: {str(e)}")
 
+@app.get(
+    "/models/loaded",
+    tags=["🤖 Gestão de Modelos"],
+    summary="Modelos Ollama carregados em memória",
+    description="Retorna os modelos carregados no Ollama (/api/ps), uso de memória, keep_alive e trabalho na fila por modelo",
+    responses={
+        200: {"description": "Modelos carregados obtidos com sucesso"},
+        401: {"description": "Chave API inválida", "model": ErrorResponse},
+        503: {"description": "Ollama indisponível", "model": ErrorResponse},
+    }
+)
+async def list_loaded_models_endpoint(
+    key: str = Depends(validate_api_key)
+):
+    """
+    List the models resident in Ollama memory and the queued work per model
+    """
+    try:
+        models = await list_loaded_models()
+    except Exception as e:
+        logger.error(f"Error reading loaded models: {e}")
+        raise HTTPException(status_code=503, detail=f"Could not read loaded models from Ollama: {str(e)}")
+    
+    return {
+        "status": "success",
+        "provider": "ollama",
+        "models": models,
+        "preload_models": OLLAMA_PRELOAD_MODELS,
+        "pending_by_model": get_pending_by_model()
+    }
+
 @app.post(
     "/config/compute",
     response_model=ComputeConfigResponse,
@@ -913,10 +1383,14 @@ async def root():
             "POST /upload": "🚀 SMART UPLOAD - Auto-detects file type and processes",
             "GET /queue": "Get processing queue status",
             "GET /response/{id}": "Get document response",
+            "POST /documents/ask": "🔁 New question about already extracted documents",
+            "GET /query/{id}": "Get response of a re-ask query",
             "POST /models/download": "Download new Ollama model",
             "GET /models/list": "List available models",
+            "GET /models/loaded": "Models loaded in Ollama memory (/api/ps)",
             "POST /config/compute": "🆕 Set compute mode (CPU/GPU)",
             "GET /config/compute": "🆕 Get current compute mode",
+            "GET /metrics": "Processing counters and LLM cache hit-rate",
             "GET /health": "Health check"
         },
         "file_types_supported": {
@@ -931,6 +1405,7 @@ async def root():
             "Format-Response": "Expected response format",
             "Model": "Ollama model name",
             "Example": "Optional response example",
+            "Questions": "Optional JSON list of questions answered in a single pass",
             "Model-Name": "Model name for download (download endpoint only)",
             "Compute-Mode": "cpu or gpu (compute config endpoint only)"
         }
@@ -0,0 +1,42 @@
+"""
+Contadores de métricas compartilhados entre API e workers.
+
+Os contadores ficam em um hash no Redis para que todos os processos (FastAPI e
+Celery) somem nos mesmos valores. Se o Redis estiver indisponível, os valores
+são mantidos apenas em memória no processo atual.
+"""
+from collections import Counter
+from loguru import logger
+from redis_client import get_redis
+
+METRICS_KEY = "metrics:counters"
+
+_local_counters = Counter()
+
+def incr(name: str, amount: float = 1):
+    """Increment a counter"""
+    try:
+        get_redis().hincrbyfloat(METRICS_KEY, name, amount)
+    except Exception as e:
+        logger.debug(f"⚠️ VERBOSE: Redis unavailable for metrics, counting locally: {e}")
+        _local_counters[name] += amount
+
+def get_counters(prefix: str = "") -> dict:
+    """Return all counters (optionally filtered by prefix)"""
+    counters = Counter(_local_counters)
+    try:
+        for name, value in get_redis().hgetall(METRICS_KEY).items():
+            counters[name] += float(value)
+    except Exception as e:
+        logger.debug(f"⚠️ VERBOSE: Redis unavailable for metrics, returning local counters: {e}")
+
+    return {
+        name: int(value) if float(value).is_integer() else round(value, 4)
+        for name, value in sorted(counters.items())
+        if name.startswith(prefix)
+    }
+
+def rate(counters: dict, numerator: str, denominator: str) -> float:
+    """Compute a ratio between two counters (0.0 when the denominator is zero)"""
+    total = counters.get(denominator, 0)
+    return round(counters.get(numerator, 0) / total, 4) if total else 0.0
@@ -0,0 +1,141 @@
+"""
+Residência de modelos no Ollama (warm pool).
+
+- Pré-carrega os modelos configurados quando o worker inicia, evitando o
+  load_duration na primeira requisição após ociosidade
+- keep_alive por modelo (OLLAMA_MODEL_KEEP_ALIVE)
+- Lista modelos carregados e uso de memória via /api/ps
+- Agrupa o trabalho por modelo: documentos de um modelo que não está carregado
+  aguardam (por tempo limitado) enquanto houver trabalho pendente para o modelo
+  já carregado, reduzindo trocas de modelo
+"""
+import os
+import time
+import httpx
+from loguru import logger
+from dotenv import load_dotenv
+from redis_client import get_redis
+from ollama_pool import get_pool
+import metrics
+
+load_dotenv()
+
+# Configuration
+OLLAMA_PRELOAD_MODELS = [m.strip() for m in os.getenv("OLLAMA_PRELOAD_MODELS", os.getenv("DEFAULT_MODEL", "")).split(",") if m.strip()]
+# keep_alive por modelo, ex: "gemma3:1b=-1,gemma3:4b=10m" (-1 = manter sempre carregado)
+OLLAMA_MODEL_KEEP_ALIVE = os.getenv("OLLAMA_MODEL_KEEP_ALIVE", "")
+MODEL_GROUPING_ENABLED = os.getenv("MODEL_GROUPING_ENABLED", "true").lower() == "true"
+MODEL_SWAP_DEFER_SECONDS = int(os.getenv("MODEL_SWAP_DEFER_SECONDS", "5"))
+MODEL_SWAP_MAX_DEFERRALS = int(os.getenv("MODEL_SWAP_MAX_DEFERRALS", "6"))
+# Trabalho pendente mais antigo que isso é descartado (tarefa perdida em OOM kill, mensagem descartada)
+MODEL_PENDING_TTL_SECONDS = int(os.getenv("MODEL_PENDING_TTL_SECONDS", "1800"))
+
+# Sorted set por modelo: work_id com o momento do enfileiramento como score
+PENDING_KEY_PREFIX = "ollama:queued:"
+
+def parse_keep_alive_map(raw: str) -> dict:
+    """Parse OLLAMA_MODEL_KEEP_ALIVE ("model=duration,...")"""
+    keep_alive = {}
+    for item in raw.split(","):
+        if "=" in item:
+            model, duration = item.rsplit("=", 1)
+            duration = duration.strip()
+            # Números puros (ex: -1, 3600) são segundos para o Ollama
+            keep_alive[model.strip()] = int(duration) if duration.lstrip("-").isdigit() else duration
+    return keep_alive
+
+MODEL_KEEP_ALIVE = parse_keep_alive_map(OLLAMA_MODEL_KEEP_ALIVE)
+
+def get_keep_alive(model: str, default=None):
+    """keep_alive configured for a model (falls back to default)"""
+    return MODEL_KEEP_ALIVE.get(model, MODEL_KEEP_ALIVE.get(model.split(":")[0], default))
+
+def preload_models(models: list = None, default_keep_alive=None):
+    """Load models into the memory of every Ollama backend (an empty generate request only loads the model)"""
+    for model in models if models is not None else OLLAMA_PRELOAD_MODELS:
+        request_body = {"model": model}
+        keep_alive = get_keep_alive(model, default_keep_alive)
+        if keep_alive is not None:
+            request_body["keep_alive"] = keep_alive
+        for backend in get_pool().backends:
+            try:
+                start = time.time()
+                response = httpx.post(f"{backend.url}/api/generate", json=request_body, timeout=300)
+                response.raise_for_status()
+                logger.info(f"🔥 VERBOSE: Preloaded model '{model}' on {backend.url} in {time.time() - start:.2f}s (keep_alive={keep_alive})")
+                metrics.incr("ollama.preload.success")
+            except Exception as e:
+                logger.warning(f"⚠️ VERBOSE: Could not preload model '{model}' on {backend.url}: {e}")
+                metrics.incr("ollama.preload.errors")
+
+async def list_loaded_models() -> list:
+    """Models currently loaded on each Ollama backend with their memory use (/api/ps)"""
+    loaded = []
+    async with httpx.AsyncClient(timeout=10) as client:
+        for backend in get_pool().backends:
+            response = await client.get(f"{backend.url}/api/ps")
+            response.raise_for_status()
+            loaded += [
+                {
+                    "name": model.get("name"),
+                    "backend": backend.url,
+                    "size": model.get("size"),
+                    "size_vram": model.get("size_vram"),
+                    "expires_at": model.get("expires_at"),
+                    "keep_alive_configured": get_keep_alive(model.get("name", "")),
+                }
+                for model in response.json().get("models", [])
+            ]
+    return loaded
+
+def mark_pending(model: str, work_id: str):
+    """Register queued LLM work for a model (re-enqueueing refreshes its timestamp)"""
+    try:
+        client = get_redis()
+        client.zadd(PENDING_KEY_PREFIX + model, {work_id: time.time()})
+        client.expire(PENDING_KEY_PREFIX + model, MODEL_PENDING_TTL_SECONDS)
+    except Exception as e:
+        logger.debug(f"⚠️ VERBOSE: Could not register pending work: {e}")
+
+def mark_started(model: str, work_id: str):
+    """Remove work from the pending set when a worker picks it up"""
+    try:
+        get_redis().zrem(PENDING_KEY_PREFIX + model, work_id)
+    except Exception as e:
+        logger.debug(f"⚠️ VERBOSE: Could not clear pending work: {e}")
+
+def get_pending_by_model() -> dict:
+    """Number of queued LLM tasks per model, dropping entries older than MODEL_PENDING_TTL_SECONDS"""
+    try:
+        client = get_redis()
+        cutoff = time.time() - MODEL_PENDING_TTL_SECONDS
+        pending = {}
+        for key in client.scan_iter(PENDING_KEY_PREFIX + "*"):
+            client.zremrangebyscore(key, 0, cutoff)
+            pending[key[len(PENDING_KEY_PREFIX):]] = client.zcard(key)
+        return pending
+    except Exception:
+        return {}
+
+def should_defer_for_model(model: str, deferrals: int) -> bool:
+    """True when loading this model would evict, on every backend, a loaded model that still has queued work"""
+    if not MODEL_GROUPING_ENABLED or deferrals >= MODEL_SWAP_MAX_DEFERRALS:
+        return False
+
+    pending = get_pending_by_model()
+    busy_models = set()
+    for backend in get_pool().available_backends():
+        loaded = backend.loaded_models()
+        if model in loaded:
+            return False
+        busy_on_backend = [name for name in loaded if pending.get(name, 0) > 0]
+        if not busy_on_backend:
+            # Backend livre (ou sem trabalho na fila para os modelos carregados): pode carregar o modelo
+            return False
+        busy_models.update(busy_on_backend)
+
+    if busy_models:
+        logger.info(f"⏳ VERBOSE: Model '{model}' not loaded and {sorted(busy_models)} still have queued work - deferring ({deferrals + 1}/{MODEL_SWAP_MAX_DEFERRALS})")
+        metrics.incr("ollama.model_swap.deferred")
+        return True
+    return False
@@ -1,18 +1,39 @@
-from sqlalchemy import Column, Integer, String, Text, DateTime, Enum
+from sqlalchemy import Column, Integer, String, Text, DateTime, Enum, Boolean, ForeignKey
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.sql import func
 import enum
+import json
 
 Base = declarative_base()
 
+def load_processing_info(raw: str) -> dict:
+    """Parse the processing_info JSON column (returns {} when empty or invalid)"""
+    try:
+        return json.loads(raw) if raw else {}
+    except (json.JSONDecodeError, TypeError):
+        return {}
+
 class DocumentStatus(enum.Enum):
     UPLOADED = "uploaded"
     TEXT_EXTRACTED = "text_extracted"
     PROMPT_PROCESSED = "prompt_processed"
+    RETRYING = "retrying"  # Falha recuperável: nova tentativa agendada (error_message mostra o último erro)
     COMPLETED = "completed"
     ERROR = "error"
 
-class Document(Base):
+class ProcessingInfoMixin:
+    """Helpers for the processing_info JSON column"""
+    
+    def get_processing_info(self) -> dict:
+        return load_processing_info(self.processing_info)
+    
+    def set_processing_info(self, key: str, value):
+        """Store a stage entry in the processing_info JSON column"""
+        info = self.get_processing_info()
+        info[key] = value
+        self.processing_info = json.dumps(info, ensure_ascii=False, default=str)
+
+class Document(ProcessingInfoMixin, Base):
     __tablename__ = "documents"
     
     id = Column(Integer, primary_key=True, index=True)
@@ -26,10 +47,14 @@ class Document(Base):
     format_response = Column(Text, nullable=False)
     example = Column(Text, nullable=True)
     model = Column(String(100), nullable=False)
+    questions = Column(Text, nullable=True)  # JSON com várias perguntas (header Questions)
+    questions_mode = Column(String(20), nullable=True)  # "packed" ou "concurrent"
     
     # API Configuration - supports both Ollama and Gemini
     ai_provider = Column(String(20), nullable=True, default="ollama")  # "ollama" or "gemini"
     gemini_api_key = Column(Text, nullable=True)  # Only needed when ai_provider is "gemini"
+    cache_bypass = Column(Boolean, nullable=True, default=False)  # Ignora o cache de respostas da LLM
+    hedge_policy = Column(String(20), nullable=True)  # Requisição duplicada se a LLM demorar (header Hedge-Policy)
     
     # Processing results
     extracted_text = Column(Text, nullable=True)
@@ -37,6 +62,8 @@ class Document(Base):
     llm_response = Column(Text, nullable=True)
     formatted_response = Column(Text, nullable=True)
     error_message = Column(Text, nullable=True)
+    processing_info = Column(Text, nullable=True)  # JSON com decisões/métricas de cada etapa (debug)
+    extractor_version = Column(String(50), nullable=True)  # Versão da extração que gerou extracted_text
     
     # Timestamps
     created_at = Column(DateTime(timezone=True), server_default=func.now())
@@ -60,4 +87,63 @@ class Document(Base):
             "created_at": self.created_at.isoformat() if self.created_at else None,
             "updated_at": self.updated_at.isoformat() if self.updated_at else None,
             "completed_at": self.completed_at.isoformat() if self.completed_at else None
-        } 
\ No newline at end of file
+        }
+
+class DocumentPage(Base):
+    """Texto OCR de uma página de PDF, gravado assim que a página termina (checkpoint da extração)"""
+    __tablename__ = "document_pages"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    document_id = Column(Integer, ForeignKey("documents.id"), nullable=False, index=True)
+    page_number = Column(Integer, nullable=False)  # 0-based
+    extractor_version = Column(String(50), nullable=False)
+    text = Column(Text, nullable=False)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+
+class DocumentQuery(ProcessingInfoMixin, Base):
+    """Nova pergunta sobre um documento já extraído (reutiliza documents.extracted_text)"""
+    __tablename__ = "document_queries"
+    
+    id = Column(Integer, primary_key=True, index=True)
+    document_id = Column(Integer, ForeignKey("documents.id"), nullable=False, index=True)
+    status = Column(Enum(DocumentStatus), default=DocumentStatus.TEXT_EXTRACTED)
+    
+    # Request data
+    prompt = Column(Text, nullable=False)
+    format_response = Column(Text, nullable=False)
+    example = Column(Text, nullable=True)
+    model = Column(String(100), nullable=False)
+    ai_provider = Column(String(20), nullable=True, default="ollama")  # "ollama" or "gemini"
+    gemini_api_key = Column(Text, nullable=True)
+    cache_bypass = Column(Boolean, nullable=True, default=False)
+    hedge_policy = Column(String(20), nullable=True)
+    
+    # Processing results
+    full_prompt_sent = Column(Text, nullable=True)
+    llm_response = Column(Text, nullable=True)
+    formatted_response = Column(Text, nullable=True)
+    error_message = Column(Text, nullable=True)
+    processing_info = Column(Text, nullable=True)
+    
+    # Timestamps
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    updated_at = Column(DateTime(timezone=True), onupdate=func.now())
+    completed_at = Column(DateTime(timezone=True), nullable=True)
+    
+    def to_dict(self):
+        return {
+            "query_id": self.id,
+            "document_id": self.document_id,
+            "status": self.status.value if self.status else None,
+            "prompt": self.prompt,
+            "format_response": self.format_response,
+            "example": self.example,
+            "model": self.model,
+            "ai_provider": self.ai_provider,
+            "llm_response": self.llm_response,
+            "formatted_response": self.formatted_response,
+            "error_message": self.error_message,
+            "created_at": self.created_at.isoformat() if self.created_at else None,
+            "updated_at": self.updated_at.isoformat() if self.updated_at else None,
+            "completed_at": self.completed_at.isoformat() if self.completed_at else None
+        }
@@ -0,0 +1,172 @@
+"""
+Monitor de saúde do Ollama com circuit breaker.
+
+Substitui o probe de /api/tags feito antes de cada geração. Uma thread em
+segundo plano verifica cada backend do pool periodicamente (um único probe por
+intervalo entre todos os processos, via lock no Redis) e o estado do circuito
+de cada backend fica no Redis, compartilhado entre API e workers:
+
+- closed: requisições normais
+- open: após falhas consecutivas, as tarefas falham rápido (ou são desviadas)
+- half_open: após OLLAMA_BREAKER_RESET_SECONDS uma tentativa é liberada; se
+  funcionar o circuito fecha, se falhar volta a abrir
+"""
+import os
+import time
+import threading
+import httpx
+from loguru import logger
+from dotenv import load_dotenv
+from redis_client import get_redis
+import metrics
+
+load_dotenv()
+
+# Configuration
+OLLAMA_HEALTH_INTERVAL_SECONDS = int(os.getenv("OLLAMA_HEALTH_INTERVAL_SECONDS", "10"))
+OLLAMA_BREAKER_FAILURE_THRESHOLD = int(os.getenv("OLLAMA_BREAKER_FAILURE_THRESHOLD", "3"))
+OLLAMA_BREAKER_RESET_SECONDS = int(os.getenv("OLLAMA_BREAKER_RESET_SECONDS", "30"))
+# Provedor usado enquanto o circuito estiver aberto ("" = falhar rápido, "gemini" = desviar)
+OLLAMA_FALLBACK_PROVIDER = os.getenv("OLLAMA_FALLBACK_PROVIDER", "").lower()
+OLLAMA_FALLBACK_MODEL = os.getenv("OLLAMA_FALLBACK_MODEL", "gemini-2.0-flash")
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+class OllamaUnavailableError(Exception):
+    """Raised when the circuit is open and the request must not reach Ollama"""
+
+    def __init__(self, message: str, retry_after: float = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class CircuitBreaker:
+    """Circuit breaker whose state is shared through Redis (local fallback when Redis is down)"""
+
+    def __init__(self, name: str, failure_threshold: int = OLLAMA_BREAKER_FAILURE_THRESHOLD,
+                 reset_seconds: int = OLLAMA_BREAKER_RESET_SECONDS):
+        self.name = name
+        self.key = f"breaker:{name}"
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self._local = {"state": CLOSED, "failures": 0, "opened_at": 0.0}
+
+    def _load(self) -> dict:
+        try:
+            data = get_redis().hgetall(self.key)
+            if data:
+                return {
+                    "state": data.get("state", CLOSED),
+                    "failures": int(data.get("failures", 0)),
+                    "opened_at": float(data.get("opened_at", 0)),
+                    "last_error": data.get("last_error"),
+                    "last_check": float(data["last_check"]) if data.get("last_check") else None,
+                }
+        except Exception as e:
+            logger.debug(f"⚠️ VERBOSE: Redis unavailable for circuit breaker, using local state: {e}")
+        return dict(self._local)
+
+    def _save(self, **fields):
+        self._local.update(fields)
+        try:
+            get_redis().hset(self.key, mapping={k: "" if v is None else v for k, v in fields.items()})
+        except Exception as e:
+            logger.debug(f"⚠️ VERBOSE: Could not store circuit breaker state: {e}")
+
+    @property
+    def state(self) -> str:
+        data = self._load()
+        if data["state"] == OPEN and time.time() - data["opened_at"] >= self.reset_seconds:
+            return HALF_OPEN
+        return data["state"]
+
+    def seconds_until_half_open(self) -> float:
+        data = self._load()
+        if data["state"] != OPEN:
+            return 0.0
+        return max(0.0, self.reset_seconds - (time.time() - data["opened_at"]))
+
+    def allow_request(self) -> bool:
+        """False while the circuit is open; half_open lets a single trial request through"""
+        state = self.state
+        if state == CLOSED:
+            return True
+        if state == OPEN:
+            return False
+        self._save(state=HALF_OPEN)
+        try:
+            return bool(get_redis().set(f"{self.key}:trial", "1", nx=True, ex=self.reset_seconds))
+        except Exception:
+            return True
+
+    def record_success(self):
+        if self._load()["state"] != CLOSED:
+            logger.info(f"✅ VERBOSE: Circuit '{self.name}' closed - Ollama recovered")
+            metrics.incr(f"breaker.{self.name}.closed")
+        self._save(state=CLOSED, failures=0, last_error=None, last_check=time.time())
+
+    def record_failure(self, error: str):
+        data = self._load()
+        state = self.state
+        failures = data["failures"] + 1
+        if state == OPEN:
+            # Já aberto: mantém o instante de abertura para que o half-open ocorra no tempo previsto
+            self._save(failures=failures, last_error=error, last_check=time.time())
+        elif state == HALF_OPEN or failures >= self.failure_threshold:
+            logger.error(f"❌ VERBOSE: Circuit '{self.name}' OPEN after {failures} failures: {error}")
+            metrics.incr(f"breaker.{self.name}.opened")
+            self._save(state=OPEN, failures=failures, opened_at=time.time(), last_error=error, last_check=time.time())
+        else:
+            self._save(failures=failures, last_error=error, last_check=time.time())
+
+    def snapshot(self) -> dict:
+        data = self._load()
+        return {
+            "name": self.name,
+            "state": self.state,
+            "consecutive_failures": data["failures"],
+            "last_error": data.get("last_error") or None,
+            "last_check": data.get("last_check"),
+            "retry_in_seconds": round(self.seconds_until_half_open(), 1),
+        }
+
+def probe_backend(base_url: str, breaker: CircuitBreaker) -> bool:
+    """Check one Ollama backend and update its breaker"""
+    try:
+        response = httpx.get(f"{base_url}/api/tags", timeout=5)
+        response.raise_for_status()
+        breaker.record_success()
+        return True
+    except Exception as e:
+        breaker.record_failure(f"health probe: {e}")
+        return False
+
+def _monitor_loop():
+    from ollama_pool import get_pool
+    while True:
+        for backend in get_pool().backends:
+            try:
+                # Um único probe por backend e intervalo entre todos os processos (API e workers)
+                acquired = get_redis().set(f"breaker:probe_lock:{backend.url}", "1", nx=True, ex=OLLAMA_HEALTH_INTERVAL_SECONDS)
+            except Exception:
+                acquired = True
+            if acquired:
+                probe_backend(backend.url, backend.breaker)
+        time.sleep(OLLAMA_HEALTH_INTERVAL_SECONDS)
+
+_monitor_thread = None
+
+def start_health_monitor():
+    """Start the background health monitor thread (once per process)"""
+    global _monitor_thread
+    if _monitor_thread is None or not _monitor_thread.is_alive():
+        _monitor_thread = threading.Thread(target=_monitor_loop, name="ollama-health-monitor", daemon=True)
+        _monitor_thread.start()
+        logger.info(f"🩺 VERBOSE: Ollama health monitor started (every {OLLAMA_HEALTH_INTERVAL_SECONDS}s)")
+
+def is_breaker_failure(error: Exception) -> bool:
+    """Connection errors, timeouts and 5xx count against the breaker; 4xx (ex: unknown model) do not"""
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code >= 500
+    return isinstance(error, httpx.TransportError)
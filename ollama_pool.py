@@ -0,0 +1,211 @@
+"""
+Pool de instâncias Ollama.
+
+OLLAMA_BASE_URLS lista vários servidores Ollama (ex: um por GPU/máquina). Cada
+geração é roteada para:
+
+1. backends saudáveis (circuit breaker próprio por backend)
+2. preferindo os que já têm o modelo carregado (afinidade de modelo, via /api/ps)
+3. com o menor número de requisições em andamento (least outstanding requests)
+
+Cada backend tem um limite de concorrência; as requisições em andamento são
+contadas no Redis, então o limite vale para todos os workers. Com apenas
+OLLAMA_BASE_URL configurado o pool tem um único backend.
+"""
+import os
+import time
+import uuid
+import asyncio
+import httpx
+from contextlib import asynccontextmanager
+from loguru import logger
+from dotenv import load_dotenv
+from redis_client import get_redis
+from ollama_health import CircuitBreaker, OllamaUnavailableError, OPEN, HALF_OPEN
+import metrics
+
+load_dotenv()
+
+# Configuration
+OLLAMA_BASE_URL = os.getenv("OLLAMA_BASE_URL", "http://localhost:11434")
+# ex: "http://gpu1:11434=8,http://gpu2:11434=2" (=N: limite de concorrência do backend)
+OLLAMA_BASE_URLS = os.getenv("OLLAMA_BASE_URLS", "")
+OLLAMA_BACKEND_MAX_CONCURRENCY = int(os.getenv("OLLAMA_BACKEND_MAX_CONCURRENCY", "4"))
+OLLAMA_BACKEND_WAIT_SECONDS = int(os.getenv("OLLAMA_BACKEND_WAIT_SECONDS", "30"))
+
+# Requisições em andamento mais antigas que isso são consideradas perdidas (worker morto)
+LEASE_TTL_SECONDS = 600
+# Tempo que a lista de modelos carregados de cada backend fica em cache no processo
+LOADED_MODELS_CACHE_SECONDS = 5
+
+class OllamaBackend:
+    """One Ollama server: URL, concurrency limit, circuit breaker and loaded models"""
+
+    def __init__(self, url: str, max_concurrency: int = OLLAMA_BACKEND_MAX_CONCURRENCY):
+        self.url = url.rstrip("/")
+        self.max_concurrency = max_concurrency
+        self.breaker = CircuitBreaker(f"ollama:{self.url}")
+        self.leases_key = f"ollama:leases:{self.url}"
+        self._loaded = {"names": None, "checked_at": 0}
+
+    def outstanding(self) -> int:
+        """Requests in flight on this backend (across all processes)"""
+        try:
+            client = get_redis()
+            client.zremrangebyscore(self.leases_key, 0, time.time() - LEASE_TTL_SECONDS)
+            return client.zcard(self.leases_key)
+        except Exception:
+            return 0
+
+    def try_acquire(self) -> str:
+        """Reserve a slot if the backend is under its limit (returns the lease id, or None when full)"""
+        lease_id = uuid.uuid4().hex
+        try:
+            client = get_redis()
+            client.zremrangebyscore(self.leases_key, 0, time.time() - LEASE_TTL_SECONDS)
+            # Entra no conjunto e verifica a posição: quem passou do limite sai (como em admission.py)
+            client.zadd(self.leases_key, {lease_id: time.time()})
+            rank = client.zrank(self.leases_key, lease_id)
+            if rank is not None and rank < self.max_concurrency:
+                return lease_id
+            client.zrem(self.leases_key, lease_id)
+            return None
+        except Exception as e:
+            logger.debug(f"⚠️ VERBOSE: Could not register lease on {self.url}: {e}")
+            return lease_id
+
+    def release(self, lease_id: str):
+        try:
+            get_redis().zrem(self.leases_key, lease_id)
+        except Exception as e:
+            logger.debug(f"⚠️ VERBOSE: Could not release lease on {self.url}: {e}")
+
+    def loaded_models(self) -> set:
+        """Models loaded on this backend (/api/ps, cached for a few seconds)"""
+        if self._loaded["names"] is not None and time.time() - self._loaded["checked_at"] < LOADED_MODELS_CACHE_SECONDS:
+            return self._loaded["names"]
+        try:
+            response = httpx.get(f"{self.url}/api/ps", timeout=2)
+            response.raise_for_status()
+            names = {model.get("name") for model in response.json().get("models", [])}
+        except Exception as e:
+            logger.debug(f"⚠️ VERBOSE: Could not read loaded models from {self.url}: {e}")
+            names = set()
+        self._loaded.update(names=names, checked_at=time.time())
+        return names
+
+    def snapshot(self) -> dict:
+        return {
+            "url": self.url,
+            "max_concurrency": self.max_concurrency,
+            "outstanding": self.outstanding(),
+            "loaded_models": sorted(self.loaded_models()),
+            "breaker": self.breaker.snapshot(),
+        }
+
+def parse_backends(raw: str) -> list:
+    """Parse OLLAMA_BASE_URLS ("url[=max_concurrency],...")"""
+    backends = []
+    for item in raw.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        url, _, limit = item.partition("=")
+        backends.append(OllamaBackend(url, int(limit) if limit else OLLAMA_BACKEND_MAX_CONCURRENCY))
+    return backends
+
+class OllamaPool:
+    """Routes generations across Ollama backends"""
+
+    def __init__(self, backends: list):
+        self.backends = backends
+
+    def available_backends(self) -> list:
+        return [backend for backend in self.backends if backend.breaker.state != OPEN]
+
+    def any_available(self) -> bool:
+        return bool(self.available_backends())
+
+    def seconds_until_available(self) -> float:
+        return min((backend.breaker.seconds_until_half_open() for backend in self.backends), default=0.0)
+
+    def reserve_backend(self, model: str, exclude: tuple = ()) -> tuple:
+        """Reserve a slot on a healthy backend: model affinity first, then least outstanding requests
+
+        Retorna (backend, lease_id), ou None quando todos os backends estão no limite.
+        """
+        candidates = [backend for backend in self.available_backends() if backend.url not in exclude]
+        if not candidates:
+            raise OllamaUnavailableError(
+                "No Ollama backend available (all circuits open)",
+                retry_after=self.seconds_until_available()
+            )
+
+        load = {backend.url: backend.outstanding() for backend in candidates}
+        not_full = [backend for backend in candidates if load[backend.url] < backend.max_concurrency]
+        if not not_full:
+            return None
+
+        # Afinidade: backends com o modelo já carregado têm prioridade enquanto tiverem slot livre
+        if len(not_full) > 1:
+            not_full.sort(key=lambda backend: (model not in backend.loaded_models(), load[backend.url] / backend.max_concurrency))
+
+        recovering = False
+        for backend in not_full:
+            # A contagem acima é só para ordenar: o slot é reservado de forma atômica aqui
+            lease_id = backend.try_acquire()
+            if lease_id is None:
+                continue
+            # Half-open: apenas uma requisição de teste passa
+            if backend.breaker.state != HALF_OPEN or backend.breaker.allow_request():
+                return backend, lease_id
+            backend.release(lease_id)
+            recovering = True
+        if recovering:
+            raise OllamaUnavailableError("Ollama backends are recovering (half-open)", retry_after=5)
+        return None
+
+    @asynccontextmanager
+    async def lease(self, model: str, exclude: tuple = ()):
+        """Reserve a slot on the best backend for a generation (optionally avoiding some backends)"""
+        deadline = time.time() + OLLAMA_BACKEND_WAIT_SECONDS
+        reserved = self.reserve_backend(model, exclude)
+        while reserved is None:
+            # Todos os backends no limite de concorrência: aguarda um slot, sem passar do limite
+            if time.time() >= deadline:
+                metrics.incr("ollama.pool.saturated")
+                raise OllamaUnavailableError(
+                    f"No free slot on Ollama backends after {OLLAMA_BACKEND_WAIT_SECONDS}s",
+                    retry_after=OLLAMA_BACKEND_WAIT_SECONDS
+                )
+            await asyncio.sleep(0.2)
+            reserved = self.reserve_backend(model, exclude)
+
+        backend, lease_id = reserved
+        metrics.incr(f"ollama.pool.requests.{backend.url}")
+        logger.info(f"🧭 VERBOSE: Routing '{model}' to Ollama backend {backend.url}")
+        try:
+            yield backend
+        finally:
+            backend.release(lease_id)
+
+    def snapshot(self) -> dict:
+        backends = [backend.snapshot() for backend in self.backends]
+        states = [backend["breaker"]["state"] for backend in backends]
+        if all(state == OPEN for state in states):
+            state = OPEN
+        elif any(state != "closed" for state in states):
+            state = "degraded"
+        else:
+            state = "closed"
+        return {"state": state, "backends": backends}
+
+_pool = None
+
+def get_pool() -> OllamaPool:
+    """The shared Ollama pool (OLLAMA_BASE_URLS, or OLLAMA_BASE_URL alone)"""
+    global _pool
+    if _pool is None:
+        _pool = OllamaPool(parse_backends(OLLAMA_BASE_URLS or OLLAMA_BASE_URL))
+        logger.info(f"🧭 VERBOSE: Ollama pool with {len(_pool.backends)} backend(s): {[b.url for b in _pool.backends]}")
+    return _pool
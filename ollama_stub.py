@@ -0,0 +1,138 @@
+"""
+Servidor Ollama falso para testes locais do pool de backends.
+
+Implementa /api/tags, /api/ps, /api/generate e /api/embed com latência
+configurável, sem precisar de GPU nem de modelos baixados. Exemplo com três
+backends:
+
+    python ollama_stub.py --port 11435 --delay 1.0 &
+    python ollama_stub.py --port 11436 --delay 1.0 &
+    python ollama_stub.py --port 11437 --delay 1.0 --fail-rate 0.5 &
+    OLLAMA_BASE_URLS=http://localhost:11435,http://localhost:11436,http://localhost:11437 celery -A workers worker
+"""
+import json
+import time
+import random
+import asyncio
+import hashlib
+import argparse
+from datetime import datetime, timedelta, timezone
+import uvicorn
+from fastapi import FastAPI, HTTPException, Request
+
+def _sample_value(schema: dict):
+    """Minimal value that satisfies the JSON Schema sent in "format\""""
+    kind = str(schema.get("type", "")).lower()
+    if kind == "object":
+        return {key: _sample_value(item) for key, item in schema.get("properties", {}).items()}
+    if kind == "array":
+        return [_sample_value(schema.get("items", {}))]
+    if kind == "integer":
+        return 1
+    if kind == "number":
+        return 1.0
+    if kind == "boolean":
+        return True
+    return "stub"
+
+def create_app(name: str, models: list, delay: float, fail_rate: float, slots: int = 0,
+               slow_rate: float = 0.0, slow_delay: float = 0.0) -> FastAPI:
+    app = FastAPI(title=f"Ollama stub {name}")
+    loaded = {}
+    stats = {"requests": 0, "in_flight": 0, "max_in_flight": 0}
+
+    def load(model: str, keep_alive):
+        expires = datetime.now(timezone.utc) + timedelta(minutes=5)
+        loaded[model] = {"name": model, "model": model, "size": 1_000_000_000, "size_vram": 800_000_000,
+                         "expires_at": expires.isoformat(), "keep_alive": keep_alive}
+
+    @app.get("/api/tags")
+    async def tags():
+        return {"models": [{"name": model, "model": model, "size": 1_000_000_000} for model in models]}
+
+    @app.get("/api/ps")
+    async def ps():
+        return {"models": list(loaded.values())}
+
+    @app.get("/stats")
+    async def get_stats():
+        return {"backend": name, **stats, "loaded": list(loaded)}
+
+    @app.post("/api/generate")
+    async def generate(request: Request):
+        body = await request.json()
+        model = body.get("model")
+        if model not in models:
+            raise HTTPException(status_code=404, detail=f"model '{model}' not found")
+
+        cold_start = model not in loaded
+        load(model, body.get("keep_alive"))
+        if not body.get("prompt"):
+            return {"model": model, "response": "", "done": True, "done_reason": "load"}
+
+        if random.random() < fail_rate:
+            raise HTTPException(status_code=500, detail="stub failure")
+
+        stats["requests"] += 1
+        stats["in_flight"] += 1
+        stats["max_in_flight"] = max(stats["max_in_flight"], stats["in_flight"])
+        try:
+            start = time.time()
+            # Com --slots, requisições acima da capacidade dividem a GPU e ficam mais lentas
+            slowdown = max(1.0, stats["in_flight"] / slots) if slots else 1.0
+            # Com --slow-rate, uma fração das gerações demora --slow-delay (cauda de latência)
+            tail = slow_delay if random.random() < slow_rate else 0.0
+            await asyncio.sleep(delay * slowdown + tail + (1.0 if cold_start else 0.0))
+        finally:
+            stats["in_flight"] -= 1
+
+        schema = body.get("format")
+        if isinstance(schema, dict):
+            response = json.dumps(_sample_value(schema))
+        else:
+            response = f'{{"backend": "{name}", "model": "{model}"}}'
+
+        prompt_tokens = len(body["prompt"]) // 4
+        return {
+            "model": model,
+            "response": response,
+            "done": True,
+            "context": list(body.get("context") or []) + [1] * min(prompt_tokens, 64),
+            "total_duration": int((time.time() - start) * 1e9),
+            "load_duration": int(1e9) if cold_start else 0,
+            "prompt_eval_count": prompt_tokens,
+            "prompt_eval_duration": int(prompt_tokens * 1e6),
+            "eval_count": len(response) // 4,
+            "eval_duration": int(delay * 1e9),
+        }
+
+    @app.post("/api/embed")
+    async def embed(request: Request):
+        body = await request.json()
+        texts = body.get("input") or []
+        texts = [texts] if isinstance(texts, str) else texts
+        embeddings = []
+        for text in texts:
+            digest = hashlib.sha256(text.encode("utf-8")).digest()
+            embeddings.append([byte / 255 for byte in digest[:16]])
+        return {"model": body.get("model"), "embeddings": embeddings}
+
+    return app
+
+def main():
+    parser = argparse.ArgumentParser(description="Servidor Ollama falso para testes locais")
+    parser.add_argument("--port", type=int, default=11435)
+    parser.add_argument("--models", default="gemma3:1b,gemma3:4b", help="modelos disponíveis, separados por vírgula")
+    parser.add_argument("--delay", type=float, default=0.5, help="latência de cada geração em segundos")
+    parser.add_argument("--slots", type=int, default=0, help="gerações simultâneas sem perda de velocidade (0 = ilimitado)")
+    parser.add_argument("--slow-rate", type=float, default=0.0, help="fração de gerações lentas (cauda de latência)")
+    parser.add_argument("--slow-delay", type=float, default=5.0, help="atraso extra das gerações lentas em segundos")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="fração de gerações que retornam HTTP 500")
+    args = parser.parse_args()
+
+    app = create_app(f"stub:{args.port}", args.models.split(","), args.delay, args.fail_rate, args.slots,
+                     args.slow_rate, args.slow_delay)
+    uvicorn.run(app, host="127.0.0.1", port=args.port, log_level="warning")
+
+if __name__ == "__main__":
+    main()
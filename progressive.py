@@ -0,0 +1,85 @@
+"""
+Extração progressiva com resposta antecipada.
+
+Muitos prompts ("data de emissão", "CNPJ do emitente") são respondidos pela
+primeira página, mas o documento inteiro passava pelo OCR antes da LLM. No modo
+progressivo (header Extraction-Mode: progressive) as páginas do PDF são
+extraídas em ordem: primeiro PROGRESSIVE_FIRST_PAGES, depois lotes de
+PROGRESSIVE_BATCH_PAGES. Após cada lote o motor de regras tenta responder e, nos
+primeiros PROGRESSIVE_MAX_LLM_PROBES lotes, a LLM também é consultada sobre o
+texto parcial. A extração para assim que todos os campos do Format-Response
+estão preenchidos com confiança:
+
+- regras: todas as chaves resolvidas (confiança >= RULES_MIN_CONFIDENCE)
+- LLM: todas as chaves com valor não vazio e presente no texto extraído (evita
+  aceitar um valor inventado pelo modelo antes da página certa ser lida)
+
+Sem resposta confiável, a extração continua até o fim e o pipeline segue normal.
+"""
+import os
+import re
+import json
+from dotenv import load_dotenv
+from utils import find_json_value
+
+load_dotenv()
+
+# Configuration
+# "full" (extrai tudo antes da LLM) ou "progressive"; header Extraction-Mode por requisição
+EXTRACTION_MODE = os.getenv("EXTRACTION_MODE", "full").lower()
+PROGRESSIVE_FIRST_PAGES = int(os.getenv("PROGRESSIVE_FIRST_PAGES", "1"))
+PROGRESSIVE_BATCH_PAGES = int(os.getenv("PROGRESSIVE_BATCH_PAGES", "4"))
+PROGRESSIVE_MAX_LLM_PROBES = int(os.getenv("PROGRESSIVE_MAX_LLM_PROBES", "2"))
+
+EXTRACTION_MODES = ("full", "progressive")
+# Instrução extra nas consultas sobre texto parcial: campo ausente fica vazio em vez de inventado
+PARTIAL_TEXT_INSTRUCTION = "If a field is not present in the context, leave its value empty."
+EMPTY_VALUES = {"", "null", "none", "n/a", "na", "-", "não encontrado", "nao encontrado", "não informado",
+                "nao informado", "desconhecido", "not found", "unknown"}
+
+def flat_template_keys(format_template: str) -> list:
+    """Keys of a flat JSON object template (None for other templates: no early answer)"""
+    try:
+        template = json.loads(format_template or "")
+    except (json.JSONDecodeError, TypeError):
+        return None
+    if not isinstance(template, dict) or not template or any(isinstance(v, (dict, list)) for v in template.values()):
+        return None
+    return list(template)
+
+def page_batches(num_pages: int, first_pages: int = PROGRESSIVE_FIRST_PAGES,
+                 batch_pages: int = PROGRESSIVE_BATCH_PAGES) -> list:
+    """Inclusive [first, last] page ranges: the first pages, then fixed-size batches"""
+    batches = [[0, min(max(first_pages, 1), num_pages) - 1]]
+    while batches[-1][1] < num_pages - 1:
+        first = batches[-1][1] + 1
+        batches.append([first, min(first + max(batch_pages, 1), num_pages) - 1])
+    return batches
+
+def _normalize(text: str) -> str:
+    return re.sub(r"[\W_]+", "", text.lower())
+
+def _is_grounded(value, normalized_text: str) -> bool:
+    """Whether the value appears in the extracted text (ignoring case, spaces and punctuation)"""
+    if isinstance(value, bool):
+        return True
+    if isinstance(value, (int, float)):
+        return str(int(value)) in normalized_text
+    normalized_value = _normalize(str(value))
+    return bool(normalized_value) and normalized_value in normalized_text
+
+def confident_answer(llm_response: str, format_template: str, text: str) -> bool:
+    """Whether an answer over partial text fills every template key with a value found in the text"""
+    keys = flat_template_keys(format_template)
+    found = find_json_value(llm_response or "", dict)
+    if not keys or found is None:
+        return False
+    answer = json.loads(found)
+    normalized_text = _normalize(text)
+    for key in keys:
+        value = answer.get(key)
+        if value is None or str(value).strip().lower() in EMPTY_VALUES:
+            return False
+        if not _is_grounded(value, normalized_text):
+            return False
+    return True
@@ -0,0 +1,118 @@
+"""
+Várias perguntas em um único upload.
+
+O header Questions traz uma lista JSON de perguntas, cada uma com id, prompt e
+formato próprios. O texto é extraído uma única vez e as perguntas são
+respondidas em uma só passada sobre o documento:
+
+- "packed": todas as perguntas em um único prompt estruturado (uma chamada à LLM)
+- "concurrent": uma chamada por pergunta, em paralelo, com o mesmo prefixo de contexto
+
+Os resultados são devolvidos em um objeto JSON indexado pelo id da pergunta.
+"""
+import os
+import json
+from loguru import logger
+from utils import format_llm_response
+
+QUESTIONS_MODES = ["packed", "concurrent"]
+MAX_QUESTIONS = int(os.getenv("MAX_QUESTIONS", "20"))
+
+def _to_text(value) -> str:
+    """Accept templates/examples given either as JSON strings or as JSON values"""
+    if value is None or isinstance(value, str):
+        return value or ""
+    return json.dumps(value, ensure_ascii=False)
+
+def _to_value(text: str):
+    """Parse a JSON string, keeping plain text when it is not JSON"""
+    try:
+        return json.loads(text)
+    except (json.JSONDecodeError, TypeError):
+        return text
+
+def parse_questions(raw: str) -> list:
+    """Validate the Questions header and return the normalized list (raises ValueError)"""
+    data = json.loads(raw)
+    if not isinstance(data, list) or not data:
+        raise ValueError("Questions must be a non-empty JSON list")
+    if len(data) > MAX_QUESTIONS:
+        raise ValueError(f"Too many questions: {len(data)} (maximum {MAX_QUESTIONS})")
+
+    questions = []
+    seen_ids = set()
+    for index, item in enumerate(data, start=1):
+        if not isinstance(item, dict) or not item.get("prompt"):
+            raise ValueError(f"Question {index} must be an object with a 'prompt'")
+
+        question_id = str(item.get("id") or f"q{index}")
+        if question_id in seen_ids:
+            raise ValueError(f"Duplicated question id: {question_id}")
+        seen_ids.add(question_id)
+
+        questions.append({
+            "id": question_id,
+            "prompt": str(item["prompt"]),
+            "format": _to_text(item.get("format", item.get("format_response"))),
+            "example": _to_text(item.get("example")) or None,
+        })
+
+    return questions
+
+def load_questions(raw: str) -> list:
+    """Load the questions stored in the database (empty list for single-question documents)"""
+    return json.loads(raw) if raw else []
+
+def summarize_questions(questions: list) -> str:
+    """One line per question - stored as the document prompt and used as retrieval query"""
+    return "\n".join(f"[{q['id']}] {q['prompt']}" for q in questions)
+
+def build_packed_request(questions: list) -> tuple[str, str, str]:
+    """Pack every question into one structured prompt. Returns (prompt, format_template, example)"""
+    lines = [
+        "Answer each of the following questions about the document.",
+        "Return a single JSON object using each question id as key and the answer in the requested format as value.",
+        "",
+    ]
+    for question in questions:
+        line = f"- [{question['id']}] {question['prompt']}"
+        if question["format"]:
+            line += f" (answer format: {question['format']})"
+        lines.append(line)
+
+    template = {q["id"]: _to_value(q["format"]) for q in questions}
+    examples = {q["id"]: _to_value(q["example"]) for q in questions if q["example"]}
+
+    return (
+        "\n".join(lines),
+        json.dumps(template, ensure_ascii=False),
+        json.dumps(examples, ensure_ascii=False) if examples else None,
+    )
+
+def format_question_responses(llm_response: str, questions: list, mode: str) -> str:
+    """Format the LLM output of a multi-question document. Returns a JSON object keyed by question id"""
+    results = {}
+
+    if mode == "concurrent":
+        # llm_response guarda as respostas brutas por id
+        raw_by_id = _to_value(llm_response)
+        if not isinstance(raw_by_id, dict):
+            raw_by_id = {}
+        for question in questions:
+            formatted = format_llm_response(raw_by_id.get(question["id"], ""), question["format"], question["example"])
+            results[question["id"]] = _to_value(formatted)
+    else:
+        _, packed_template, packed_example = build_packed_request(questions)
+        packed = _to_value(format_llm_response(llm_response, packed_template, packed_example))
+        if not isinstance(packed, dict):
+            packed = {}
+        for question in questions:
+            if question["id"] in packed:
+                results[question["id"]] = packed[question["id"]]
+            else:
+                # Fallback: procura a resposta desta pergunta na saída bruta
+                logger.warning(f"⚠️ VERBOSE: Question '{question['id']}' missing from packed answer - extracting individually")
+                formatted = format_llm_response(llm_response, question["format"], question["example"])
+                results[question["id"]] = _to_value(formatted)
+
+    return json.dumps(results, ensure_ascii=False)
@@ -0,0 +1,88 @@
+"""
+Detecção de documentos travados no meio do pipeline.
+
+Se um worker morre no meio de uma etapa (OOM kill, deploy, máquina reiniciada), a
+mensagem é perdida e o documento fica para sempre em UPLOADED, TEXT_EXTRACTED,
+PROMPT_PROCESSED ou RETRYING - o cleanup_task só remove documentos concluídos. O
+reaper (tarefa periódica do beat em workers.py) procura documentos sem mudança
+de status há mais que o timeout da etapa e confere se ainda há trabalho vivo
+para eles:
+
+- na fila: job registrado pelo escalonador e ainda não consumido (scheduling)
+- em execução: tarefa ativa, reservada ou agendada (retry com countdown) em
+  algum worker (celery inspect)
+
+Sem trabalho vivo, o documento é reenfileirado a partir do último checkpoint
+(extração, LLM ou formatação), no máximo REAPER_MAX_REQUEUES vezes; depois disso
+vai para ERROR.
+"""
+import os
+from datetime import datetime, timedelta
+from dotenv import load_dotenv
+from models import DocumentStatus
+
+load_dotenv()
+
+# Configuration
+REAPER_ENABLED = os.getenv("REAPER_ENABLED", "true").lower() == "true"
+REAPER_INTERVAL_SECONDS = int(os.getenv("REAPER_INTERVAL_SECONDS", "60"))
+REAPER_MAX_REQUEUES = int(os.getenv("REAPER_MAX_REQUEUES", "3"))
+# Tempo sem mudança de status a partir do qual a etapa é suspeita (só reenfileira se nenhuma tarefa estiver viva)
+REAPER_EXTRACTION_TIMEOUT_SECONDS = int(os.getenv("REAPER_EXTRACTION_TIMEOUT_SECONDS", "900"))
+REAPER_LLM_TIMEOUT_SECONDS = int(os.getenv("REAPER_LLM_TIMEOUT_SECONDS", "600"))
+REAPER_FORMAT_TIMEOUT_SECONDS = int(os.getenv("REAPER_FORMAT_TIMEOUT_SECONDS", "120"))
+REAPER_RETRYING_TIMEOUT_SECONDS = int(os.getenv("REAPER_RETRYING_TIMEOUT_SECONDS", "600"))
+REAPER_INSPECT_TIMEOUT_SECONDS = float(os.getenv("REAPER_INSPECT_TIMEOUT_SECONDS", "2.0"))
+
+STAGE_TIMEOUTS = {
+    DocumentStatus.UPLOADED: REAPER_EXTRACTION_TIMEOUT_SECONDS,
+    DocumentStatus.TEXT_EXTRACTED: REAPER_LLM_TIMEOUT_SECONDS,
+    DocumentStatus.PROMPT_PROCESSED: REAPER_FORMAT_TIMEOUT_SECONDS,
+    DocumentStatus.RETRYING: REAPER_RETRYING_TIMEOUT_SECONDS,
+}
+
+# Posição do document_id nos argumentos de cada tarefa do pipeline
+PIPELINE_TASK_DOCUMENT_ARG = {
+    "workers.extract_text_task": 0,
+    "workers.ocr_page_range_task": 0,
+    "workers.merge_ocr_pages_task": 1,
+    "workers.process_prompt_task": 0,
+    "workers.format_response_task": 0,
+    "workers.process_document_task": 0,
+}
+
+def last_status_change(document) -> datetime:
+    """When the document last changed status (updated_at só é gravado no primeiro commit de etapa)"""
+    return document.updated_at or document.created_at
+
+def is_overdue(status: DocumentStatus, changed_at: datetime, now: datetime = None) -> bool:
+    """Whether the document has stayed in an in-progress status longer than the stage timeout"""
+    timeout = STAGE_TIMEOUTS.get(status)
+    if timeout is None or changed_at is None:
+        return False
+    return (now or datetime.utcnow()) - changed_at > timedelta(seconds=timeout)
+
+def overdue_cutoff(now: datetime = None) -> datetime:
+    """Documents updated after this moment are within every stage timeout (prefilter for the query)"""
+    return (now or datetime.utcnow()) - timedelta(seconds=min(STAGE_TIMEOUTS.values()))
+
+def live_task_document_ids(celery_app) -> set:
+    """Document ids with a pipeline task active, reserved or scheduled in some worker
+
+    Retorna None quando nenhum worker respondeu (não dá para saber o que está vivo).
+    """
+    inspector = celery_app.control.inspect(timeout=REAPER_INSPECT_TIMEOUT_SECONDS)
+    replies = [inspector.active(), inspector.reserved(), inspector.scheduled()]
+    if all(reply is None for reply in replies):
+        return None
+    document_ids = set()
+    for reply in replies:
+        for tasks in (reply or {}).values():
+            for task in tasks:
+                # scheduled() embrulha a tarefa em "request"
+                request = task.get("request", task)
+                index = PIPELINE_TASK_DOCUMENT_ARG.get(request.get("name"))
+                args = request.get("args") or []
+                if index is not None and isinstance(args, (list, tuple)) and len(args) > index:
+                    document_ids.add(int(args[index]))
+    return document_ids
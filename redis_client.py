@@ -0,0 +1,22 @@
+import os
+import redis
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Configuration
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+
+_redis_client = None
+
+def get_redis() -> redis.Redis:
+    """Get the shared Redis client (the same Redis already used by Celery)"""
+    global _redis_client
+    if _redis_client is None:
+        _redis_client = redis.Redis.from_url(
+            REDIS_URL,
+            decode_responses=True,
+            socket_timeout=2,
+            socket_connect_timeout=2
+        )
+    return _redis_client
@@ -0,0 +1,234 @@
+"""
+Seleção de contexto relevante (retrieval) entre a extração e o prompt.
+
+O texto extraído é dividido em chunks, indexado com BM25 em memória e,
+opcionalmente, combinado com embeddings do Ollama (matriz NumPy). Apenas os
+top-k chunks mais relevantes para o Prompt, dentro de um orçamento de tokens,
+são enviados como Context para a LLM.
+"""
+import os
+import re
+import math
+import unicodedata
+from collections import Counter
+import httpx
+from loguru import logger
+from dotenv import load_dotenv
+
+try:
+    import numpy as np
+except ImportError:  # NumPy é opcional - sem ele apenas o BM25 é usado
+    np = None
+
+load_dotenv()
+
+# Configuration
+OLLAMA_BASE_URL = os.getenv("OLLAMA_BASE_URL", "http://localhost:11434")
+RETRIEVAL_ENABLED = os.getenv("RETRIEVAL_ENABLED", "true").lower() == "true"
+RETRIEVAL_TOP_K = int(os.getenv("RETRIEVAL_TOP_K", "6"))
+RETRIEVAL_TOKEN_BUDGET = int(os.getenv("RETRIEVAL_TOKEN_BUDGET", "1500"))
+RETRIEVAL_CHUNK_TOKENS = int(os.getenv("RETRIEVAL_CHUNK_TOKENS", "200"))
+RETRIEVAL_EMBEDDING_MODEL = os.getenv("RETRIEVAL_EMBEDDING_MODEL", "")  # ex: nomic-embed-text (vazio = só BM25)
+RETRIEVAL_EMBEDDING_WEIGHT = float(os.getenv("RETRIEVAL_EMBEDDING_WEIGHT", "0.5"))
+
+# Média aproximada de caracteres por token para textos em português/inglês
+CHARS_PER_TOKEN = 4
+
+STOPWORDS = {
+    # português
+    "a", "o", "as", "os", "de", "da", "do", "das", "dos", "e", "em", "no", "na", "nos", "nas",
+    "um", "uma", "para", "por", "com", "que", "qual", "quais", "se", "ao", "aos", "ou", "sua",
+    "seu", "este", "esta", "esse", "essa", "documento", "extraia", "informe", "retorne",
+    # inglês
+    "the", "of", "and", "to", "in", "is", "what", "which", "for", "on", "with", "from",
+    "extract", "return", "document",
+}
+
+def estimate_tokens(text: str) -> int:
+    """Estimate the number of tokens of a text (heuristic, no tokenizer needed)"""
+    if not text:
+        return 0
+    return max(1, math.ceil(len(text) / CHARS_PER_TOKEN))
+
+def tokenize(text: str) -> list:
+    """Lowercase, strip accents and split text into searchable terms"""
+    normalized = unicodedata.normalize("NFKD", text.lower())
+    normalized = "".join(c for c in normalized if not unicodedata.combining(c))
+    terms = re.findall(r"[a-z0-9]+", normalized)
+    return [t for t in terms if t not in STOPWORDS and (len(t) > 1 or t.isdigit())]
+
+def split_into_chunks(text: str, chunk_tokens: int = RETRIEVAL_CHUNK_TOKENS) -> list:
+    """Split text into line-aligned chunks of roughly chunk_tokens tokens"""
+    max_chars = chunk_tokens * CHARS_PER_TOKEN
+    chunks = []
+    current = []
+    current_len = 0
+
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        # Linhas muito longas (ex: PDFs sem quebra) são quebradas no limite do chunk
+        while len(line) > max_chars:
+            if current:
+                chunks.append("\n".join(current))
+                current, current_len = [], 0
+            chunks.append(line[:max_chars])
+            line = line[max_chars:]
+        if current_len + len(line) > max_chars and current:
+            chunks.append("\n".join(current))
+            current, current_len = [], 0
+        current.append(line)
+        current_len += len(line) + 1
+
+    if current:
+        chunks.append("\n".join(current))
+
+    return chunks
+
+class BM25:
+    """Okapi BM25 ranker built in-process over a list of chunks"""
+
+    def __init__(self, documents: list, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.doc_terms = [Counter(tokenize(doc)) for doc in documents]
+        self.doc_lengths = [sum(terms.values()) for terms in self.doc_terms]
+        self.avg_length = (sum(self.doc_lengths) / len(self.doc_lengths)) if self.doc_lengths else 0
+
+        document_frequency = Counter()
+        for terms in self.doc_terms:
+            document_frequency.update(terms.keys())
+
+        total = len(documents)
+        self.idf = {
+            term: math.log((total - freq + 0.5) / (freq + 0.5) + 1)
+            for term, freq in document_frequency.items()
+        }
+
+    def score(self, query: str) -> list:
+        """Return the BM25 score of every chunk for the given query"""
+        query_terms = tokenize(query)
+        scores = []
+        for terms, length in zip(self.doc_terms, self.doc_lengths):
+            score = 0.0
+            for term in query_terms:
+                freq = terms.get(term)
+                if not freq:
+                    continue
+                norm = 1 - self.b + self.b * (length / self.avg_length if self.avg_length else 0)
+                score += self.idf[term] * (freq * (self.k1 + 1)) / (freq + self.k1 * norm)
+            scores.append(score)
+        return scores
+
+def build_retrieval_query(prompt: str, format_response: str = None) -> str:
+    """Build the retrieval query from the Prompt and the keys of the Format-Response template"""
+    query = prompt or ""
+    if format_response:
+        # Chaves do template (ex: "data_emissao", "CNPJ") também indicam o que procurar
+        keys = re.findall(r'"([^"]+)"\s*:', format_response)
+        query += " " + " ".join(key.replace("_", " ") for key in keys)
+    return query
+
+async def embed_texts(texts: list, model: str) -> "np.ndarray":
+    """Get Ollama embeddings for a list of texts as an L2-normalized NumPy matrix"""
+    async with httpx.AsyncClient(timeout=120) as client:
+        response = await client.post(
+            f"{OLLAMA_BASE_URL}/api/embed",
+            json={"model": model, "input": texts}
+        )
+        response.raise_for_status()
+        matrix = np.array(response.json()["embeddings"], dtype=np.float32)
+
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+async def select_relevant_context(prompt: str, text: str, format_response: str = None,
+                                  top_k: int = RETRIEVAL_TOP_K,
+                                  token_budget: int = RETRIEVAL_TOKEN_BUDGET) -> tuple[str, dict]:
+    """Select the chunks of text most relevant to the prompt. Returns (context, selection_info)"""
+    original_tokens = estimate_tokens(text)
+    selection_info = {
+        "applied": False,
+        "strategy": None,
+        "original_tokens": original_tokens,
+        "token_budget": token_budget,
+    }
+
+    if not RETRIEVAL_ENABLED:
+        selection_info["reason"] = "retrieval disabled (RETRIEVAL_ENABLED=false)"
+        return text, selection_info
+
+    if original_tokens <= token_budget:
+        selection_info["reason"] = "document fits in token budget"
+        return text, selection_info
+
+    chunks = split_into_chunks(text)
+    query = build_retrieval_query(prompt, format_response)
+    logger.info(f"🔎 VERBOSE: Retrieval - {len(chunks)} chunks, ~{original_tokens} tokens, budget {token_budget}")
+    logger.info(f"🔎 VERBOSE: Retrieval query: {query}")
+
+    bm25_scores = BM25(chunks).score(query)
+    max_bm25 = max(bm25_scores) if bm25_scores else 0
+    scores = [s / max_bm25 if max_bm25 else 0.0 for s in bm25_scores]
+    embedding_scores = None
+    selection_info["strategy"] = "bm25"
+
+    if RETRIEVAL_EMBEDDING_MODEL and np is not None:
+        try:
+            matrix = await embed_texts(chunks + [query], RETRIEVAL_EMBEDDING_MODEL)
+            embedding_scores = (matrix[:-1] @ matrix[-1]).tolist()
+            weight = RETRIEVAL_EMBEDDING_WEIGHT
+            scores = [(1 - weight) * s + weight * e for s, e in zip(scores, embedding_scores)]
+            selection_info["strategy"] = "hybrid"
+            selection_info["embedding_model"] = RETRIEVAL_EMBEDDING_MODEL
+        except Exception as e:
+            logger.warning(f"⚠️ VERBOSE: Embeddings unavailable, using BM25 only: {e}")
+
+    # Sem nenhum termo em comum: mantém o início do documento (cabeçalho)
+    matched = any(scores)
+    if not matched:
+        ranking = list(range(len(chunks)))
+        selection_info["reason"] = "no query term matched - using leading chunks"
+    else:
+        ranking = sorted(range(len(chunks)), key=lambda i: scores[i], reverse=True)
+
+    selected = []
+    used_tokens = 0
+    for index in ranking:
+        if len(selected) >= top_k or (matched and selected and scores[index] <= 0):
+            break
+        chunk_tokens = estimate_tokens(chunks[index])
+        if used_tokens + chunk_tokens > token_budget and selected:
+            continue
+        selected.append(index)
+        used_tokens += chunk_tokens
+
+    # Mantém a ordem original do documento para preservar a leitura
+    selected.sort()
+    context = "\n...\n".join(chunks[i] for i in selected)
+
+    selection_info.update({
+        "applied": True,
+        "total_chunks": len(chunks),
+        "selected_chunks": selected,
+        "selected_tokens": estimate_tokens(context),
+        "chunk_scores": [
+            {
+                "chunk": i,
+                "score": round(scores[i], 4),
+                "bm25": round(bm25_scores[i], 4),
+                "embedding": round(embedding_scores[i], 4) if embedding_scores else None,
+                "tokens": estimate_tokens(chunks[i]),
+                "selected": i in selected,
+                "preview": chunks[i][:80],
+            }
+            for i in ranking[:max(top_k * 3, 10)]
+        ],
+    })
+
+    logger.info(f"✅ VERBOSE: Retrieval selected chunks {selected} (~{selection_info['selected_tokens']} of {original_tokens} tokens)")
+    for item in selection_info["chunk_scores"][:top_k]:
+        logger.debug(f"🔎 VERBOSE: Chunk {item['chunk']} score={item['score']} bm25={item['bm25']} selected={item['selected']}")
+
+    return context, selection_info
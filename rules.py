@@ -0,0 +1,207 @@
+"""
+Extração determinística por regras (antes da LLM).
+
+Campos como CNPJ, datas e valores podem ser encontrados no extracted_text com
+padrões pré-compilados e validados. Quando todas as chaves do template do
+Format-Response são resolvidas com alta confiança, a resposta é montada
+diretamente e a chamada à LLM é evitada.
+
+Novas regras são registradas com o decorator @register_rule.
+"""
+import os
+import re
+import json
+from datetime import datetime
+from loguru import logger
+from dotenv import load_dotenv
+from retrieval import tokenize
+import metrics
+
+load_dotenv()
+
+# Configuration
+RULES_ENABLED = os.getenv("RULES_ENABLED", "true").lower() == "true"
+RULES_MIN_CONFIDENCE = float(os.getenv("RULES_MIN_CONFIDENCE", "0.9"))
+
+# Quantos caracteres antes do valor são considerados como rótulo (ex: "Data de emissão:")
+LABEL_WINDOW = 60
+
+class Rule:
+    """A deterministic extractor for template keys matching key_pattern"""
+
+    def __init__(self, name: str, key_pattern: str, generic_terms: set, extractor):
+        self.name = name
+        self.key_pattern = re.compile(key_pattern)
+        self.generic_terms = generic_terms
+        self.extractor = extractor
+
+    def matches_key(self, key: str) -> bool:
+        return bool(self.key_pattern.search(" ".join(tokenize(key.replace("_", " ")))))
+
+    def find(self, text: str) -> list:
+        """Return (value, start_position) for every valid occurrence in text, in text order"""
+        return self.extractor(text)
+
+RULES = []
+
+def register_rule(name: str, key_pattern: str, generic_terms: set):
+    """Decorator that registers an extractor function as a rule"""
+    def decorator(extractor):
+        RULES.append(Rule(name, key_pattern, generic_terms, extractor))
+        return extractor
+    return decorator
+
+def find_rule(key: str):
+    """First registered rule that handles a template key"""
+    return next((rule for rule in RULES if rule.matches_key(key)), None)
+
+# --- Regras padrão ---
+
+CNPJ_PATTERN = re.compile(r"(?<!\d)(\d{2})\.?(\d{3})\.?(\d{3})/?(\d{4})-?(\d{2})(?!\d)")
+
+def is_valid_cnpj(digits: str) -> bool:
+    """Validate the two CNPJ check digits"""
+    if len(digits) != 14 or digits == digits[0] * 14:
+        return False
+    for size in (12, 13):
+        weights = list(range(size - 7, 1, -1)) + list(range(9, 1, -1))
+        total = sum(int(d) * w for d, w in zip(digits[:size], weights))
+        check = 11 - total % 11
+        if int(digits[size]) != (0 if check >= 10 else check):
+            return False
+    return True
+
+@register_rule("cnpj", r"\bcnpj\b", {"cnpj"})
+def extract_cnpj(text: str) -> list:
+    found = []
+    for match in CNPJ_PATTERN.finditer(text):
+        digits = "".join(match.groups())
+        if is_valid_cnpj(digits):
+            found.append((f"{digits[:2]}.{digits[2:5]}.{digits[5:8]}/{digits[8:12]}-{digits[12:]}", match.start()))
+    return found
+
+NUMERIC_DATE_PATTERN = re.compile(r"(?<!\d)(\d{1,2})[/\-\.](\d{1,2})[/\-\.](\d{4}|\d{2})(?!\d)")
+MONTHS = {
+    "janeiro": 1, "fevereiro": 2, "marco": 3, "março": 3, "abril": 4, "maio": 5, "junho": 6,
+    "julho": 7, "agosto": 8, "setembro": 9, "outubro": 10, "novembro": 11, "dezembro": 12,
+}
+WRITTEN_DATE_PATTERN = re.compile(
+    r"(?<!\d)(\d{1,2})\s+de\s+(" + "|".join(MONTHS) + r")\s+de\s+(\d{4})(?!\d)", re.IGNORECASE
+)
+
+def _format_date(day: int, month: int, year: int):
+    if year < 100:
+        year += 2000 if year < 70 else 1900
+    try:
+        return datetime(year, month, day).strftime("%d/%m/%Y")
+    except ValueError:
+        return None
+
+@register_rule("date", r"\b(data|date|emissao|vencimento|validade)\b", {"data", "date"})
+def extract_dates(text: str) -> list:
+    found = []
+    for match in NUMERIC_DATE_PATTERN.finditer(text):
+        value = _format_date(int(match.group(1)), int(match.group(2)), int(match.group(3)))
+        if value:
+            found.append((value, match.start()))
+    for match in WRITTEN_DATE_PATTERN.finditer(text):
+        value = _format_date(int(match.group(1)), MONTHS[match.group(2).lower()], int(match.group(3)))
+        if value:
+            found.append((value, match.start()))
+    return sorted(found, key=lambda item: item[1])
+
+CURRENCY_PATTERN = re.compile(r"R\$\s*(\d{1,3}(?:\.\d{3})*(?:,\d{2})|\d+(?:,\d{2}))(?!\d)")
+
+@register_rule("currency", r"\b(valor|total|preco|montante|amount|price)\b", {"valor", "value", "amount", "preco", "price"})
+def extract_currency(text: str) -> list:
+    return [(match.group(1), match.start()) for match in CURRENCY_PATTERN.finditer(text)]
+
+# --- Engine ---
+
+def _is_anchored(text: str, position: int, previous_end: int, key_terms: list, generic_terms: set) -> bool:
+    """True when the label right before the value names the key (ex: "Data de emissão:" for data_emissao)
+
+    The label is the text since the previous value or line break. Qualifier terms of the
+    key (emissao, vencimento, total...) must all be present; keys made only of generic
+    terms (cnpj, data) need any of them.
+    """
+    start = max(position - LABEL_WINDOW, previous_end, text.rfind("\n", 0, position) + 1)
+    label = set(tokenize(text[start:position]))
+    qualifiers = [term for term in key_terms if term not in generic_terms]
+    if qualifiers:
+        return all(term in label for term in qualifiers)
+    return bool(label & set(key_terms))
+
+def resolve_key(key: str, text: str, rule: Rule) -> dict:
+    """Resolve one template key with a rule. Returns {"value", "rule", "confidence"} or None"""
+    candidates = rule.find(text)
+    if not candidates:
+        return None
+
+    key_terms = tokenize(key.replace("_", " "))
+    anchored = []
+    previous_end = 0
+    for value, position in candidates:
+        if _is_anchored(text, position, previous_end, key_terms, rule.generic_terms) and value not in anchored:
+            anchored.append(value)
+        previous_end = position + len(value)
+    distinct = list(dict.fromkeys(value for value, _ in candidates))
+
+    if len(anchored) == 1:
+        # Um único valor com o rótulo da chave (ex: "Data de emissão: 15/03/2024")
+        value, confidence = anchored[0], 0.95
+    elif len(distinct) == 1 and set(key_terms) <= rule.generic_terms:
+        # Único valor do tipo no documento e a chave não pede um qualificador (ex: "cnpj")
+        value, confidence = distinct[0], 0.9
+    else:
+        value, confidence = (anchored or distinct)[0], 0.5
+
+    return {"value": value, "rule": rule.name, "confidence": confidence}
+
+def _typed_value(value: str, template_value):
+    """Convert currency values to numbers when the template expects a number"""
+    if isinstance(template_value, (int, float)) and not isinstance(template_value, bool):
+        try:
+            return float(value.replace(".", "").replace(",", "."))
+        except ValueError:
+            return value
+    return value
+
+def extract_with_rules(text: str, format_template: str) -> dict:
+    """Run the rule engine over the extracted text for a flat JSON object template
+
+    Returns {"answered", "response", "resolved", "unresolved"}; response is the JSON answer
+    when every key was resolved with confidence >= RULES_MIN_CONFIDENCE.
+    """
+    result = {"answered": False, "response": None, "resolved": {}, "unresolved": []}
+    if not RULES_ENABLED or not text or not format_template:
+        return result
+    try:
+        template = json.loads(format_template)
+    except (json.JSONDecodeError, TypeError):
+        return result
+    if not isinstance(template, dict) or not template or any(isinstance(v, (dict, list)) for v in template.values()):
+        return result
+
+    metrics.incr("rules.evaluations")
+    answer = {}
+    for key, template_value in template.items():
+        rule = find_rule(key)
+        resolved = resolve_key(key, text, rule) if rule else None
+        if not resolved or resolved["confidence"] < RULES_MIN_CONFIDENCE:
+            result["unresolved"].append(key)
+            if resolved:
+                result["resolved"][key] = resolved
+            continue
+        result["resolved"][key] = resolved
+        answer[key] = _typed_value(resolved["value"], template_value)
+
+    if not result["unresolved"]:
+        result["answered"] = True
+        result["response"] = json.dumps(answer, ensure_ascii=False)
+        metrics.incr("rules.llm_calls_avoided")
+        logger.info(f"📏 VERBOSE: Rule engine resolved every key ({', '.join(template)}) - skipping LLM")
+    else:
+        logger.info(f"📏 VERBOSE: Rule engine could not resolve {result['unresolved']} - LLM required")
+
+    return result
@@ -0,0 +1,237 @@
+"""
+Escalonamento por custo estimado (shortest-job-first) com prioridades do Celery.
+
+Os documentos eram processados em ordem de chegada (FIFO): um scan de 300
+páginas segurava dezenas de recibos de uma página. No upload o custo do job é
+estimado (páginas, tamanho, tipo do arquivo e modelo) e convertido em uma
+prioridade do Celery (0 = mais urgente, 9 = menos). O header Priority
+(high/normal/low ou 0-9) define a prioridade explicitamente.
+
+Envelhecimento (aging): uma tarefa na fila há mais de SCHEDULER_AGING_SECONDS
+sobe um nível por período. Como uma mensagem já enviada ao broker não muda de
+prioridade, a tarefa é reenviada com a nova prioridade e um novo token de
+despacho; a cópia antiga, ao ser consumida, vê que o token não é mais o atual e
+é descartada (claim_dispatch). Assim nenhum job grande fica parado para sempre
+atrás de um fluxo contínuo de jobs pequenos.
+"""
+import os
+import re
+import json
+import time
+import uuid
+import redis
+from loguru import logger
+from dotenv import load_dotenv
+from redis_client import get_redis
+import metrics
+
+load_dotenv()
+
+# Configuration
+SCHEDULER_ENABLED = os.getenv("SCHEDULER_ENABLED", "true").lower() == "true"
+SCHEDULER_AGING_SECONDS = int(os.getenv("SCHEDULER_AGING_SECONDS", "300"))
+# Custos usados na estimativa (segundos)
+SCHEDULER_OCR_SECONDS_PER_PAGE = float(os.getenv("SCHEDULER_OCR_SECONDS_PER_PAGE", "3.0"))
+SCHEDULER_PARSE_SECONDS_PER_MB = float(os.getenv("SCHEDULER_PARSE_SECONDS_PER_MB", "1.0"))
+SCHEDULER_LLM_SECONDS_PER_BILLION = float(os.getenv("SCHEDULER_LLM_SECONDS_PER_BILLION", "2.0"))
+SCHEDULER_GEMINI_SECONDS = float(os.getenv("SCHEDULER_GEMINI_SECONDS", "3.0"))
+
+# Prioridades do Celery no Redis: 0 é consumida primeiro
+HIGHEST_PRIORITY = 0
+LOWEST_PRIORITY = 9
+PRIORITY_NAMES = {"high": 0, "normal": 5, "low": 9}
+DEFAULT_PRIORITY = PRIORITY_NAMES["normal"]
+# Custo estimado (s) -> prioridade 1..8; 0 e 9 ficam para o header Priority
+COST_PRIORITY_THRESHOLDS = (5, 15, 30, 60, 120, 300, 600)
+# Modelo sem tamanho no nome (ex: "llama3"): considerado de 3B
+DEFAULT_MODEL_BILLIONS = 3.0
+MIN_LLM_SECONDS = 2.0
+
+JOB_KEY_PREFIX = "schedule:job:"
+PENDING_KEY = "schedule:pending"
+JOB_TTL_SECONDS = 86400
+
+def model_billions(model: str) -> float:
+    """Parameter count in billions from the model tag (gemma3:1b -> 1, llama3.2:3b -> 3)"""
+    match = re.search(r"(\d+(?:\.\d+)?)b\b", (model or "").lower())
+    return float(match.group(1)) if match else DEFAULT_MODEL_BILLIONS
+
+def estimate_llm_seconds(model: str, ai_provider: str) -> float:
+    if ai_provider == "gemini":
+        return SCHEDULER_GEMINI_SECONDS
+    return max(MIN_LLM_SECONDS, SCHEDULER_LLM_SECONDS_PER_BILLION * model_billions(model))
+
+def estimate_job_cost(file_type: str, file_size: int, pages: int, model: str, ai_provider: str = "ollama") -> float:
+    """Estimated seconds of work for a document: extraction + LLM"""
+    if file_type.lower() in ("pdf", "jpg", "jpeg", "png"):
+        extraction = SCHEDULER_OCR_SECONDS_PER_PAGE * max(pages, 1)
+    else:
+        extraction = SCHEDULER_PARSE_SECONDS_PER_MB * file_size / (1024 * 1024)
+    return round(extraction + estimate_llm_seconds(model, ai_provider), 2)
+
+def parse_priority(value: str) -> int:
+    """Priority header: high/normal/low or 0-9 (0 = most urgent). Raises ValueError"""
+    value = value.strip().lower()
+    if value in PRIORITY_NAMES:
+        return PRIORITY_NAMES[value]
+    priority = int(value)
+    if not HIGHEST_PRIORITY <= priority <= LOWEST_PRIORITY:
+        raise ValueError(f"priority out of range: {priority}")
+    return priority
+
+def priority_for_cost(cost_seconds: float) -> int:
+    """Shortest job first: cheaper jobs get a more urgent priority (1..8)"""
+    for level, threshold in enumerate(COST_PRIORITY_THRESHOLDS, start=1):
+        if cost_seconds <= threshold:
+            return level
+    return len(COST_PRIORITY_THRESHOLDS) + 1
+
+def plan_job(file_type: str, file_size: int, pages: int, model: str, ai_provider: str = "ollama",
+             requested_priority: int = None) -> dict:
+    """Scheduling entry saved in processing_info: estimated cost and the priority used by every stage"""
+    estimated_seconds = estimate_job_cost(file_type, file_size, pages, model, ai_provider)
+    priority = requested_priority if requested_priority is not None else priority_for_cost(estimated_seconds)
+    return {
+        "estimated_seconds": estimated_seconds,
+        "priority": priority,
+        "requested": requested_priority is not None,
+        "enqueued_at": time.time(),
+    }
+
+def aged_priority(base_priority: int, enqueued_at: float, now: float = None) -> int:
+    """One level more urgent for every SCHEDULER_AGING_SECONDS waited"""
+    waited = max(0.0, (now or time.time()) - enqueued_at)
+    return max(HIGHEST_PRIORITY, base_priority - int(waited // max(SCHEDULER_AGING_SECONDS, 1)))
+
+def _job_key(task_name: str, document_id: int, query_id: int = None) -> str:
+    return f"{JOB_KEY_PREFIX}{task_name}:{document_id}:{query_id or ''}"
+
+def dispatch(task, document_id: int, priority: int, args: tuple = (), kwargs: dict = None,
+             query_id: int = None, queue: str = None, countdown: float = None, enqueued_at: float = None):
+    """Send a pipeline task with a Celery priority, registering it for aging"""
+    kwargs = dict(kwargs or {})
+    options = {"priority": priority}
+    if queue:
+        options["queue"] = queue
+    if countdown:
+        options["countdown"] = countdown
+    if not SCHEDULER_ENABLED:
+        return task.apply_async(args, kwargs, **options)
+
+    dispatch_id = uuid.uuid4().hex
+    key = _job_key(task.name, document_id, query_id)
+    job = {
+        "task": task.name, "args": list(args), "kwargs": kwargs, "queue": queue,
+        "base_priority": priority, "priority": priority, "dispatch_id": dispatch_id, "claimed": False,
+        # Momento a partir do qual a tarefa está na fila (countdown conta a partir do fim da espera)
+        "enqueued_at": enqueued_at or time.time() + (countdown or 0),
+    }
+    try:
+        client = get_redis()
+        pipe = client.pipeline()
+        pipe.set(key, json.dumps(job), ex=JOB_TTL_SECONDS)
+        pipe.zadd(PENDING_KEY, {key: job["enqueued_at"]})
+        pipe.execute()
+        kwargs["dispatch_id"] = dispatch_id
+    except Exception as e:
+        # Sem Redis: envia sem token (a tarefa sempre executa, só não envelhece)
+        logger.debug(f"⚠️ VERBOSE: Could not register job for aging: {e}")
+    return task.apply_async(args, kwargs, **options)
+
+def claim_dispatch(task_name: str, document_id: int, dispatch_id: str, query_id: int = None) -> bool:
+    """Whether this message is the current dispatch of the job (False: stale copy replaced by aging)"""
+    if not dispatch_id:
+        return True
+    key = _job_key(task_name, document_id, query_id)
+    try:
+        with get_redis().pipeline() as pipe:
+            while True:
+                try:
+                    pipe.watch(key)
+                    raw = pipe.get(key)
+                    if raw is None:
+                        # Registro expirado: executa
+                        pipe.unwatch()
+                        return True
+                    job = json.loads(raw)
+                    if job["dispatch_id"] != dispatch_id:
+                        pipe.unwatch()
+                        metrics.incr("scheduler.stale_skipped")
+                        return False
+                    if job["claimed"]:
+                        # Nova tentativa (retry) da mesma mensagem
+                        pipe.unwatch()
+                        return True
+                    job["claimed"] = True
+                    wait_seconds = max(0.0, time.time() - job["enqueued_at"])
+                    pipe.multi()
+                    pipe.set(key, json.dumps(job), ex=JOB_TTL_SECONDS)
+                    pipe.zrem(PENDING_KEY, key)
+                    pipe.execute()
+                    metrics.incr("scheduler.claimed")
+                    metrics.incr("scheduler.wait_seconds", wait_seconds)
+                    return True
+                except redis.WatchError:
+                    continue
+    except Exception as e:
+        logger.debug(f"⚠️ VERBOSE: Could not claim dispatch, running task: {e}")
+        return True
+
+def promote_waiting_jobs(celery_app) -> int:
+    """Re-dispatch queued jobs whose aged priority became more urgent. Returns how many were promoted"""
+    if not SCHEDULER_ENABLED:
+        return 0
+    client = get_redis()
+    now = time.time()
+    promoted = 0
+    # Só quem esperou pelo menos um período pode subir de nível
+    for key in client.zrangebyscore(PENDING_KEY, 0, now - SCHEDULER_AGING_SECONDS):
+        with client.pipeline() as pipe:
+            try:
+                pipe.watch(key)
+                raw = pipe.get(key)
+                if raw is None:
+                    pipe.unwatch()
+                    client.zrem(PENDING_KEY, key)
+                    continue
+                job = json.loads(raw)
+                new_priority = aged_priority(job["base_priority"], job["enqueued_at"], now)
+                if job["claimed"] or new_priority >= job["priority"]:
+                    pipe.unwatch()
+                    continue
+                job["priority"] = new_priority
+                job["dispatch_id"] = uuid.uuid4().hex
+                pipe.multi()
+                pipe.set(key, json.dumps(job), ex=JOB_TTL_SECONDS)
+                pipe.execute()
+            except redis.WatchError:
+                # Consumida (ou promovida) enquanto isso: nada a fazer
+                continue
+        options = {"priority": new_priority}
+        if job["queue"]:
+            options["queue"] = job["queue"]
+        celery_app.send_task(job["task"], args=job["args"], kwargs={**job["kwargs"], "dispatch_id": job["dispatch_id"]}, **options)
+        promoted += 1
+        metrics.incr("scheduler.promotions")
+    if promoted:
+        logger.info(f"⏫ VERBOSE: Promoted {promoted} waiting job(s) by aging")
+    return promoted
+
+def pending_document_ids() -> set:
+    """Document ids with a job waiting in the queue (dispatched and not consumed yet)"""
+    return {int(key.rsplit(":", 2)[1]) for key in get_redis().zrange(PENDING_KEY, 0, -1)}
+
+def get_scheduler_stats() -> dict:
+    """Pending jobs, promotions and average queue wait"""
+    counters = metrics.get_counters("scheduler.")
+    try:
+        pending = get_redis().zcard(PENDING_KEY)
+    except Exception:
+        pending = None
+    return {
+        "pending": pending,
+        "claimed": counters.get("scheduler.claimed", 0),
+        "promotions": counters.get("scheduler.promotions", 0),
+        "stale_skipped": counters.get("scheduler.stale_skipped", 0),
+        "avg_wait_seconds": metrics.rate(counters, "scheduler.wait_seconds", "scheduler.claimed"),
+    }
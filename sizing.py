@@ -0,0 +1,100 @@
+"""
+Dimensionamento de num_ctx e num_predict por requisição.
+
+O tamanho do prompt é estimado a partir do prompt completo (contexto extraído +
+instruções) e o tamanho da resposta a partir do template do Format-Response.
+num_ctx é arredondado para a próxima potência de dois (dentro do limite do
+modelo) para que requisições parecidas usem o mesmo valor e o Ollama não
+precise realocar/recarregar o modelo a cada documento.
+"""
+import os
+import json
+from loguru import logger
+from dotenv import load_dotenv
+from retrieval import estimate_tokens
+
+load_dotenv()
+
+# Configuration
+SIZING_ENABLED = os.getenv("SIZING_ENABLED", "true").lower() == "true"
+OLLAMA_MIN_NUM_CTX = int(os.getenv("OLLAMA_MIN_NUM_CTX", "2048"))
+OLLAMA_MAX_NUM_CTX = int(os.getenv("OLLAMA_MAX_NUM_CTX", "8192"))
+# Limite por modelo, ex: "gemma3:1b=32768,llama3.2:3b=131072"
+OLLAMA_MODEL_CTX_CAPS = os.getenv("OLLAMA_MODEL_CTX_CAPS", "")
+MIN_OUTPUT_TOKENS = int(os.getenv("MIN_OUTPUT_TOKENS", "128"))
+MAX_OUTPUT_TOKENS = int(os.getenv("MAX_OUTPUT_TOKENS", "2048"))
+
+# Respostas sem template (texto livre) mantêm um limite folgado
+FREE_TEXT_OUTPUT_TOKENS = 1024
+# Arrays no template podem ter vários itens na resposta
+ARRAY_ITEMS_ESTIMATE = 10
+
+def parse_model_caps(raw: str) -> dict:
+    """Parse OLLAMA_MODEL_CTX_CAPS ("model=tokens,...")"""
+    caps = {}
+    for item in raw.split(","):
+        if "=" in item:
+            model, tokens = item.rsplit("=", 1)
+            caps[model.strip()] = int(tokens)
+    return caps
+
+MODEL_CTX_CAPS = parse_model_caps(OLLAMA_MODEL_CTX_CAPS)
+
+def get_model_ctx_cap(model: str) -> int:
+    """Context cap for a model: exact name, then base name (without tag), then OLLAMA_MAX_NUM_CTX"""
+    if model in MODEL_CTX_CAPS:
+        return MODEL_CTX_CAPS[model]
+    return MODEL_CTX_CAPS.get(model.split(":")[0], OLLAMA_MAX_NUM_CTX)
+
+def _value_tokens(value) -> int:
+    """Estimate the tokens needed to answer one template value"""
+    if isinstance(value, dict):
+        return sum(estimate_tokens(json.dumps(k)) + _value_tokens(v) + 2 for k, v in value.items()) + 2
+    if isinstance(value, list):
+        item = _value_tokens(value[0]) if value else 16
+        return item * ARRAY_ITEMS_ESTIMATE + 2
+    if isinstance(value, str):
+        # Valores de texto costumam ser maiores que o placeholder do template
+        return max(24, estimate_tokens(value) * 2)
+    return 8
+
+def estimate_output_tokens(format_response: str = None, example: str = None) -> int:
+    """Estimate num_predict / max_output_tokens from the Format-Response template"""
+    if not format_response:
+        return FREE_TEXT_OUTPUT_TOKENS
+
+    try:
+        template = json.loads(format_response)
+        tokens = _value_tokens(template)
+    except (json.JSONDecodeError, TypeError):
+        tokens = estimate_tokens(format_response) * 4
+
+    if example:
+        # O exemplo mostra o tamanho real de uma resposta
+        tokens = max(tokens, estimate_tokens(example) * 2)
+
+    # Margem para espaços/quebras de linha que o modelo adiciona ao JSON
+    tokens = int(tokens * 1.5)
+    return max(MIN_OUTPUT_TOKENS, min(tokens, MAX_OUTPUT_TOKENS))
+
+def size_ollama_request(model: str, full_prompt: str, format_response: str = None, example: str = None) -> dict:
+    """Return the num_ctx / num_predict options for an Ollama request"""
+    prompt_tokens = estimate_tokens(full_prompt)
+    num_predict = estimate_output_tokens(format_response, example)
+    cap = get_model_ctx_cap(model)
+
+    needed = prompt_tokens + num_predict
+    num_ctx = OLLAMA_MIN_NUM_CTX
+    while num_ctx < needed and num_ctx < cap:
+        num_ctx *= 2
+    num_ctx = min(num_ctx, cap)
+
+    if needed > num_ctx:
+        logger.warning(f"⚠️ VERBOSE: Prompt (~{prompt_tokens} tokens) + answer ({num_predict}) exceed the {model} cap of {num_ctx} tokens - context will be truncated")
+
+    return {
+        "num_ctx": num_ctx,
+        "num_predict": num_predict,
+        "estimated_prompt_tokens": prompt_tokens,
+        "ctx_cap": cap,
+    }
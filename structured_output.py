@@ -0,0 +1,91 @@
+"""
+Geração restrita por schema (structured outputs).
+
+O template do Format-Response é convertido em um JSON Schema e enviado ao
+Ollama (parâmetro "format") ou ao Gemini (response_schema). Assim o modelo só
+consegue gerar JSON válido e a formatação vira um único parse validado, sem as
+heurísticas de extração.
+"""
+import os
+import json
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Configuration
+STRUCTURED_OUTPUT_ENABLED = os.getenv("STRUCTURED_OUTPUT_ENABLED", "false").lower() == "true"
+
+def _value_schema(value) -> dict:
+    """JSON Schema for a single template value (the value is the expected shape/description)"""
+    if isinstance(value, bool):
+        return {"type": "boolean"}
+    if isinstance(value, int):
+        return {"type": "integer"}
+    if isinstance(value, float):
+        return {"type": "number"}
+    if isinstance(value, dict):
+        return {
+            "type": "object",
+            "properties": {key: _value_schema(item) for key, item in value.items()},
+            "required": list(value.keys()),
+        }
+    if isinstance(value, list):
+        return {"type": "array", "items": _value_schema(value[0]) if value else {"type": "string"}}
+
+    schema = {"type": "string"}
+    if isinstance(value, str) and value.strip():
+        # O texto do template (ex: "DD/MM/AAAA") orienta o modelo sobre o conteúdo do campo
+        schema["description"] = value.strip()
+    return schema
+
+def template_to_json_schema(format_template: str):
+    """Convert a Format-Response JSON template into a JSON Schema (None if the template is not a JSON object/array)"""
+    if not format_template:
+        return None
+    try:
+        template = json.loads(format_template)
+    except (json.JSONDecodeError, TypeError):
+        return None
+    if not isinstance(template, (dict, list)):
+        return None
+    return _value_schema(template)
+
+def validate_against_schema(value, schema: dict, path: str = "$") -> list:
+    """Validate a parsed value against the schema subset generated above. Returns a list of errors"""
+    expected = schema.get("type")
+    if expected == "object":
+        if not isinstance(value, dict):
+            return [f"{path}: expected object"]
+        errors = [f"{path}.{key}: missing" for key in schema.get("required", []) if key not in value]
+        for key, item_schema in schema.get("properties", {}).items():
+            if key in value:
+                errors += validate_against_schema(value[key], item_schema, f"{path}.{key}")
+        return errors
+    if expected == "array":
+        if not isinstance(value, list):
+            return [f"{path}: expected array"]
+        errors = []
+        for index, item in enumerate(value):
+            errors += validate_against_schema(item, schema.get("items", {}), f"{path}[{index}]")
+        return errors
+    if expected == "string" and not isinstance(value, str):
+        return [f"{path}: expected string"]
+    if expected == "integer" and (not isinstance(value, int) or isinstance(value, bool)):
+        return [f"{path}: expected integer"]
+    if expected == "number" and (not isinstance(value, (int, float)) or isinstance(value, bool)):
+        return [f"{path}: expected number"]
+    if expected == "boolean" and not isinstance(value, bool):
+        return [f"{path}: expected boolean"]
+    return []
+
+def parse_structured_response(llm_response: str, schema: dict) -> str:
+    """Single validated parse of a schema-constrained response. Raises ValueError when invalid"""
+    try:
+        value = json.loads(llm_response)
+    except (json.JSONDecodeError, TypeError) as e:
+        raise ValueError(f"invalid JSON: {e}")
+
+    errors = validate_against_schema(value, schema)
+    if errors:
+        raise ValueError("; ".join(errors[:5]))
+    return json.dumps(value, ensure_ascii=False)
@@ -8,19 +8,45 @@ import openpyxl
 import httpx
 import json
 import io
+import re
+import asyncio
+from functools import lru_cache
 from pathlib import Path
 from loguru import logger
 from dotenv import load_dotenv
 import fitz  # PyMuPDF for PDF to image conversion
+from llm_cache import get_cached_response, store_cached_response
+from redis_client import get_redis
+from structured_output import STRUCTURED_OUTPUT_ENABLED, template_to_json_schema, parse_structured_response
+from sizing import SIZING_ENABLED, size_ollama_request, estimate_output_tokens
+from model_residency import get_keep_alive
+from ollama_health import is_breaker_failure
+from ollama_pool import get_pool
+from admission import admit
+from gemini_client import generate_content as gemini_generate_content, list_models as gemini_list_models
+from errors import PermanentError
+import hashlib
+import metrics
 
 load_dotenv()
 
 # Configuration
 OLLAMA_BASE_URL = os.getenv("OLLAMA_BASE_URL", "http://localhost:11434")
 UPLOAD_DIR = "uploads"
+# Incrementar ao mudar a extração (OCR, zoom, idiomas, parsers): textos gravados com outra versão são extraídos de novo
+EXTRACTOR_VERSION = "1"
 TEMP_DIR = "temp"
+# Zoom da renderização das páginas de PDF para o OCR (2x = 144 DPI)
+OCR_ZOOM = 2.0
 ALLOWED_EXTENSIONS = os.getenv("ALLOWED_EXTENSIONS", "pdf,jpg,jpeg,png,docx,xlsx,xls,doc").split(",")
 MAX_FILE_SIZE = int(os.getenv("MAX_FILE_SIZE", "50")) * 1024 * 1024  # Convert MB to bytes
+PROMPT_LAYOUT = os.getenv("PROMPT_LAYOUT", "standard").lower()  # "standard" ou "prefix_cache"
+OLLAMA_KEEP_ALIVE = os.getenv("OLLAMA_KEEP_ALIVE", "")  # ex: "30m" (vazio = padrão do Ollama)
+OLLAMA_CONTEXT_TTL_SECONDS = int(os.getenv("OLLAMA_CONTEXT_TTL_SECONDS", "1800"))
+# Com prefix_cache o modelo precisa continuar carregado para o cache de prefixo valer
+DEFAULT_OLLAMA_KEEP_ALIVE = OLLAMA_KEEP_ALIVE or ("30m" if PROMPT_LAYOUT == "prefix_cache" else None)
+# Gemini sem texto por bloqueio de conteúdo (erro permanente; os demais motivos são repetidos)
+GEMINI_BLOCKED_FINISH_REASONS = ("SAFETY", "RECITATION", "BLOCKLIST", "PROHIBITED_CONTENT", "SPII", "IMAGE_SAFETY")
 
 # Ensure directories exist
 os.makedirs(UPLOAD_DIR, exist_ok=True)
@@ -42,8 +68,8 @@ def save_uploaded_file(file_content: bytes, filename: str) -> str:
     
     return file_path
 
-def extract_text_from_image(image_path: str) -> str:
-    """Extract text from image using OCR"""
+def extract_text_from_image(image_path: str, zoom: float = OCR_ZOOM) -> str:
+    """Extract text from image using OCR (zoom below OCR_ZOOM downscales the image: faster, less accurate)"""
     try:
         logger.info(f"🖼️ VERBOSE: Starting OCR extraction from image: {image_path}")
         logger.info(f"🖼️ VERBOSE: File exists: {os.path.exists(image_path)}")
@@ -58,6 +84,11 @@ def extract_text_from_image(image_path: str) -> str:
         image = Image.open(image_path)
         logger.info(f"🖼️ VERBOSE: Image opened successfully - size: {image.size}, mode: {image.mode}")
         
+        if zoom < OCR_ZOOM:
+            scale = zoom / OCR_ZOOM
+            image = image.resize((max(1, int(image.width * scale)), max(1, int(image.height * scale))))
+            logger.info(f"🖼️ VERBOSE: Image downscaled to {image.size} for faster OCR")
+        
         text = pytesseract.image_to_string(image, lang='por+eng')
         logger.info(f"🖼️ VERBOSE: OCR completed - extracted {len(text)} characters")
         logger.info(f"🖼️ VERBOSE: OCR preview: {text[:100]}..." if len(text) > 100 else f"🖼️ VERBOSE: OCR result: {text}")
@@ -70,33 +101,31 @@ def extract_text_from_image(image_path: str) -> str:
         logger.error(f"❌ VERBOSE: Exception type: {type(e).__name__}")
         raise
 
-def extract_text_from_pdf(pdf_path: str) -> str:
-    """Extract text from PDF file using Tesseract OCR"""
+def ocr_pdf_pages(pdf_path: str, first_page: int = 0, last_page: int = None,
+                  done_pages: dict = None, on_page=None, zoom: float = OCR_ZOOM) -> list:
+    """OCR the pages first_page..last_page (0-based, inclusive) of a PDF. Returns one text per page
+    
+    done_pages ({page_number: text}) are reused without OCR; on_page(page_number, text) is called after each new page.
+    """
+    texts = []
+    done_pages = done_pages or {}
+    pdf_document = fitz.open(pdf_path)
     try:
-        logger.info(f"📄 VERBOSE: Starting PDF OCR extraction from: {pdf_path}")
-        logger.info(f"📄 VERBOSE: File exists: {os.path.exists(pdf_path)}")
-        
-        if not os.path.exists(pdf_path):
-            raise FileNotFoundError(f"PDF file not found: {pdf_path}")
-        
-        # Verificar tamanho do arquivo
-        file_size = os.path.getsize(pdf_path)
-        logger.info(f"📄 VERBOSE: PDF file size: {file_size} bytes")
-        
-        # Convert PDF to images and apply OCR
-        text = ""
-        pdf_document = fitz.open(pdf_path)
         num_pages = len(pdf_document)
-        logger.info(f"📄 VERBOSE: PDF has {num_pages} pages - converting to images for OCR")
+        last_page = num_pages - 1 if last_page is None else min(last_page, num_pages - 1)
+        logger.info(f"📄 VERBOSE: PDF has {num_pages} pages - converting pages {first_page + 1}-{last_page + 1} to images for OCR")
         
-        for page_num in range(num_pages):
+        for page_num in range(first_page, last_page + 1):
+            if page_num in done_pages:
+                texts.append(done_pages[page_num])
+                continue
             logger.info(f"📄 VERBOSE: Processing page {page_num + 1}/{num_pages}")
             
             # Get the page
             page = pdf_document[page_num]
             
             # Convert page to image (higher resolution for better OCR)
-            mat = fitz.Matrix(2, 2)  # 2x zoom for better quality
+            mat = fitz.Matrix(zoom, zoom)
             pix = page.get_pixmap(matrix=mat)
             
             # Convert to PIL Image
@@ -107,19 +136,57 @@ def extract_text_from_pdf(pdf_path: str) -> str:
             
             # Apply OCR to the image
             page_text = pytesseract.image_to_string(image, lang='por+eng')
-            text += page_text + "\n"
+            texts.append(page_text)
             logger.info(f"📄 VERBOSE: Page {page_num + 1} OCR extracted {len(page_text)} characters")
+            if on_page is not None:
+                on_page(page_num, page_text)
             
             # Clean up
             pix = None
             image.close()
-        
+    finally:
         pdf_document.close()
+    
+    return texts
+
+def extract_pdf_text_layer(pdf_path: str, max_pages: int = None) -> list:
+    """Text embedded in the PDF (no OCR), one text per page"""
+    with fitz.open(pdf_path) as pdf_document:
+        num_pages = len(pdf_document) if max_pages is None else min(max_pages, len(pdf_document))
+        return [pdf_document[page_num].get_text() for page_num in range(num_pages)]
+
+def pdf_has_text_layer(pdf_path: str, sample_pages: int = 3, min_chars: int = 50) -> bool:
+    """Whether the first pages of the PDF carry embedded text (digital PDF, not a scan)"""
+    try:
+        page_texts = extract_pdf_text_layer(pdf_path, sample_pages)
+    except Exception:
+        return False
+    return bool(page_texts) and all(len(text.strip()) >= min_chars for text in page_texts)
+
+def join_page_texts(page_texts: list) -> str:
+    """Join per-page OCR texts into the document text"""
+    return "".join(page_text + "\n" for page_text in page_texts).strip()
+
+def extract_text_from_pdf(pdf_path: str) -> str:
+    """Extract text from PDF file using Tesseract OCR"""
+    try:
+        logger.info(f"📄 VERBOSE: Starting PDF OCR extraction from: {pdf_path}")
+        logger.info(f"📄 VERBOSE: File exists: {os.path.exists(pdf_path)}")
+        
+        if not os.path.exists(pdf_path):
+            raise FileNotFoundError(f"PDF file not found: {pdf_path}")
+        
+        # Verificar tamanho do arquivo
+        file_size = os.path.getsize(pdf_path)
+        logger.info(f"📄 VERBOSE: PDF file size: {file_size} bytes")
+        
+        # Convert PDF to images and apply OCR
+        text = join_page_texts(ocr_pdf_pages(pdf_path))
         
         logger.info(f"📄 VERBOSE: PDF OCR extraction completed - total {len(text)} characters")
         logger.info(f"📄 VERBOSE: PDF preview: {text[:100]}..." if len(text) > 100 else f"📄 VERBOSE: PDF result: {text}")
         
-        result = text.strip()
+        result = text
         logger.info(f"✅ VERBOSE: PDF OCR extraction successful - final length: {len(result)}")
         return result
     except Exception as e:
@@ -225,20 +292,24 @@ def extract_text_from_file(file_path: str, file_type: str) -> str:
         text = extract_text_from_excel(file_path)
     else:
         logger.error(f"❌ VERBOSE: Unsupported file type: {file_type}")
-        raise ValueError(f"Unsupported file type: {file_type}")
+        raise PermanentError(f"Unsupported file type: {file_type}")
     
     logger.info(f"✅ VERBOSE: Text extraction completed. Extracted {len(text)} characters")
     logger.info(f"📄 VERBOSE: Text preview: {text[:300]}..." if len(text) > 300 else f"📄 VERBOSE: Full text: {text}")
     
     return text
 
-async def send_prompt_to_ollama(prompt: str, context: str, model: str, format_response: str = None, example: str = None) -> tuple[str, str]:
-    """Send prompt to Ollama and get response. Returns (llm_response, full_prompt)"""
-    try:
-        # Build enhanced prompt with strict formatting instructions
-        format_instructions = ""
-        if format_response and example:
-            format_instructions = f"""
+def count_document_pages(file_path: str, file_type: str) -> int:
+    """Number of pages to OCR (PDF page count; other formats count as one)"""
+    if file_type.lower() != 'pdf':
+        return 1
+    with fitz.open(file_path) as pdf_document:
+        return len(pdf_document)
+
+def build_format_instructions(format_response: str = None, example: str = None) -> str:
+    """Strict JSON formatting instructions appended after the question"""
+    if format_response and example:
+        return f"""
 
 CRITICAL FORMATTING INSTRUCTIONS:
 - You MUST respond ONLY with the exact JSON format specified below
@@ -251,8 +322,8 @@ Required JSON Format: {format_response}
 Example Response: {example}
 
 Your response must be EXACTLY in this JSON format. No other text is allowed."""
-        elif format_response:
-            format_instructions = f"""
+    elif format_response:
+        return f"""
 
 CRITICAL FORMATTING INSTRUCTIONS:
 - You MUST respond ONLY with the exact JSON format specified below
@@ -263,12 +334,117 @@ CRITICAL FORMATTING INSTRUCTIONS:
 Required JSON Format: {format_response}
 
 Your response must be EXACTLY in this JSON format. No other text is allowed."""
+    return ""
+
+def build_prompt_parts(prompt: str, context: str, format_response: str = None, example: str = None,
+                       layout: str = None) -> tuple[str, str]:
+    """Build the prompt as (prefix, suffix). The full prompt is prefix + suffix.
+    
+    - standard: Context, then question and formatting instructions
+    - prefix_cache: static instructions, then Context, then question and format. The
+      prefix only depends on the document, so follow-up questions share it and can
+      reuse the Ollama KV cache / context tokens.
+    """
+    layout = layout or PROMPT_LAYOUT
+    
+    if layout == "prefix_cache":
+        prefix = f"""You are a document data extraction assistant. Read the document below, then answer the question that follows it.
+Respond ONLY with the JSON format requested in the question. Do not include explanations, introductions, markdown or code blocks.
 
-        full_prompt = f"""Context: {context}
+Context: {context}
 
-Question: {prompt}{format_instructions}
+"""
+        suffix = f"""Question: {prompt}"""
+        if format_response:
+            suffix += f"""
+Required JSON Format: {format_response}"""
+        if example:
+            suffix += f"""
+Example Response: {example}"""
+        suffix += """
+
+Respond ONLY in the specified JSON format, based on the document above."""
+        return prefix, suffix
+    
+    prefix = f"""Context: {context}
+
+"""
+    suffix = f"""Question: {prompt}{build_format_instructions(format_response, example)}
 
 Based on the context provided above, extract the required information and respond ONLY in the specified JSON format. Do not include any explanations or additional text."""
+    return prefix, suffix
+
+async def get_ollama_prefix_context(client: httpx.AsyncClient, model: str, prefix: str, reuse_key: str,
+                                    num_ctx: int = None, base_url: str = OLLAMA_BASE_URL) -> list:
+    """Return the Ollama context tokens for a prompt prefix, evaluating it once per prefix/model/backend"""
+    prefix_hash = hashlib.sha256(f"{prefix}|{num_ctx}".encode("utf-8")).hexdigest()
+    # Chave pelo texto exato do prefixo; os tokens de contexto só valem no backend que os gerou
+    redis_key = f"ollama_context:{base_url}:{model}:{prefix_hash}"
+    
+    try:
+        cached = get_redis().get(redis_key)
+        if cached:
+            logger.info(f"♻️ VERBOSE: Reusing Ollama context tokens for {reuse_key} ({model})")
+            metrics.incr("ollama.context_reuse.hits")
+            return json.loads(cached)
+    except Exception as e:
+        logger.warning(f"⚠️ VERBOSE: Could not read stored Ollama context: {e}")
+        return None
+    
+    # Avalia só o prefixo (instruções + documento), sem instrução extra, uma única vez
+    logger.info(f"🧠 VERBOSE: Priming Ollama context for {reuse_key} ({model})")
+    request_body = {
+        "model": model,
+        "prompt": prefix,
+        "stream": False,
+        # Requisições raw não devolvem context e num_predict 0 não limita a geração: gera 1 token e o descarta abaixo
+        "options": {"temperature": 0.1, "num_predict": 1}
+    }
+    if num_ctx:
+        # Mesmo num_ctx das perguntas - outro valor forçaria recarregar o modelo
+        request_body["options"]["num_ctx"] = num_ctx
+    keep_alive = get_keep_alive(model, DEFAULT_OLLAMA_KEEP_ALIVE)
+    if keep_alive is not None:
+        request_body["keep_alive"] = keep_alive
+    
+    response = await client.post(f"{base_url}/api/generate", json=request_body)
+    response.raise_for_status()
+    result = response.json()
+    prefix_context = result.get("context") or []
+    # O context termina com os tokens gerados: as perguntas continuam direto do prefixo avaliado
+    generated = result.get("eval_count", 0) if result.get("response") else 0
+    if generated:
+        prefix_context = prefix_context[:-generated]
+    if not prefix_context:
+        return None
+    
+    if "prompt_eval_duration" in result:
+        logger.info(f"🧠 VERBOSE: Prefix evaluated: {result.get('prompt_eval_count')} tokens in {result['prompt_eval_duration']/1e9:.2f}s")
+        metrics.incr("ollama.prompt_eval.full.count")
+        metrics.incr("ollama.prompt_eval.full.seconds", result["prompt_eval_duration"] / 1e9)
+    
+    metrics.incr("ollama.context_reuse.primes")
+    try:
+        get_redis().set(redis_key, json.dumps(prefix_context), ex=OLLAMA_CONTEXT_TTL_SECONDS)
+    except Exception as e:
+        logger.warning(f"⚠️ VERBOSE: Could not store Ollama context: {e}")
+    return prefix_context
+
+async def send_prompt_to_ollama(prompt: str, context: str, model: str, format_response: str = None, example: str = None,
+                                use_cache: bool = True, call_info: dict = None, reuse_key: str = None,
+                                exclude_backends: list = None, admitted: asyncio.Event = None) -> tuple[str, str]:
+    """Send prompt to Ollama and get response. Returns (llm_response, full_prompt)
+    
+    call_info (optional dict) is filled with details of the call, e.g. cache hit/miss.
+    reuse_key (e.g. the document id) enables reuse of the evaluated prompt prefix
+    between questions on the same document when PROMPT_LAYOUT=prefix_cache.
+    exclude_backends lists Ollama backend URLs that must not serve this call.
+    admitted (optional event) is set once the call holds its admission slot and backend lease.
+    """
+    try:
+        # Build enhanced prompt with strict formatting instructions
+        prefix, suffix = build_prompt_parts(prompt, context, format_response, example)
+        full_prompt = prefix + suffix
         
         logger.info(f"🤖 VERBOSE: Sending prompt to Ollama model '{model}'")
         logger.info(f"📄 VERBOSE: Context length: {len(context)} characters")
@@ -279,25 +455,80 @@ Based on the context provided above, extract the required information and respon
             logger.info(f"💡 VERBOSE: Example provided: {example}")
         logger.debug(f"📝 VERBOSE: Full prompt: {full_prompt[:500]}..." if len(full_prompt) > 500 else f"📝 VERBOSE: Full prompt: {full_prompt}")
         
-        async with httpx.AsyncClient(timeout=300) as client:
-            logger.info(f"🔗 VERBOSE: Making request to {OLLAMA_BASE_URL}/api/generate")
+        generation_options = {
+            "verbose": True,
+            "temperature": 0.1,  # Lower temperature for more consistent formatting
+            "top_p": 0.9,
+            "repeat_penalty": 1.1
+        }
+        
+        if call_info is None:
+            call_info = {}
+        
+        # num_ctx suficiente para o prompt (até o limite do modelo) e num_predict pelo tamanho do template
+        if SIZING_ENABLED:
+            sizing = size_ollama_request(model, full_prompt, format_response, example)
+            generation_options["num_ctx"] = sizing["num_ctx"]
+            generation_options["num_predict"] = sizing["num_predict"]
+            call_info["sizing"] = sizing
+            logger.info(f"📐 VERBOSE: num_ctx={sizing['num_ctx']} num_predict={sizing['num_predict']} (~{sizing['estimated_prompt_tokens']} prompt tokens)")
+        
+        # Structured outputs: o template vira um JSON Schema e o modelo só pode gerar JSON válido
+        response_schema = template_to_json_schema(format_response) if STRUCTURED_OUTPUT_ENABLED else None
+        cache_options = dict(generation_options, format=response_schema) if response_schema else generation_options
+        
+        call_info["structured_output"] = response_schema is not None
+        call_info["cache"] = "bypass"
+        if use_cache:
+            cached_response = get_cached_response("ollama", model, full_prompt, cache_options)
+            call_info["cache"] = "hit" if cached_response is not None else "miss"
+            if cached_response is not None:
+                return cached_response, full_prompt
+        
+        request_body = {
+            "model": model,
+            "prompt": full_prompt,
+            "stream": False,
+            "options": generation_options
+        }
+        if response_schema:
+            request_body["format"] = response_schema
+            logger.info(f"🧩 VERBOSE: Using structured output (JSON Schema from Format-Response)")
+        keep_alive = get_keep_alive(model, DEFAULT_OLLAMA_KEEP_ALIVE)
+        if keep_alive is not None:
+            # Mantém o modelo carregado (keep_alive por modelo ou padrão)
+            request_body["keep_alive"] = keep_alive
+        
+        # Resposta esperada: normaliza a latência se o Ollama não informar eval_count
+        output_tokens = generation_options.get("num_predict", estimate_output_tokens(format_response, example))
+        
+        backend = None
+        async with admit("ollama", model, output_tokens, call_info) as usage, \
+                get_pool().lease(model, exclude=tuple(exclude_backends or ())) as backend, \
+                httpx.AsyncClient(timeout=300) as client:
+            if admitted is not None:
+                admitted.set()
+            call_info["backend"] = backend.url
+            call_info["context_reused"] = False
+            if reuse_key and PROMPT_LAYOUT == "prefix_cache":
+                prefix_context = await get_ollama_prefix_context(client, model, prefix, reuse_key,
+                                                                 num_ctx=generation_options.get("num_ctx"),
+                                                                 base_url=backend.url)
+                if prefix_context:
+                    # Apenas a pergunta é avaliada - o documento já está nos tokens de contexto
+                    request_body["prompt"] = suffix
+                    request_body["context"] = prefix_context
+                    call_info["context_reused"] = True
+            
+            logger.info(f"🔗 VERBOSE: Making request to {backend.url}/api/generate")
             
             response = await client.post(
-                f"{OLLAMA_BASE_URL}/api/generate",
-                json={
-                    "model": model,
-                    "prompt": full_prompt,
-                    "stream": False,
-                    "options": {
-                        "verbose": True,
-                        "temperature": 0.1,  # Lower temperature for more consistent formatting
-                        "top_p": 0.9,
-                        "repeat_penalty": 1.1
-                    }
-                }
+                f"{backend.url}/api/generate",
+                json=request_body
             )
             response.raise_for_status()
             result = response.json()
+            backend.breaker.record_success()
             
             llm_response = result.get("response", "").strip()
             logger.info(f"✅ VERBOSE: Ollama response received ({len(llm_response)} chars)")
@@ -312,10 +543,35 @@ Based on the context provided above, extract the required information and respon
                 logger.info(f"🔢 VERBOSE: Prompt tokens: {result['prompt_eval_count']}")
             if "eval_count" in result:
                 logger.info(f"📊 VERBOSE: Response tokens: {result['eval_count']}")
+            if "prompt_eval_duration" in result:
+                logger.info(f"⏱️ VERBOSE: Prompt eval duration: {result['prompt_eval_duration']/1e9:.2f}s")
+            
+            for metric_name in ["total_duration", "load_duration", "prompt_eval_duration", "eval_duration"]:
+                if metric_name in result:
+                    call_info[metric_name + "_s"] = round(result[metric_name] / 1e9, 3)
+            for metric_name in ["prompt_eval_count", "eval_count"]:
+                if metric_name in result:
+                    call_info[metric_name] = result[metric_name]
+            # Limitador adaptativo: latência só da geração, por token gerado
+            if result.get("eval_count"):
+                usage["output_tokens"] = result["eval_count"]
+                if result.get("eval_duration"):
+                    usage["decode_seconds"] = result["eval_duration"] / 1e9
+            
+            # prompt_eval_duration de perguntas completas vs. perguntas que reutilizaram o prefixo
+            if "prompt_eval_duration" in result:
+                eval_kind = "followup" if call_info["context_reused"] else "full"
+                metrics.incr(f"ollama.prompt_eval.{eval_kind}.count")
+                metrics.incr(f"ollama.prompt_eval.{eval_kind}.seconds", result["prompt_eval_duration"] / 1e9)
+            
+            if use_cache:
+                store_cached_response("ollama", model, full_prompt, cache_options, llm_response)
             
             return llm_response, full_prompt
     except Exception as e:
         logger.error(f"❌ VERBOSE: Error sending prompt to Ollama: {e}")
+        if backend is not None and is_breaker_failure(e):
+            backend.breaker.record_failure(str(e))
         raise
 
 def format_llm_response(llm_response: str, format_template: str, example: str = None) -> str:
@@ -328,6 +584,19 @@ def format_llm_response(llm_response: str, format_template: str, example: str =
         # Clean the response
         cleaned_response = llm_response.strip()
         
+        # Structured outputs: um único parse validado contra o schema
+        response_schema = template_to_json_schema(format_template) if STRUCTURED_OUTPUT_ENABLED else None
+        parse_mode = "structured" if response_schema else "heuristic"
+        metrics.incr(f"formatter.{parse_mode}.responses")
+        if response_schema:
+            try:
+                extracted_json = parse_structured_response(cleaned_response, response_schema)
+                logger.info(f"✅ VERBOSE: Structured response validated against schema")
+                return extracted_json
+            except ValueError as e:
+                logger.warning(f"⚠️ VERBOSE: Structured response failed validation ({e}) - falling back to extraction")
+                metrics.incr("formatter.structured.parse_failures")
+        
         # Try to extract JSON from the response
         extracted_json = None
         
@@ -338,38 +607,23 @@ def format_llm_response(llm_response: str, format_template: str, example: str =
             logger.info(f"✅ VERBOSE: Entire response is valid JSON")
         except json.JSONDecodeError:
             logger.info(f"🔍 VERBOSE: Response is not entirely JSON, attempting extraction")
+            if not response_schema:
+                metrics.incr("formatter.heuristic.parse_failures")
             
-        # Method 2: Try to find JSON within the response
+        # Method 2: Try to find JSON within the response (single pass, handles nesting)
         if extracted_json is None:
-            import re
-            
-            # Look for JSON array patterns [...]
             if format_template.startswith('[') and format_template.endswith(']'):
-                json_pattern = r'\[.*?\]'
-                json_matches = re.findall(json_pattern, cleaned_response, re.DOTALL)
-                
-                for match in json_matches:
-                    try:
-                        json.loads(match)  # Validate JSON
-                        extracted_json = match
-                        logger.info(f"✅ VERBOSE: Found valid JSON array: {match}")
-                        break
-                    except json.JSONDecodeError:
-                        continue
-            
-            # Look for JSON object patterns {...}
+                expected_type = list
             elif format_template.startswith('{') and format_template.endswith('}'):
-                json_pattern = r'\{.*?\}'
-                json_matches = re.findall(json_pattern, cleaned_response, re.DOTALL)
-                
-                for match in json_matches:
-                    try:
-                        json.loads(match)  # Validate JSON
-                        extracted_json = match
-                        logger.info(f"✅ VERBOSE: Found valid JSON object: {match}")
-                        break
-                    except json.JSONDecodeError:
-                        continue
+                expected_type = dict
+            else:
+                expected_type = None
+            
+            if expected_type is not None:
+                found = find_json_value(cleaned_response, expected_type)
+                if found is not None:
+                    extracted_json = found
+                    logger.info(f"✅ VERBOSE: Found valid JSON {expected_type.__name__}: {found}")
         
         # Method 3: Try to extract specific values based on format template
         if extracted_json is None and format_template:
@@ -380,12 +634,8 @@ def format_llm_response(llm_response: str, format_template: str, example: str =
                 
                 if isinstance(template_obj, list) and len(template_obj) > 0 and isinstance(template_obj[0], dict):
                     # Handle array of objects
-                    extracted_data = []
-                    for key in template_obj[0].keys():
-                        # Try to find values for this key in the response
-                        value = extract_value_from_text(cleaned_response, key)
-                        if value:
-                            extracted_data.append({key: value})
+                    values = extract_template_values(cleaned_response, list(template_obj[0].keys()))
+                    extracted_data = [{key: value} for key, value in values.items()]
                     
                     if extracted_data:
                         extracted_json = json.dumps(extracted_data, ensure_ascii=False)
@@ -393,11 +643,7 @@ def format_llm_response(llm_response: str, format_template: str, example: str =
                 
                 elif isinstance(template_obj, dict):
                     # Handle single object
-                    extracted_data = {}
-                    for key in template_obj.keys():
-                        value = extract_value_from_text(cleaned_response, key)
-                        if value:
-                            extracted_data[key] = value
+                    extracted_data = extract_template_values(cleaned_response, list(template_obj.keys()))
                     
                     if extracted_data:
                         extracted_json = json.dumps(extracted_data, ensure_ascii=False)
@@ -412,11 +658,8 @@ def format_llm_response(llm_response: str, format_template: str, example: str =
             try:
                 example_obj = json.loads(example)
                 if isinstance(example_obj, list) and len(example_obj) > 0 and isinstance(example_obj[0], dict):
-                    extracted_data = []
-                    for key in example_obj[0].keys():
-                        value = extract_value_from_text(cleaned_response, key)
-                        if value:
-                            extracted_data.append({key: value})
+                    values = extract_template_values(cleaned_response, list(example_obj[0].keys()))
+                    extracted_data = [{key: value} for key, value in values.items()]
                     
                     if extracted_data:
                         extracted_json = json.dumps(extracted_data, ensure_ascii=False)
@@ -430,48 +673,113 @@ def format_llm_response(llm_response: str, format_template: str, example: str =
             return extracted_json
         else:
             logger.warning(f"⚠️ VERBOSE: Could not extract valid JSON, returning original response")
+            metrics.incr(f"formatter.{parse_mode}.unrecovered")
             return cleaned_response
             
     except Exception as e:
         logger.error(f"❌ VERBOSE: Error formatting response: {e}")
         return llm_response
 
-def extract_value_from_text(text: str, key: str) -> str:
-    """Extract a value from text based on a key pattern"""
-    import re
+_JSON_DECODER = json.JSONDecoder()
+
+def find_json_value(text: str, expected_type: type = None) -> str:
+    """Return the first JSON value embedded in text (optionally of the expected type) as a string
     
-    # Common patterns to look for
-    patterns = [
-        # Direct patterns
-        rf"{re.escape(key)}:\s*([^\n,}}]+)",
-        rf"{re.escape(key)}\s*:\s*([^\n,}}]+)",
-        rf"{re.escape(key)}\s*=\s*([^\n,}}]+)",
-        
-        # Date patterns (if key suggests it's a date)
-        r"(\d{1,2}[/\-\.]\d{1,2}[/\-\.]\d{2,4})",
-        r"(\d{2,4}[/\-\.]\d{1,2}[/\-\.]\d{1,2})",
-        
-        # CNPJ patterns
-        r"(\d{2}\.\d{3}\.\d{3}/\d{4}-\d{2})",
-        r"(\d{14})",
-        
-        # General number patterns
-        r"(\d+[,\.]\d+)",
-        r"(\d+)",
-    ]
+    Single left-to-right pass: raw_decode is tried only at '{' / '[' positions and the
+    scan resumes after each decoded value. A decoded value of another type is searched
+    for a nested value of the expected type (re-serialized) instead of being re-decoded.
+    """
+    position = 0
+    length = len(text)
+    while position < length:
+        brace = text.find("{", position)
+        bracket = text.find("[", position)
+        candidates = [p for p in (brace, bracket) if p != -1]
+        if not candidates:
+            return None
+        start = min(candidates)
+        try:
+            value, end = _JSON_DECODER.raw_decode(text, start)
+        except json.JSONDecodeError:
+            position = start + 1
+            continue
+        if expected_type is None or isinstance(value, expected_type):
+            return text[start:end]
+        # Valor de outro tipo (ex: array quando se espera objeto): procura dentro dele
+        nested = _find_nested_value(value, expected_type)
+        if nested is not None:
+            return json.dumps(nested, ensure_ascii=False)
+        position = end
+    return None
+
+def _find_nested_value(value, expected_type: type):
+    """First value of the expected type inside a decoded JSON value, in document order"""
+    children = value.values() if isinstance(value, dict) else value if isinstance(value, list) else ()
+    for child in children:
+        if isinstance(child, expected_type):
+            return child
+        found = _find_nested_value(child, expected_type)
+        if found is not None:
+            return found
+    return None
+
+# Padrões genéricos usados quando a chave não aparece no texto (datas, CNPJ, números)
+_FALLBACK_VALUE_PATTERNS = [
+    re.compile(r"(\d{1,2}[/\-\.]\d{1,2}[/\-\.]\d{2,4})"),
+    re.compile(r"(\d{2,4}[/\-\.]\d{1,2}[/\-\.]\d{1,2})"),
+    re.compile(r"(\d{2}\.\d{3}\.\d{3}/\d{4}-\d{2})"),
+    re.compile(r"(\d{14})"),
+    re.compile(r"(\d+[,\.]\d+)"),
+    re.compile(r"(\d+)"),
+]
+
+@lru_cache(maxsize=256)
+def _key_value_matcher(keys: tuple) -> re.Pattern:
+    """One compiled pattern matching 'key: value' / 'key = value' for all template keys"""
+    alternatives = "|".join(re.escape(key) for key in sorted(keys, key=len, reverse=True))
+    return re.compile(rf"""["']?({alternatives})["']?\s*[:=]\s*([^\n,}}]+)""", re.IGNORECASE)
+
+def _clean_extracted_value(value: str) -> str:
+    value = value.strip().strip("\"'").strip()
+    return re.sub(r'[,;\.]+$', '', value)
+
+def extract_template_values(text: str, keys: list) -> dict:
+    """Extract a value for each template key with a single scan of the text"""
+    if not keys:
+        return {}
     
-    # Try each pattern
-    for pattern in patterns:
-        matches = re.findall(pattern, text, re.IGNORECASE)
-        if matches:
-            # Clean and return the first match
-            value = matches[0].strip()
-            # Remove common trailing characters
-            value = re.sub(r'[,;\.]+$', '', value)
-            if value:
-                return value
+    keys_by_lower = {key.lower(): key for key in keys}
+    values = {}
+    for match in _key_value_matcher(tuple(keys_by_lower.values())).finditer(text):
+        key = keys_by_lower.get(match.group(1).lower())
+        if key in values:
+            continue
+        value = _clean_extracted_value(match.group(2))
+        if value:
+            values[key] = value
+        if len(values) == len(keys_by_lower):
+            break
     
-    return None
+    missing = [key for key in keys_by_lower.values() if key not in values]
+    if missing:
+        # Chaves sem rótulo no texto: primeiro valor genérico encontrado (calculado uma única vez)
+        fallback = None
+        for pattern in _FALLBACK_VALUE_PATTERNS:
+            match = pattern.search(text)
+            if match:
+                fallback = _clean_extracted_value(match.group(1))
+                if fallback:
+                    break
+        if fallback:
+            for key in missing:
+                values[key] = fallback
+    
+    # Mantém a ordem das chaves do template
+    return {key: values[key] for key in keys_by_lower.values() if key in values}
+
+def extract_value_from_text(text: str, key: str) -> str:
+    """Extract a value from text based on a key pattern"""
+    return extract_template_values(text, [key]).get(key)
 
 def cleanup_old_files():
     """Clean up old uploaded files and temporary files"""
@@ -505,11 +813,28 @@ def validate_file_size(file_size: int) -> bool:
     """Validate file size"""
     return file_size <= MAX_FILE_SIZE 
 
-async def send_prompt_to_gemini(prompt: str, context: str, model: str, gemini_api_key: str, format_response: str = None, example: str = None) -> tuple[str, str]:
-    """Send prompt to Google Gemini API and get response. Returns (llm_response, full_prompt)"""
+def gemini_response_text(response) -> str:
+    """Text of a Gemini response. Raises when the model finished without text"""
+    if response.text:
+        return response.text.strip()
+    
+    candidates = getattr(response, "candidates", None) or []
+    finish_reason = getattr(candidates[0], "finish_reason", None) if candidates else None
+    block_reason = getattr(getattr(response, "prompt_feedback", None), "block_reason", None)
+    reason = getattr(finish_reason or block_reason, "name", None) or str(finish_reason or block_reason or "empty response")
+    if block_reason or reason in GEMINI_BLOCKED_FINISH_REASONS:
+        # Bloqueio de conteúdo: a mesma requisição seria bloqueada de novo
+        raise PermanentError(f"Gemini returned no text (blocked: {reason})")
+    # MAX_TOKENS ou resposta vazia: nova tentativa pela política de erros
+    raise RuntimeError(f"Gemini returned no text (finish reason: {reason})")
+
+async def send_prompt_to_gemini(prompt: str, context: str, model: str, gemini_api_key: str, format_response: str = None, example: str = None,
+                                use_cache: bool = True, call_info: dict = None) -> tuple[str, str]:
+    """Send prompt to Google Gemini API and get response. Returns (llm_response, full_prompt)
+    
+    call_info (optional dict) is filled with details of the call, e.g. cache hit/miss.
+    """
     try:
-        from google import genai
-        
         logger.info(f"🤖 VERBOSE: Sending prompt to Google Gemini model '{model}'")
         logger.info(f"📄 VERBOSE: Context length: {len(context)} characters")
         logger.info(f"❓ VERBOSE: Prompt: {prompt}")
@@ -519,61 +844,52 @@ async def send_prompt_to_gemini(prompt: str, context: str, model: str, gemini_ap
             logger.info(f"💡 VERBOSE: Example provided: {example}")
         
         # Build enhanced prompt with strict formatting instructions
-        format_instructions = ""
-        if format_response and example:
-            format_instructions = f"""
-
-CRITICAL FORMATTING INSTRUCTIONS:
-- You MUST respond ONLY with the exact JSON format specified below
-- DO NOT include any explanations, introductions, or additional text
-- DO NOT use markdown formatting or code blocks
-- Respond with ONLY the JSON structure, nothing else
-- Follow the exact pattern shown in the example
-
-Required JSON Format: {format_response}
-Example Response: {example}
-
-Your response must be EXACTLY in this JSON format. No other text is allowed."""
-        elif format_response:
-            format_instructions = f"""
-
-CRITICAL FORMATTING INSTRUCTIONS:
-- You MUST respond ONLY with the exact JSON format specified below
-- DO NOT include any explanations, introductions, or additional text
-- DO NOT use markdown formatting or code blocks
-- Respond with ONLY the JSON structure, nothing else
-
-Required JSON Format: {format_response}
-
-Your response must be EXACTLY in this JSON format. No other text is allowed."""
-
-        full_prompt = f"""Context: {context}
-
-Question: {prompt}{format_instructions}
-
-Based on the context provided above, extract the required information and respond ONLY in the specified JSON format. Do not include any explanations or additional text."""
-        
-        # Create Gemini client
-        client = genai.Client(api_key=gemini_api_key)
+        prefix, suffix = build_prompt_parts(prompt, context, format_response, example)
+        full_prompt = prefix + suffix
+        
+        # Sem max_output_tokens: nos modelos 2.5 o raciocínio conta no limite e um teto pelo template
+        # terminava em MAX_TOKENS sem texto nenhum
+        generation_config = {
+            'temperature': 0.1,  # Lower temperature for more consistent formatting
+            'top_p': 0.9,
+        }
+        
+        response_schema = template_to_json_schema(format_response) if STRUCTURED_OUTPUT_ENABLED else None
+        if response_schema:
+            generation_config['response_mime_type'] = 'application/json'
+            generation_config['response_schema'] = response_schema
+            logger.info(f"🧩 VERBOSE: Using structured output (JSON Schema from Format-Response)")
+        
+        if call_info is None:
+            call_info = {}
+        call_info["structured_output"] = response_schema is not None
+        call_info["cache"] = "bypass"
+        if use_cache:
+            cached_response = get_cached_response("gemini", model, full_prompt, generation_config)
+            call_info["cache"] = "hit" if cached_response is not None else "miss"
+            if cached_response is not None:
+                return cached_response, full_prompt
         
         logger.info(f"🔗 VERBOSE: Making request to Google Gemini API")
         logger.debug(f"📝 VERBOSE: Full prompt: {full_prompt[:500]}..." if len(full_prompt) > 500 else f"📝 VERBOSE: Full prompt: {full_prompt}")
         
-        # Send request to Gemini
-        response = client.models.generate_content(
-            model=model,
-            contents=full_prompt,
-            config={
-                'temperature': 0.1,  # Lower temperature for more consistent formatting
-                'top_p': 0.9,
-                'max_output_tokens': 2048,
-            }
+        # Send request to Gemini (cliente compartilhado, chamada assíncrona com novas tentativas)
+        response = await gemini_generate_content(
+            gemini_api_key,
+            model,
+            full_prompt,
+            generation_config,
+            output_tokens=estimate_output_tokens(format_response, example),
+            call_info=call_info
         )
         
-        gemini_response = response.text.strip()
+        gemini_response = gemini_response_text(response)
         logger.info(f"✅ VERBOSE: Gemini response received ({len(gemini_response)} chars)")
         logger.info(f"💬 VERBOSE: Response preview: {gemini_response[:200]}..." if len(gemini_response) > 200 else f"💬 VERBOSE: Full response: {gemini_response}")
         
+        if use_cache:
+            store_cached_response("gemini", model, full_prompt, generation_config, gemini_response)
+        
         return gemini_response, full_prompt
         
     except Exception as e:
@@ -583,96 +899,71 @@ Based on the context provided above, extract the required information and respon
 async def list_gemini_models(gemini_api_key: str) -> dict:
     """List available Google Gemini models dynamically from API"""
     try:
-        import httpx
-        
         logger.info(f"🌟 VERBOSE: Fetching available Gemini models from API")
         
-        # Call Google Gemini API to list models
-        url = f"https://generativelanguage.googleapis.com/v1beta/models?key={gemini_api_key}"
+        # Cliente compartilhado; a lista fica em cache (GEMINI_MODELS_CACHE_SECONDS)
+        models = list(await gemini_list_models(gemini_api_key))
+        
+        # Sort models by preference (newer versions first)
+        models.sort(key=lambda x: (
+            '2.5' in x['name'],  # 2.5 first
+            '2.0' in x['name'],  # then 2.0
+            '1.5' in x['name'],  # then 1.5
+            'flash' in x['name']  # flash variants first
+        ), reverse=True)
+        
+        logger.info(f"✅ VERBOSE: Successfully fetched {len(models)} Gemini models")
+        return {
+            'status': 'success',
+            'models': models,
+            'total_models': len(models),
+            'recommended_model': models[0]['name'] if models else 'gemini-2.0-flash'
+        }
         
-        async with httpx.AsyncClient() as client:
-            response = await client.get(url)
-            
-            if response.status_code == 200:
-                data = response.json()
-                models = []
-                
-                # Filter only generation models and extract relevant info
-                for model in data.get('models', []):
-                    model_name = model.get('name', '').replace('models/', '')
-                    
-                    # Only include generation models that support generateContent
-                    supported_methods = model.get('supportedGenerationMethods', [])
-                    if 'generateContent' in supported_methods:
-                        # Extract description and create clean model info
-                        description = model.get('description', '').split('.')[0]  # First sentence only
-                        
-                        models.append({
-                            'name': model_name,
-                            'description': description,
-                            'version': model.get('version', 'latest'),
-                            'input_token_limit': model.get('inputTokenLimit', 'unknown'),
-                            'output_token_limit': model.get('outputTokenLimit', 'unknown')
-                        })
-                
-                # Sort models by preference (newer versions first)
-                models.sort(key=lambda x: (
-                    '2.5' in x['name'],  # 2.5 first
-                    '2.0' in x['name'],  # then 2.0
-                    '1.5' in x['name'],  # then 1.5
-                    'flash' in x['name']  # flash variants first
-                ), reverse=True)
-                
-                logger.info(f"✅ VERBOSE: Successfully fetched {len(models)} Gemini models")
-                return {
-                    'status': 'success',
-                    'models': models,
-                    'total_models': len(models),
-                    'recommended_model': models[0]['name'] if models else 'gemini-2.0-flash'
-                }
-            else:
-                logger.error(f"❌ VERBOSE: Failed to fetch Gemini models. Status: {response.status_code}")
-                logger.error(f"❌ VERBOSE: Response: {response.text}")
-                return {
-                    'status': 'error',
-                    'message': f'Failed to fetch models from Gemini API: {response.status_code}',
-                    'fallback_models': [
-                        {
-                            'name': 'gemini-2.0-flash',
-                            'description': 'Latest multimodal model with next generation features',
-                            'version': 'latest',
-                            'size': None,
-                            'modified': None,
-                            'status': 'available'
-                        },
-                        {
-                            'name': 'gemini-2.5-pro-preview', 
-                            'description': 'Most powerful thinking model with enhanced reasoning',
-                            'version': 'preview',
-                            'size': None,
-                            'modified': None,
-                            'status': 'available'
-                        },
-                        {
-                            'name': 'gemini-1.5-pro',
-                            'description': 'Advanced model for complex reasoning tasks', 
-                            'version': 'stable',
-                            'size': None,
-                            'modified': None,
-                            'status': 'available'
-                        },
-                        {
-                            'name': 'gemini-1.5-flash',
-                            'description': 'Fast and versatile performance model',
-                            'version': 'stable',
-                            'size': None,
-                            'modified': None,
-                            'status': 'available'
-                        }
-                    ]
-                }
-                
     except Exception as e:
+        status_code = getattr(e, "code", None)
+        if isinstance(status_code, int):
+            logger.error(f"❌ VERBOSE: Failed to fetch Gemini models. Status: {status_code}")
+            logger.error(f"❌ VERBOSE: Response: {e}")
+            return {
+                'status': 'error',
+                'message': f'Failed to fetch models from Gemini API: {status_code}',
+                'fallback_models': [
+                    {
+                        'name': 'gemini-2.0-flash',
+                        'description': 'Latest multimodal model with next generation features',
+                        'version': 'latest',
+                        'size': None,
+                        'modified': None,
+                        'status': 'available'
+                    },
+                    {
+                        'name': 'gemini-2.5-pro-preview', 
+                        'description': 'Most powerful thinking model with enhanced reasoning',
+                        'version': 'preview',
+                        'size': None,
+                        'modified': None,
+                        'status': 'available'
+                    },
+                    {
+                        'name': 'gemini-1.5-pro',
+                        'description': 'Advanced model for complex reasoning tasks', 
+                        'version': 'stable',
+                        'size': None,
+                        'modified': None,
+                        'status': 'available'
+                    },
+                    {
+                        'name': 'gemini-1.5-flash',
+                        'description': 'Fast and versatile performance model',
+                        'version': 'stable',
+                        'size': None,
+                        'modified': None,
+                        'status': 'available'
+                    }
+                ]
+            }
+
         logger.error(f"❌ VERBOSE: Error fetching Gemini models: {str(e)}")
         return {
             'status': 'error',
@@ -1,18 +1,55 @@
-from celery import Celery
+from celery import Celery, chord
+from kombu import Queue
+from sqlalchemy import func
 from sqlalchemy.orm import Session
 from database import SessionLocal, init_database_sync
-from models import Document, DocumentStatus
-from utils import extract_text_from_file, send_prompt_to_ollama, send_prompt_to_gemini, format_llm_response, cleanup_old_files, list_gemini_models
+from models import Document, DocumentQuery, DocumentPage, DocumentStatus
+from utils import extract_text_from_file, send_prompt_to_gemini, format_llm_response, cleanup_old_files, list_gemini_models, count_document_pages, ocr_pdf_pages, join_page_texts, extract_text_from_image, extract_pdf_text_layer, EXTRACTOR_VERSION, OCR_ZOOM, PROMPT_LAYOUT, DEFAULT_OLLAMA_KEEP_ALIVE
+from retrieval import select_relevant_context, RETRIEVAL_TOKEN_BUDGET
+from questions import load_questions, summarize_questions, build_packed_request, format_question_responses
+from rules import extract_with_rules
+from model_residency import preload_models, mark_pending, mark_started, should_defer_for_model, MODEL_SWAP_DEFER_SECONDS
+from ollama_health import start_health_monitor, OllamaUnavailableError, OLLAMA_FALLBACK_PROVIDER, OLLAMA_FALLBACK_MODEL
+from errors import PermanentError, PERMANENT, classify_error, max_retries_for, retry_countdown
+from hedging import generate_with_policy
+from deadline import record_ocr_page
+from progressive import EXTRACTION_MODE, PROGRESSIVE_FIRST_PAGES, PROGRESSIVE_MAX_LLM_PROBES, PARTIAL_TEXT_INSTRUCTION, flat_template_keys, page_batches, confident_answer
+from coalescing import release_leadership
+from scheduling import dispatch, claim_dispatch, aged_priority, promote_waiting_jobs, pending_document_ids, DEFAULT_PRIORITY, SCHEDULER_AGING_SECONDS
+from reaper import REAPER_ENABLED, REAPER_INTERVAL_SECONDS, REAPER_MAX_REQUEUES, is_overdue, overdue_cutoff, last_status_change, live_task_document_ids
+from ollama_pool import get_pool
+from celery.signals import worker_ready
+import metrics
 from loguru import logger
 import os
 from datetime import datetime
 from dotenv import load_dotenv
 import asyncio
+import json
+import time
+import threading
 
 load_dotenv()
 
 # Configuration
-OLLAMA_BASE_URL = os.getenv("OLLAMA_BASE_URL", "http://localhost:11434")
+GEMINI_API_KEY = os.getenv("GEMINI_API_KEY", "")
+# "fused" (uma tarefa para todas as etapas), "chained" (uma tarefa por etapa) ou "auto" (fused para documentos pequenos)
+PIPELINE_MODE = os.getenv("PIPELINE_MODE", "auto").lower()
+PIPELINE_FUSED_MAX_KB = int(os.getenv("PIPELINE_FUSED_MAX_KB", "2048"))
+PIPELINE_FUSED_MAX_PAGES = int(os.getenv("PIPELINE_FUSED_MAX_PAGES", "5"))
+
+PIPELINE_MODES = ("auto", "fused", "chained")
+# Filas separadas: OCR (CPU, pool prefork) e LLM/formatação (I/O, pool de threads)
+CELERY_OCR_QUEUE = os.getenv("CELERY_OCR_QUEUE", "ocr")
+CELERY_LLM_QUEUE = os.getenv("CELERY_LLM_QUEUE", "llm")
+
+# Tipos extraídos por OCR (Tesseract); DOCX/Excel são só parsing e vão para a fila de I/O
+OCR_FILE_TYPES = ("pdf", "jpg", "jpeg", "png")
+
+# PDFs longos: OCR dividido em faixas de páginas distribuídas entre todos os workers (chord)
+OCR_FANOUT_ENABLED = os.getenv("OCR_FANOUT_ENABLED", "true").lower() == "true"
+OCR_FANOUT_MIN_PAGES = int(os.getenv("OCR_FANOUT_MIN_PAGES", "16"))
+OCR_FANOUT_PAGES_PER_TASK = int(os.getenv("OCR_FANOUT_PAGES_PER_TASK", "4"))
 
 # Initialize database
 init_database_sync()
@@ -34,70 +71,493 @@ celery_app.conf.update(
     worker_prefetch_multiplier=1,
     task_acks_late=True,
     worker_max_tasks_per_child=1000,
+    # Worker sem -Q consome as duas filas (layout antigo de um único worker continua funcionando)
+    task_queues=(Queue(CELERY_OCR_QUEUE), Queue(CELERY_LLM_QUEUE)),
+    task_default_queue=CELERY_LLM_QUEUE,
+    # Prioridades no Redis (0 = mais urgente): uma lista por nível, consumidas em ordem
+    broker_transport_options={"priority_steps": list(range(10)), "sep": ":", "queue_order_strategy": "priority"},
+    task_default_priority=DEFAULT_PRIORITY,
+    task_routes={
+        'workers.extract_text_task': {'queue': CELERY_OCR_QUEUE},
+        'workers.ocr_page_range_task': {'queue': CELERY_OCR_QUEUE},
+        'workers.merge_ocr_pages_task': {'queue': CELERY_LLM_QUEUE},
+        'workers.process_prompt_task': {'queue': CELERY_LLM_QUEUE},
+        'workers.format_response_task': {'queue': CELERY_LLM_QUEUE},
+        # Pipeline fused: fila padrão para DOCX/Excel; PDFs e imagens vão para a fila de OCR no despacho
+        'workers.process_document_task': {'queue': CELERY_LLM_QUEUE},
+        'workers.cleanup_task': {'queue': CELERY_LLM_QUEUE},
+        'workers.promote_jobs_task': {'queue': CELERY_LLM_QUEUE},
+        'workers.reap_stuck_documents_task': {'queue': CELERY_LLM_QUEUE},
+    },
 )
 
+def delivery_queue(task) -> str:
+    """Queue the current message of a bound task was delivered from"""
+    return (task.request.delivery_info or {}).get("routing_key")
+
+def consumes_queue(queue: str) -> bool:
+    """Whether this worker process consumes the given queue (-Q option; all queues without it)"""
+    consume_from = celery_app.amqp.queues.consume_from
+    return not consume_from or queue in consume_from
+
+@worker_ready.connect
+def on_worker_ready(**kwargs):
+    """Load the configured Ollama models as soon as the worker starts (avoids cold starts)"""
+    if not consumes_queue(CELERY_LLM_QUEUE):
+        # Worker só de OCR não chama a LLM
+        return
+    start_health_monitor()
+    preload_models(default_keep_alive=DEFAULT_OLLAMA_KEEP_ALIVE)
+
+_thread_state = threading.local()
+
+def get_event_loop() -> asyncio.AbstractEventLoop:
+    """Event loop reused by every task of this worker thread
+    
+    Um loop novo por tarefa invalidava os clientes assíncronos compartilhados
+    (ex: cliente Gemini) e suas conexões a cada documento.
+    """
+    loop = getattr(_thread_state, "loop", None)
+    if loop is None or loop.is_closed():
+        loop = asyncio.new_event_loop()
+        _thread_state.loop = loop
+    asyncio.set_event_loop(loop)
+    return loop
+
+def choose_pipeline_mode(file_path: str, file_type: str, requested: str = None) -> str:
+    """Fused pipeline for small documents, chained stages for long ones"""
+    mode = (requested or PIPELINE_MODE).lower()
+    if mode in ("fused", "chained"):
+        return mode
+    try:
+        if os.path.getsize(file_path) > PIPELINE_FUSED_MAX_KB * 1024:
+            return "chained"
+        if count_document_pages(file_path, file_type) > PIPELINE_FUSED_MAX_PAGES:
+            return "chained"
+    except Exception:
+        # Arquivo ausente ou corrompido (ex: fitz.FileDataError): a extração encadeada reporta o erro
+        return "chained"
+    return "fused"
+
+def extraction_queue(file_type: str) -> str:
+    """Queue for the extraction stage: OCR work goes to the CPU queue, plain parsing does not wait behind it"""
+    return CELERY_OCR_QUEUE if file_type.lower() in OCR_FILE_TYPES else CELERY_LLM_QUEUE
+
+def start_document_pipeline(document_id: int, file_path: str, file_type: str, requested_mode: str = None,
+                            priority: int = DEFAULT_PRIORITY) -> str:
+    """Enqueue the processing of an uploaded document. Returns the pipeline mode used"""
+    mode = choose_pipeline_mode(file_path, file_type, requested_mode)
+    if mode == "fused":
+        # Com OCR, o fused começa no pool prefork (Tesseract em threads do worker de LLM competiria com as chamadas)
+        # e passa LLM e formatação para a fila llm depois da extração
+        dispatch(process_document_task, document_id, priority, args=(document_id,), queue=extraction_queue(file_type))
+    else:
+        dispatch(extract_text_task, document_id, priority, args=(document_id,), queue=extraction_queue(file_type))
+    logger.info(f"🚀 VERBOSE: Document {document_id} queued in {mode} pipeline mode (priority {priority})")
+    return mode
+
+def stage_priority(target) -> int:
+    """Priority of the next stage: the upload priority, aged by the time since the upload"""
+    scheduling_info = target.get_processing_info().get("scheduling")
+    if not scheduling_info:
+        return DEFAULT_PRIORITY
+    return aged_priority(scheduling_info["priority"], scheduling_info["enqueued_at"])
+
+def enqueue_prompt_task(document_id: int, model: str, ai_provider: str, query_id: int = None, countdown: int = None,
+                        model_deferrals: int = 0, priority: int = DEFAULT_PRIORITY):
+    """Enqueue the LLM stage, registering the queued work under its Ollama model"""
+    if ai_provider != "gemini":
+        mark_pending(model, f"{document_id}:{query_id or ''}")
+    dispatch(process_prompt_task, document_id, priority, args=(document_id,),
+             kwargs={"query_id": query_id, "model_deferrals": model_deferrals},
+             query_id=query_id, countdown=countdown)
+
+def enqueue_format_task(document_id: int, target, query_id: int = None):
+    """Enqueue the formatting stage with the aged priority of the target"""
+    dispatch(format_response_task, document_id, stage_priority(target), args=(document_id,),
+             kwargs={"query_id": query_id}, query_id=query_id)
+
+def skip_stale_dispatch(task, document_id: int, dispatch_id: str, query_id: int = None):
+    """Result for a message replaced by a promoted copy (aging), or None when it should run"""
+    if claim_dispatch(task.name, document_id, dispatch_id, query_id):
+        return None
+    logger.info(f"⏭️ VERBOSE: Skipping stale {task.name} message for document {document_id} (re-dispatched with a higher priority)")
+    return {"status": "skipped", "document_id": document_id, "query_id": query_id, "reason": "stale dispatch"}
+
+def handle_task_failure(task, db: Session, target, error: Exception, stage: str):
+    """Retry the task with the policy of the error class, or mark the target as failed. Always raises"""
+    error_class = classify_error(error)
+    max_retries = max_retries_for(error_class)
+    attempt = task.request.retries
+    metrics.incr(f"errors.{error_class}")
+    retrying = attempt < max_retries
+    countdown = retry_countdown(error_class, attempt, getattr(error, "retry_after", None)) if retrying else None
+    
+    # Durante as novas tentativas o status fica RETRYING (ERROR só quando desistir)
+    try:
+        db.rollback()
+        if target is not None:
+            target.status = DocumentStatus.RETRYING if retrying else DocumentStatus.ERROR
+            target.error_message = f"[{error_class}] retry {attempt + 1}/{max_retries} in {countdown}s: {error}" if retrying else str(error)
+            target.updated_at = datetime.utcnow()
+            db.commit()
+            if not retrying:
+                release_followers(db, target)
+    except Exception as db_error:
+        logger.error(f"❌ VERBOSE: Failed to save error status: {db_error}")
+    
+    if retrying:
+        logger.info(f"🔄 VERBOSE: Retrying {stage} in {countdown}s ({error_class} error, attempt {attempt + 1}/{max_retries})")
+        raise task.retry(exc=error, countdown=countdown, max_retries=max_retries)
+    
+    if error_class == PERMANENT:
+        logger.error(f"⛔ VERBOSE: Permanent error in {stage} - not retrying: {error}")
+    else:
+        logger.error(f"❌ VERBOSE: Giving up {stage} after {attempt} retries ({error_class} error)")
+    raise error
+
 @celery_app.task(bind=True, max_retries=3)
-def extract_text_task(self, document_id: int):
+def extract_text_task(self, document_id: int, dispatch_id: str = None):
     """Extract text from uploaded file"""
+    stale = skip_stale_dispatch(self, document_id, dispatch_id)
+    if stale:
+        return stale
     db = SessionLocal()
     try:
         # Get document from database
         document = db.query(Document).filter(Document.id == document_id).first()
         if not document:
-            raise Exception(f"Document with id {document_id} not found")
-        
-        logger.info(f"🔍 VERBOSE: Starting text extraction for document {document_id}")
-        logger.info(f"📁 VERBOSE: File path: {document.file_path}")
-        logger.info(f"📄 VERBOSE: File type: {document.file_type}")
-        logger.info(f"📝 VERBOSE: Filename: {document.filename}")
+            raise PermanentError(f"Document with id {document_id} not found")
         
-        # Verificar se o arquivo existe
-        if not document.file_path or not os.path.exists(document.file_path):
-            error_msg = f"File not found: {document.file_path}"
-            logger.error(f"❌ VERBOSE: {error_msg}")
-            raise Exception(error_msg)
+        document.set_processing_info("pipeline", {"mode": "chained"})
         
-        logger.info(f"✅ VERBOSE: File exists, proceeding with extraction")
+        if is_completed(document):
+            logger.info(f"♻️ VERBOSE: Document {document_id} already completed - nothing to do")
+            return {"status": "success", "document_id": document_id, "resumed": True}
         
-        # Extract text from file
-        extracted_text = extract_text_from_file(document.file_path, document.file_type)
+        # Checkpoint: texto já extraído com a versão atual do extrator (nova tentativa ou entrega repetida)
+        if has_current_extraction(document):
+            logger.info(f"♻️ VERBOSE: Document {document_id} already extracted (extractor v{EXTRACTOR_VERSION}) - skipping to prompt")
+            llm_skipped = continue_after_extraction(db, document, document.extracted_text)
+            return {"status": "success", "document_id": document_id, "resumed": True, "llm_skipped": llm_skipped}
         
-        # Verificação crítica do texto extraído
-        logger.info(f"🔍 VERBOSE: Extracted text length: {len(extracted_text) if extracted_text else 0}")
-        logger.info(f"🔍 VERBOSE: Extracted text preview: {extracted_text[:200] if extracted_text else 'None'}...")
+        # Extração progressiva: responde assim que as primeiras páginas bastarem
+        if uses_progressive_extraction(document):
+            extracted_text, answered_by = run_progressive_extraction(db, document)
+            if answered_by == "llm":
+                enqueue_format_task(document_id, document)
+            llm_skipped = answered_by == "rules" or (answered_by is None and continue_after_extraction(db, document, extracted_text))
+            return {"status": "success", "document_id": document_id, "answered_by": answered_by, "llm_skipped": llm_skipped}
         
-        # Verificar se o texto foi realmente extraído
-        if not extracted_text or not extracted_text.strip():
-            logger.warning(f"⚠️ VERBOSE: No text extracted from file: {document.file_path}")
-            logger.warning(f"⚠️ VERBOSE: File type: {document.file_type}")
-            logger.warning(f"⚠️ VERBOSE: File exists: {os.path.exists(document.file_path) if document.file_path else False}")
-            # Definir texto padrão para evitar problemas
-            extracted_text = f"[ERRO: Não foi possível extrair texto do arquivo {document.filename}]"
+        # PDF longo: OCR das faixas de páginas em paralelo; merge_ocr_pages_task continua o pipeline
+        if start_ocr_fanout(db, document):
+            return {"status": "success", "document_id": document_id, "fanout": True}
         
-        # CRÍTICO: Atualizar documento no banco com verificação robusta
-        logger.info(f"💾 VERBOSE: Saving extracted text to database...")
-        logger.info(f"💾 VERBOSE: Text to save length: {len(extracted_text)}")
+        extracted_text = run_extraction_stage(db, document)
+        llm_skipped = continue_after_extraction(db, document, extracted_text)
         
-        # Atualizar campos um por um para garantir que sejam salvos
-        document.extracted_text = extracted_text
-        document.status = DocumentStatus.TEXT_EXTRACTED
-        document.updated_at = datetime.utcnow()
+        return {"status": "success", "document_id": document_id, "extracted_length": len(extracted_text), "llm_skipped": llm_skipped}
         
-        # Commit com verificação
-        logger.info(f"💾 VERBOSE: Committing to database...")
+    except Exception as e:
+        logger.error(f"❌ VERBOSE: Error extracting text for document {document_id}: {e}")
+        logger.error(f"❌ VERBOSE: Exception type: {type(e).__name__}")
+        handle_task_failure(self, db, locals().get("document"), e, "text extraction")
+    finally:
+        db.close()
+
+def has_current_extraction(document: Document) -> bool:
+    """Whether extracted_text was produced by the current extractor version"""
+    return bool((document.extracted_text or "").strip()) and document.extractor_version == EXTRACTOR_VERSION
+
+def has_llm_response(target) -> bool:
+    """Whether the LLM stage already ran for the target"""
+    return target.llm_response is not None and target.status != DocumentStatus.UPLOADED
+
+def is_completed(target) -> bool:
+    return target.status == DocumentStatus.COMPLETED and target.formatted_response is not None
+
+def copy_leader_result(leader: Document, follower: Document):
+    """Give a coalesced duplicate the final result (or error) of its leader"""
+    # Só as colunas do resultado: o processing_info da cópia é gravado pela API
+    follower.extracted_text = leader.extracted_text
+    follower.extractor_version = leader.extractor_version
+    follower.llm_response = leader.llm_response
+    follower.full_prompt_sent = leader.full_prompt_sent
+    follower.formatted_response = leader.formatted_response
+    follower.error_message = leader.error_message
+    follower.status = leader.status
+    follower.completed_at = leader.completed_at or datetime.utcnow()
+    follower.updated_at = datetime.utcnow()
+
+def release_followers(db: Session, target):
+    """Finish the identical uploads coalesced with a document that reached COMPLETED or ERROR"""
+    coalescing_info = target.get_processing_info().get("coalescing") if isinstance(target, Document) else None
+    if not coalescing_info or coalescing_info.get("leader_id"):
+        return
+    follower_ids = release_leadership(coalescing_info["key"], target.id)
+    if not follower_ids:
+        return
+    for follower in db.query(Document).filter(Document.id.in_(follower_ids)).all():
+        copy_leader_result(target, follower)
+    db.commit()
+    metrics.incr("coalescing.released", len(follower_ids))
+    logger.info(f"🤝 VERBOSE: Document {target.id} finished {len(follower_ids)} coalesced duplicate(s): {follower_ids}")
+
+def load_page_checkpoints(db: Session, document_id: int) -> dict:
+    """OCR texts of the pages already finished with the current extractor version ({page_number: text})"""
+    pages = db.query(DocumentPage).filter(
+        DocumentPage.document_id == document_id,
+        DocumentPage.extractor_version == EXTRACTOR_VERSION
+    ).all()
+    return {page.page_number: page.text for page in pages}
+
+def ocr_pdf_with_checkpoints(db: Session, document: Document, first_page: int = 0, last_page: int = None) -> list:
+    """OCR a PDF page range, persisting each page as it completes and skipping pages already done"""
+    done_pages = load_page_checkpoints(db, document.id)
+    if done_pages:
+        logger.info(f"♻️ VERBOSE: Resuming OCR of document {document.id}: {len(done_pages)} page(s) already done")
+    zoom = degradation_options(document).get("ocr_zoom", OCR_ZOOM)
+    page_started = [time.time()]
+    
+    def save_page(page_number: int, text: str):
+        # Tempo por página: base histórica do planejamento por prazo (Deadline)
+        record_ocr_page(time.time() - page_started[0], zoom)
+        db.add(DocumentPage(document_id=document.id, page_number=page_number, extractor_version=EXTRACTOR_VERSION, text=text))
         db.commit()
-        
+        page_started[0] = time.time()
+    
+    return ocr_pdf_pages(document.file_path, first_page, last_page, done_pages=done_pages, on_page=save_page, zoom=zoom)
+
+def degradation_options(target) -> dict:
+    """Cheaper options chosen to meet the Deadline header ({} without a deadline)"""
+    return target.get_processing_info().get("deadline", {}).get("options", {})
+
+def ocr_page_limit(document: Document, num_pages: int) -> int:
+    """Pages to extract: all of them, or the first max_pages when the deadline forced fewer pages"""
+    return min(num_pages, degradation_options(document).get("max_pages", num_pages))
+
+def continue_after_extraction(db: Session, document: Document, extracted_text: str) -> bool:
+    """Answer with the rule engine or chain to the prompt task. Returns True when the LLM call was skipped"""
+    # Regras determinísticas: se todas as chaves foram resolvidas, a LLM não é chamada
+    if answer_with_rules(document, extracted_text):
+        db.commit()
+        release_followers(db, document)
+        return True
+    db.commit()
+    
+    # Chain to next task
+    logger.info(f"🔗 VERBOSE: Chaining to prompt processing task")
+    enqueue_prompt_task(document.id, document.model, document.ai_provider, priority=stage_priority(document))
+    return False
+
+def page_ranges(num_pages: int, pages_per_task: int = OCR_FANOUT_PAGES_PER_TASK) -> list:
+    """Split 0..num_pages-1 into inclusive [first, last] ranges"""
+    return [[first, min(first + pages_per_task, num_pages) - 1] for first in range(0, num_pages, pages_per_task)]
+
+def start_ocr_fanout(db: Session, document: Document) -> bool:
+    """Dispatch the OCR of a long PDF as a chord of page-range tasks. Returns False when the document does not qualify"""
+    if not OCR_FANOUT_ENABLED or (document.file_type or "").lower() != "pdf":
+        return False
+    if not document.file_path or not os.path.exists(document.file_path):
+        return False
+    if degradation_options(document).get("text_layer_only"):
+        return False
+    num_pages = ocr_page_limit(document, count_document_pages(document.file_path, document.file_type))
+    if num_pages < OCR_FANOUT_MIN_PAGES:
+        return False
+    
+    ranges = page_ranges(num_pages)
+    document.set_processing_info("ocr_fanout", {
+        "pages": num_pages,
+        "ranges": len(ranges),
+        "pages_per_task": OCR_FANOUT_PAGES_PER_TASK,
+        "started_at": time.time(),
+    })
+    db.commit()
+    
+    logger.info(f"🪓 VERBOSE: Splitting OCR of document {document.id} ({num_pages} pages) into {len(ranges)} page-range tasks")
+    priority = stage_priority(document)
+    chord(
+        ocr_page_range_task.s(document.id, first, last).set(priority=priority) for first, last in ranges
+    )(merge_ocr_pages_task.s(document.id).set(priority=priority))
+    return True
+
+def get_task_target(db: Session, document: Document, query_id: int = None):
+    """Return the row that holds the prompt and results: the DocumentQuery when re-asking, else the Document"""
+    if query_id is None:
+        return document
+    
+    query = db.query(DocumentQuery).filter(
+        DocumentQuery.id == query_id,
+        DocumentQuery.document_id == document.id
+    ).first()
+    if not query:
+        raise PermanentError(f"Query {query_id} for document {document.id} not found")
+    return query
+
+def answer_with_rules(target, extracted_text: str, rule_result: dict = None) -> bool:
+    """Try to answer the target with the rule engine. Returns True when the LLM call can be skipped
+    
+    rule_result: an extract_with_rules result already computed for this text.
+    """
+    if getattr(target, "questions", None):
+        return False
+    
+    if rule_result is None:
+        rule_result = extract_with_rules(extracted_text, target.format_response)
+    if not rule_result["resolved"] and not rule_result["answered"]:
+        return False
+    
+    target.set_processing_info("rule_extraction", {
+        "answered": rule_result["answered"],
+        "resolved": rule_result["resolved"],
+        "unresolved": rule_result["unresolved"],
+    })
+    if not rule_result["answered"]:
+        return False
+    
+    target.llm_response = rule_result["response"]
+    target.formatted_response = rule_result["response"]
+    target.set_processing_info("llm_call", {"skipped": "rule_engine"})
+    target.status = DocumentStatus.COMPLETED
+    target.completed_at = datetime.utcnow()
+    target.updated_at = datetime.utcnow()
+    return True
+
+async def generate_llm_response(target, prompt: str, context: str, format_response: str, example: str, call_info: dict,
+                                reuse_key: str = None) -> tuple[str, str]:
+    """Send a prompt to the AI provider configured on the target. Returns (llm_response, full_prompt)"""
+    use_cache = not target.cache_bypass
+    if target.ai_provider == "gemini":
+        return await send_prompt_to_gemini(
+            prompt,
+            context,
+            target.model,
+            target.gemini_api_key,
+            format_response,
+            example,
+            use_cache=use_cache,
+            call_info=call_info
+        )
+    
+    # Ollama: duplica a requisição em outro destino se passar do prazo (header Hedge-Policy)
+    return await generate_with_policy(
+        prompt,
+        context,
+        target.model,
+        format_response,
+        example,
+        use_cache=use_cache,
+        call_info=call_info,
+        reuse_key=reuse_key,
+        policy=getattr(target, "hedge_policy", None),
+        gemini_api_key=GEMINI_API_KEY
+    )
+
+async def generate_concurrent_responses(target, questions: list, context: str, call_info: dict,
+                                        reuse_key: str = None) -> tuple[str, str]:
+    """Ask every question concurrently over the same context. Returns (responses_json, full_prompts)"""
+    for question in questions:
+        call_info[question["id"]] = {}
+    
+    def ask(question):
+        return generate_llm_response(target, question["prompt"], context, question["format"], question["example"],
+                                     call_info[question["id"]], reuse_key=reuse_key)
+    
+    if PROMPT_LAYOUT == "prefix_cache" and target.ai_provider != "gemini":
+        # A primeira pergunta avalia o prefixo do documento; as demais reutilizam os tokens
+        results = [await ask(questions[0])]
+        results += await asyncio.gather(*[ask(q) for q in questions[1:]])
+    else:
+        results = await asyncio.gather(*[ask(q) for q in questions])
+    
+    responses = {q["id"]: llm_response for q, (llm_response, _) in zip(questions, results)}
+    full_prompts = "\n\n".join(f"### [{q['id']}]\n{full_prompt}" for q, (_, full_prompt) in zip(questions, results))
+    return json.dumps(responses, ensure_ascii=False), full_prompts
+
+def run_extraction_stage(db: Session, document: Document, verify: bool = True) -> str:
+    """Extract the document text and checkpoint it (status TEXT_EXTRACTED)
+    
+    verify re-reads the row after the commit; the fused pipeline skips it and keeps the text in memory.
+    """
+    logger.info(f"🔍 VERBOSE: Starting text extraction for document {document.id}")
+    logger.info(f"📁 VERBOSE: File path: {document.file_path}")
+    logger.info(f"📄 VERBOSE: File type: {document.file_type}")
+    logger.info(f"📝 VERBOSE: Filename: {document.filename}")
+    
+    # Verificar se o arquivo existe
+    if not document.file_path or not os.path.exists(document.file_path):
+        error_msg = f"File not found: {document.file_path}"
+        logger.error(f"❌ VERBOSE: {error_msg}")
+        raise PermanentError(error_msg)
+    
+    logger.info(f"✅ VERBOSE: File exists, proceeding with extraction")
+    
+    # Extract text from file (PDF: página a página, com checkpoint de cada página)
+    options = degradation_options(document)
+    file_type = document.file_type.lower()
+    if file_type == "pdf" and options.get("text_layer_only"):
+        logger.info(f"⏱️ VERBOSE: Deadline - using the PDF text layer instead of OCR")
+        extracted_text = join_page_texts(extract_pdf_text_layer(document.file_path, options.get("max_pages")))
+    elif file_type == "pdf":
+        num_pages = count_document_pages(document.file_path, document.file_type)
+        extracted_text = join_page_texts(ocr_pdf_with_checkpoints(db, document, 0, ocr_page_limit(document, num_pages) - 1))
+    elif file_type in OCR_FILE_TYPES and "ocr_zoom" in options:
+        ocr_started = time.time()
+        extracted_text = extract_text_from_image(document.file_path, zoom=options["ocr_zoom"])
+        record_ocr_page(time.time() - ocr_started, options["ocr_zoom"])
+    else:
+        ocr_started = time.time()
+        extracted_text = extract_text_from_file(document.file_path, document.file_type)
+        if file_type in OCR_FILE_TYPES:
+            record_ocr_page(time.time() - ocr_started)
+    
+    # Verificação crítica do texto extraído
+    logger.info(f"🔍 VERBOSE: Extracted text length: {len(extracted_text) if extracted_text else 0}")
+    logger.info(f"🔍 VERBOSE: Extracted text preview: {extracted_text[:200] if extracted_text else 'None'}...")
+    
+    # Verificar se o texto foi realmente extraído
+    if not extracted_text or not extracted_text.strip():
+        logger.warning(f"⚠️ VERBOSE: No text extracted from file: {document.file_path}")
+        logger.warning(f"⚠️ VERBOSE: File type: {document.file_type}")
+        logger.warning(f"⚠️ VERBOSE: File exists: {os.path.exists(document.file_path) if document.file_path else False}")
+        # Definir texto padrão para evitar problemas
+        extracted_text = f"[ERRO: Não foi possível extrair texto do arquivo {document.filename}]"
+    
+    return save_extracted_text(db, document, extracted_text, verify)
+
+def save_extracted_text(db: Session, document: Document, extracted_text: str, verify: bool = True) -> str:
+    """Checkpoint the extracted text (status TEXT_EXTRACTED)"""
+    # CRÍTICO: Atualizar documento no banco com verificação robusta
+    logger.info(f"💾 VERBOSE: Saving extracted text to database...")
+    logger.info(f"💾 VERBOSE: Text to save length: {len(extracted_text)}")
+    
+    # Atualizar campos um por um para garantir que sejam salvos
+    document.extracted_text = extracted_text
+    document.extractor_version = EXTRACTOR_VERSION
+    # Texto novo invalida uma resposta gerada sobre o texto anterior
+    document.llm_response = None
+    document.status = DocumentStatus.TEXT_EXTRACTED
+    document.updated_at = datetime.utcnow()
+    # O texto completo substitui os checkpoints por página
+    db.query(DocumentPage).filter(DocumentPage.document_id == document.id).delete(synchronize_session=False)
+    
+    # Commit com verificação
+    logger.info(f"💾 VERBOSE: Committing to database...")
+    db.commit()
+    
+    if verify:
         # VERIFICAÇÃO CRÍTICA: Refresh e verificar se foi salvo
         db.refresh(document)
         logger.info(f"🔍 VERBOSE: After commit - extracted_text length in DB: {len(document.extracted_text) if document.extracted_text else 0}")
         logger.info(f"🔍 VERBOSE: After commit - status in DB: {document.status}")
-        
+    
         # Verificação adicional: fazer nova query para confirmar
-        verification_doc = db.query(Document).filter(Document.id == document_id).first()
+        verification_doc = db.query(Document).filter(Document.id == document.id).first()
         if verification_doc:
             logger.info(f"✅ VERBOSE: Verification query - extracted_text length: {len(verification_doc.extracted_text) if verification_doc.extracted_text else 0}")
             logger.info(f"✅ VERBOSE: Verification query - status: {verification_doc.status}")
-            
+        
             if not verification_doc.extracted_text:
                 logger.error(f"❌ CRITICAL: Text was not saved to database! Attempting manual save...")
                 # Tentar salvar novamente
@@ -107,240 +567,507 @@ def extract_text_task(self, document_id: int):
                 db.commit()
                 db.refresh(verification_doc)
                 logger.info(f"🔄 VERBOSE: After manual save - extracted_text length: {len(verification_doc.extracted_text) if verification_doc.extracted_text else 0}")
+    
+    logger.info(f"✅ VERBOSE: Text extraction completed for document {document.id}")
+    logger.info(f"📊 VERBOSE: Extracted {len(extracted_text)} characters")
+    
+    return extracted_text
+
+def uses_progressive_extraction(document: Document) -> bool:
+    """Progressive mode: multi-page PDFs with a flat JSON template (not multi-question requests)"""
+    mode = document.get_processing_info().get("extraction", {}).get("mode", EXTRACTION_MODE)
+    if mode != "progressive" or (document.file_type or "").lower() != "pdf" or document.questions:
+        return False
+    if degradation_options(document).get("text_layer_only") or flat_template_keys(document.format_response) is None:
+        return False
+    if not document.file_path or not os.path.exists(document.file_path):
+        return False
+    return count_document_pages(document.file_path, document.file_type) > PROGRESSIVE_FIRST_PAGES
+
+def probe_llm_answer(document: Document, partial_text: str) -> tuple[str, str, dict]:
+    """Ask the LLM over the text extracted so far. Returns (llm_response, full_prompt, call_info)"""
+    ensure_llm_available(document.id, document)
+    if document.ai_provider == "gemini" and not document.gemini_api_key:
+        raise PermanentError("Gemini API key is required for Gemini provider")
+    loop = get_event_loop()
+    token_budget = degradation_options(document).get("context_token_budget", RETRIEVAL_TOKEN_BUDGET)
+    context_text, _ = loop.run_until_complete(
+        select_relevant_context(document.prompt, partial_text, document.format_response, token_budget=token_budget)
+    )
+    call_info = {}
+    llm_response, full_prompt = loop.run_until_complete(
+        generate_llm_response(document, f"{document.prompt}\n{PARTIAL_TEXT_INSTRUCTION}", context_text,
+                              document.format_response, document.example, call_info)
+    )
+    return llm_response, full_prompt, call_info
+
+def run_progressive_extraction(db: Session, document: Document) -> tuple[str, str]:
+    """Extract a PDF in page batches, stopping as soon as the pages read so far answer the prompt
+    
+    Returns (extracted_text, answered_by): "rules" (documento concluído), "llm" (resposta
+    bruta gravada, falta a formatação) ou None (texto completo extraído, pipeline normal).
+    """
+    started = time.time()
+    num_pages = ocr_page_limit(document, count_document_pages(document.file_path, document.file_type))
+    page_texts, answered_by, llm_result = [], None, None
+    progress = {"total_pages": num_pages, "batches": 0, "llm_probes": 0}
+    
+    for first, last in page_batches(num_pages):
+        page_texts += ocr_pdf_with_checkpoints(db, document, first, last)
+        progress["batches"] += 1
+        if last >= num_pages - 1:
+            # Documento inteiro extraído: segue o pipeline normal
+            break
         
-        logger.info(f"✅ VERBOSE: Text extraction completed for document {document_id}")
-        logger.info(f"📊 VERBOSE: Extracted {len(extracted_text)} characters")
-        
-        # Chain to next task
-        logger.info(f"🔗 VERBOSE: Chaining to prompt processing task")
-        process_prompt_task.delay(document_id)
-        
-        return {"status": "success", "document_id": document_id, "extracted_length": len(extracted_text)}
-        
-    except Exception as e:
-        logger.error(f"❌ VERBOSE: Error extracting text for document {document_id}: {e}")
-        logger.error(f"❌ VERBOSE: Exception type: {type(e).__name__}")
-        logger.error(f"❌ VERBOSE: Exception details: {str(e)}")
+        partial_text = join_page_texts(page_texts)
+        rule_result = extract_with_rules(partial_text, document.format_response)
+        if rule_result["answered"]:
+            answered_by = "rules"
+            break
         
-        # Update document status to error
-        try:
-            if 'document' in locals():
-                document.status = DocumentStatus.ERROR
-                document.error_message = str(e)
-                document.updated_at = datetime.utcnow()
-                db.commit()
-                logger.info(f"💾 VERBOSE: Error status saved to database")
-        except Exception as db_error:
-            logger.error(f"❌ VERBOSE: Failed to save error status: {db_error}")
+        if progress["llm_probes"] < PROGRESSIVE_MAX_LLM_PROBES:
+            progress["llm_probes"] += 1
+            try:
+                llm_result = probe_llm_answer(document, partial_text)
+            except PermanentError:
+                raise
+            except Exception as e:
+                # Consulta antecipada é opcional: sem LLM agora, continua extraindo
+                logger.warning(f"⚠️ VERBOSE: Progressive LLM probe failed for document {document.id}: {e}")
+                progress["llm_probes"] = PROGRESSIVE_MAX_LLM_PROBES
+                continue
+            if confident_answer(llm_result[0], document.format_response, partial_text):
+                answered_by = "llm"
+                break
+            logger.info(f"📖 VERBOSE: Answer not complete after {last + 1}/{num_pages} pages - extracting next batch")
+    
+    extracted_text = join_page_texts(page_texts) or f"[ERRO: Não foi possível extrair texto do arquivo {document.filename}]"
+    progress.update({
+        "pages_extracted": len(page_texts),
+        "stopped_early": answered_by is not None,
+        "answered_by": answered_by,
+        "seconds": round(time.time() - started, 3),
+    })
+    document.set_processing_info("progressive", progress)
+    save_extracted_text(db, document, extracted_text, verify=False)
+    
+    if answered_by == "rules":
+        answer_with_rules(document, extracted_text, rule_result)
+        db.commit()
+        release_followers(db, document)
+    elif answered_by == "llm":
+        llm_response, full_prompt, call_info = llm_result
+        call_info["progressive"] = True
+        document.llm_response = llm_response
+        document.full_prompt_sent = full_prompt
+        document.set_processing_info("llm_call", call_info)
+        document.status = DocumentStatus.PROMPT_PROCESSED
+        document.updated_at = datetime.utcnow()
+        db.commit()
+    
+    if answered_by:
+        metrics.incr("progressive.stopped_early")
+        metrics.incr("progressive.pages_skipped", num_pages - len(page_texts))
+        logger.info(f"⏩ VERBOSE: Document {document.id} answered by {answered_by} after {len(page_texts)}/{num_pages} pages")
+    return extracted_text, answered_by
+
+def ensure_llm_available(document_id: int, target):
+    """Circuit breaker: with Ollama down, fail fast or reroute the target to the fallback provider"""
+    if target.ai_provider == "gemini" or get_pool().any_available():
+        return
+    if OLLAMA_FALLBACK_PROVIDER == "gemini" and GEMINI_API_KEY:
+        logger.warning(f"🔀 VERBOSE: Ollama circuit open - rerouting document {document_id} to Gemini ({OLLAMA_FALLBACK_MODEL})")
+        target.set_processing_info("reroute", {"from": f"ollama/{target.model}", "to": f"gemini/{OLLAMA_FALLBACK_MODEL}", "reason": "ollama circuit open"})
+        target.ai_provider = "gemini"
+        target.model = OLLAMA_FALLBACK_MODEL
+        target.gemini_api_key = GEMINI_API_KEY
+        metrics.incr("breaker.ollama.rerouted")
+    else:
+        metrics.incr("breaker.ollama.rejected")
+        raise OllamaUnavailableError(
+            "No Ollama backend available (all circuits open)",
+            retry_after=get_pool().seconds_until_available()
+        )
+
+def run_prompt_stage(db: Session, document: Document, target, extracted_text: str = None, verify: bool = True):
+    """Select the context, call the LLM and checkpoint the raw response (status PROMPT_PROCESSED)"""
+    # VERIFICAÇÃO CRÍTICA: Verificar se temos texto extraído (o pipeline unificado já o tem em memória)
+    if extracted_text is None:
+        extracted_text = document.extracted_text or ""
+    logger.info(f"📄 VERBOSE: Context length: {len(extracted_text)} characters")
+    logger.info(f"📄 VERBOSE: Context preview: {extracted_text[:200] if extracted_text else 'EMPTY'}...")
+    
+    if not extracted_text.strip():
+        logger.error(f"❌ CRITICAL: No extracted text available for document {document.id}")
+        logger.error(f"❌ CRITICAL: Document status: {document.status}")
+        logger.error(f"❌ CRITICAL: This should not happen if extraction was successful!")
         
-        # Retry logic
-        if self.request.retries < self.max_retries:
-            logger.info(f"🔄 VERBOSE: Retrying text extraction for document {document_id} (attempt {self.request.retries + 1})")
-            raise self.retry(countdown=60 * (2 ** self.request.retries))
+        # Tentar recarregar o documento para verificar
+        db.refresh(document)
+        extracted_text = document.extracted_text or ""
+        logger.info(f"🔄 VERBOSE: After refresh - extracted_text length: {len(extracted_text)}")
         
-        raise e
-    finally:
-        db.close()
+        if not extracted_text.strip():
+            logger.warning(f"⚠️ VERBOSE: Still no extracted text - will proceed with empty context")
+            logger.warning(f"⚠️ VERBOSE: LLM may use general knowledge instead of document content")
+            extracted_text = f"[AVISO: Texto não foi extraído do documento {document.filename}. Responda baseado em conhecimento geral.]"
+    
+    # Send prompt to appropriate AI provider
+    # Loop persistente da thread: clientes assíncronos compartilhados continuam válidos
+    loop = get_event_loop()
+    
+    questions = load_questions(getattr(target, "questions", None))
+    if questions:
+        # Várias perguntas: uma única seleção de contexto para todas (prefixo compartilhado)
+        retrieval_prompt = summarize_questions(questions)
+        retrieval_format = " ".join(q["format"] for q in questions)
+    else:
+        retrieval_prompt = target.prompt
+        retrieval_format = target.format_response
+    
+    # Retrieval: envia apenas os chunks relevantes para o Prompt (menos tokens quando o Deadline exige)
+    token_budget = degradation_options(target).get("context_token_budget", RETRIEVAL_TOKEN_BUDGET)
+    context_text, selection_info = loop.run_until_complete(
+        select_relevant_context(retrieval_prompt, extracted_text, retrieval_format, token_budget=token_budget)
+    )
+    target.set_processing_info("context_selection", selection_info)
+    logger.info(f"📄 VERBOSE: Context sent to LLM: {len(context_text)} of {len(extracted_text)} characters")
+    
+    llm_call_info = {}
+    reuse_key = f"document:{document.id}"
+    
+    if target.ai_provider == "gemini":
+        logger.info(f"🌟 VERBOSE: Using Google Gemini API")
+        if not target.gemini_api_key:
+            raise PermanentError("Gemini API key is required for Gemini provider")
+    else:
+        logger.info(f"🏠 VERBOSE: Using Ollama (Local)")
+    
+    if questions and target.questions_mode == "concurrent":
+        logger.info(f"❓ VERBOSE: Answering {len(questions)} questions concurrently")
+        llm_response, full_prompt = loop.run_until_complete(
+            generate_concurrent_responses(target, questions, context_text, llm_call_info, reuse_key=reuse_key)
+        )
+    elif questions:
+        logger.info(f"❓ VERBOSE: Answering {len(questions)} questions in a single packed prompt")
+        packed_prompt, packed_format, packed_example = build_packed_request(questions)
+        llm_response, full_prompt = loop.run_until_complete(
+            generate_llm_response(target, packed_prompt, context_text, packed_format, packed_example, llm_call_info,
+                                  reuse_key=reuse_key)
+        )
+    else:
+        llm_response, full_prompt = loop.run_until_complete(
+            generate_llm_response(
+                target,
+                target.prompt,
+                context_text,
+                target.format_response,
+                target.example,
+                llm_call_info,
+                reuse_key=reuse_key
+            )
+        )
+    
+    # Update document in database
+    logger.info(f"💾 VERBOSE: Saving LLM response to database...")
+    target.llm_response = llm_response
+    target.full_prompt_sent = full_prompt
+    target.set_processing_info("llm_call", llm_call_info)
+    target.status = DocumentStatus.PROMPT_PROCESSED
+    target.updated_at = datetime.utcnow()
+    db.commit()
+    
+    # Verificação
+    if verify:
+        db.refresh(target)
+        logger.info(f"✅ VERBOSE: LLM response saved - length: {len(target.llm_response) if target.llm_response else 0}")
+    
+    logger.info(f"✅ VERBOSE: Prompt processing completed for document {document.id}")
+    logger.info(f"📊 VERBOSE: LLM response length: {len(llm_response)} characters")
+
+def run_format_stage(db: Session, document: Document, target, verify: bool = True) -> str:
+    """Format the raw LLM response and finish the target (status COMPLETED)"""
+    logger.info(f"🎨 VERBOSE: Starting response formatting for document {document.id}" + (f" (query {target.id})" if target is not document else ""))
+    logger.info(f"📋 VERBOSE: Format template: {target.format_response}")
+    logger.info(f"💡 VERBOSE: Example provided: {bool(target.example)}")
+    
+    # Verificação final do texto extraído
+    logger.info(f"🔍 VERBOSE: Final check - extracted_text length: {len(document.extracted_text) if document.extracted_text else 0}")
+    
+    # Format response
+    questions = load_questions(getattr(target, "questions", None))
+    if questions:
+        formatted_response = format_question_responses(target.llm_response, questions, target.questions_mode)
+    else:
+        formatted_response = format_llm_response(
+            target.llm_response,
+            target.format_response,
+            target.example
+        )
+    
+    # Update document in database
+    logger.info(f"💾 VERBOSE: Saving final formatted response...")
+    target.formatted_response = formatted_response
+    target.status = DocumentStatus.COMPLETED
+    target.completed_at = datetime.utcnow()
+    target.updated_at = datetime.utcnow()
+    db.commit()
+    release_followers(db, target)
+    
+    # Verificação final
+    if verify:
+        db.refresh(target)
+        logger.info(f"✅ VERBOSE: Final verification - status: {target.status}")
+        logger.info(f"✅ VERBOSE: Final verification - extracted_text length: {len(document.extracted_text) if document.extracted_text else 0}")
+        logger.info(f"✅ VERBOSE: Final verification - formatted_response length: {len(target.formatted_response) if target.formatted_response else 0}")
+    
+    logger.info(f"🎉 VERBOSE: Response formatting completed for document {document.id}")
+    logger.info(f"✅ VERBOSE: Document processing pipeline completed successfully!")
+    logger.info(f"📊 VERBOSE: Final response length: {len(formatted_response)} characters")
+    
+    return formatted_response
 
 @celery_app.task(bind=True, max_retries=3)
-def process_prompt_task(self, document_id: int):
-    """Process prompt with LLM"""
+def process_prompt_task(self, document_id: int, query_id: int = None, model_deferrals: int = 0, dispatch_id: str = None):
+    """Process prompt with LLM (query_id: re-ask an already extracted document)"""
+    stale = skip_stale_dispatch(self, document_id, dispatch_id, query_id)
+    if stale:
+        return stale
     db = SessionLocal()
     try:
         # Get document from database
         document = db.query(Document).filter(Document.id == document_id).first()
         if not document:
-            raise Exception(f"Document with id {document_id} not found")
+            raise PermanentError(f"Document with id {document_id} not found")
+        target = get_task_target(db, document, query_id)
         
-        logger.info(f"🤖 VERBOSE: Starting prompt processing for document {document_id}")
-        logger.info(f"🎯 VERBOSE: Prompt: {document.prompt}")
-        logger.info(f"🤖 VERBOSE: Model: {document.model}")
-        logger.info(f"🤖 VERBOSE: AI Provider: {document.ai_provider}")
+        # Sai do trabalho pendente do modelo antes de qualquer retorno (inclusive pelos checkpoints)
+        if target.ai_provider != "gemini":
+            mark_started(target.model, f"{document_id}:{query_id or ''}")
         
-        # VERIFICAÇÃO CRÍTICA: Verificar se temos texto extraído
-        extracted_text = document.extracted_text or ""
-        logger.info(f"📄 VERBOSE: Context length: {len(extracted_text)} characters")
-        logger.info(f"📄 VERBOSE: Context preview: {extracted_text[:200] if extracted_text else 'EMPTY'}...")
+        # Checkpoints: resposta da LLM já gravada (nova tentativa ou entrega repetida com acks_late)
+        if is_completed(target):
+            logger.info(f"♻️ VERBOSE: Document {document_id}" + (f" query {query_id}" if query_id else "") + " already completed - nothing to do")
+            return {"status": "success", "document_id": document_id, "query_id": query_id, "resumed": True}
+        if has_llm_response(target):
+            logger.info(f"♻️ VERBOSE: LLM response already saved for document {document_id} - skipping to formatting")
+            enqueue_format_task(document_id, target, query_id)
+            return {"status": "success", "document_id": document_id, "query_id": query_id, "resumed": True}
         
-        if not extracted_text.strip():
-            logger.error(f"❌ CRITICAL: No extracted text available for document {document_id}")
-            logger.error(f"❌ CRITICAL: Document status: {document.status}")
-            logger.error(f"❌ CRITICAL: This should not happen if extraction was successful!")
-            
-            # Tentar recarregar o documento para verificar
-            db.refresh(document)
-            extracted_text = document.extracted_text or ""
-            logger.info(f"🔄 VERBOSE: After refresh - extracted_text length: {len(extracted_text)}")
-            
-            if not extracted_text.strip():
-                logger.warning(f"⚠️ VERBOSE: Still no extracted text - will proceed with empty context")
-                logger.warning(f"⚠️ VERBOSE: LLM may use general knowledge instead of document content")
-                extracted_text = f"[AVISO: Texto não foi extraído do documento {document.filename}. Responda baseado em conhecimento geral.]"
-        
-        # Send prompt to appropriate AI provider
-        logger.info(f"🔄 VERBOSE: Setting up async event loop for AI call")
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
+        logger.info(f"🤖 VERBOSE: Starting prompt processing for document {document_id}" + (f" (query {query_id})" if query_id else ""))
+        logger.info(f"🎯 VERBOSE: Prompt: {target.prompt}")
+        logger.info(f"🤖 VERBOSE: Model: {target.model}")
+        logger.info(f"🤖 VERBOSE: AI Provider: {target.ai_provider}")
         
-        try:
-            if document.ai_provider == "gemini":
-                logger.info(f"🌟 VERBOSE: Using Google Gemini API")
-                if not document.gemini_api_key:
-                    raise Exception("Gemini API key is required for Gemini provider")
-                
-                llm_response, full_prompt = loop.run_until_complete(
-                    send_prompt_to_gemini(
-                        document.prompt,
-                        extracted_text,
-                        document.model,
-                        document.gemini_api_key,
-                        document.format_response,
-                        document.example
-                    )
-                )
-            else:
-                logger.info(f"🏠 VERBOSE: Using Ollama (Local)")
-                
-                # Verificar se Ollama está disponível
-                try:
-                    import httpx
-                    async def check_ollama():
-                        async with httpx.AsyncClient(timeout=5) as client:
-                            response = await client.get(f"{OLLAMA_BASE_URL}/api/tags")
-                            return response.status_code == 200
-                    
-                    ollama_available = loop.run_until_complete(check_ollama())
-                    
-                    if not ollama_available:
-                        logger.error(f"❌ CRITICAL: Ollama not available at {OLLAMA_BASE_URL}")
-                        logger.error(f"❌ CRITICAL: Document will fail unless you:")
-                        logger.error(f"  1. Restart Docker container")
-                        logger.error(f"  2. Verify Ollama is running inside container")
-                        logger.error(f"  3. Or use Gemini provider instead")
-                        raise Exception(f"Ollama service not available at {OLLAMA_BASE_URL}")
-                        
-                except Exception as connectivity_error:
-                    logger.error(f"❌ CRITICAL: Failed to connect to Ollama: {connectivity_error}")
-                    raise Exception(f"Ollama connectivity error: {connectivity_error}")
-                
-                llm_response, full_prompt = loop.run_until_complete(
-                    send_prompt_to_ollama(
-                        document.prompt,
-                        extracted_text,
-                        document.model,
-                        document.format_response,
-                        document.example
-                    )
-                )
-        finally:
-            loop.close()
+        # Novas perguntas (re-ask) também passam pelas regras determinísticas antes da LLM
+        if query_id is not None and answer_with_rules(target, document.extracted_text or ""):
+            db.commit()
+            logger.info(f"📏 VERBOSE: Query {query_id} answered by the rule engine - LLM skipped")
+            return {"status": "success", "document_id": document_id, "query_id": query_id, "llm_skipped": True}
         
-        # Update document in database
-        logger.info(f"💾 VERBOSE: Saving LLM response to database...")
-        document.llm_response = llm_response
-        document.full_prompt_sent = full_prompt
-        document.status = DocumentStatus.PROMPT_PROCESSED
-        document.updated_at = datetime.utcnow()
-        db.commit()
+        # Circuit breaker: com o Ollama fora do ar, falha rápido ou desvia para o provedor de fallback
+        ensure_llm_available(document_id, target)
         
-        # Verificação
-        db.refresh(document)
-        logger.info(f"✅ VERBOSE: LLM response saved - length: {len(document.llm_response) if document.llm_response else 0}")
+        # Agrupa por modelo: não troca o modelo carregado enquanto ele ainda tem trabalho na fila
+        if target.ai_provider != "gemini" and should_defer_for_model(target.model, model_deferrals):
+            enqueue_prompt_task(document_id, target.model, target.ai_provider, query_id=query_id,
+                                countdown=MODEL_SWAP_DEFER_SECONDS, model_deferrals=model_deferrals + 1,
+                                priority=stage_priority(target))
+            return {"status": "deferred", "document_id": document_id, "query_id": query_id}
         
-        logger.info(f"✅ VERBOSE: Prompt processing completed for document {document_id}")
-        logger.info(f"📊 VERBOSE: LLM response length: {len(llm_response)} characters")
+        run_prompt_stage(db, document, target)
         
         # Chain to next task
         logger.info(f"🔗 VERBOSE: Chaining to response formatting task")
-        format_response_task.delay(document_id)
+        enqueue_format_task(document_id, target, query_id)
         
-        return {"status": "success", "document_id": document_id}
+        return {"status": "success", "document_id": document_id, "query_id": query_id}
         
     except Exception as e:
         logger.error(f"❌ VERBOSE: Error processing prompt for document {document_id}: {e}")
-        
-        # Update document status to error
-        try:
-            if 'document' in locals():
-                document.status = DocumentStatus.ERROR
-                document.error_message = str(e)
-                document.updated_at = datetime.utcnow()
-                db.commit()
-        except Exception as db_error:
-            logger.error(f"❌ VERBOSE: Failed to save error status: {db_error}")
-        
-        # Retry logic
-        if self.request.retries < self.max_retries:
-            logger.info(f"🔄 VERBOSE: Retrying prompt processing for document {document_id} (attempt {self.request.retries + 1})")
-            raise self.retry(countdown=60 * (2 ** self.request.retries))
-        
-        raise e
+        handle_task_failure(self, db, locals().get("target"), e, "prompt processing")
     finally:
         db.close()
 
 @celery_app.task(bind=True, max_retries=3)
-def format_response_task(self, document_id: int):
-    """Format and finalize response"""
+def format_response_task(self, document_id: int, query_id: int = None, dispatch_id: str = None):
+    """Format and finalize response (query_id: re-ask an already extracted document)"""
+    stale = skip_stale_dispatch(self, document_id, dispatch_id, query_id)
+    if stale:
+        return stale
     db = SessionLocal()
     try:
         # Get document from database
         document = db.query(Document).filter(Document.id == document_id).first()
         if not document:
-            raise Exception(f"Document with id {document_id} not found")
+            raise PermanentError(f"Document with id {document_id} not found")
+        target = get_task_target(db, document, query_id)
         
-        logger.info(f"🎨 VERBOSE: Starting response formatting for document {document_id}")
-        logger.info(f"📋 VERBOSE: Format template: {document.format_response}")
-        logger.info(f"💡 VERBOSE: Example provided: {bool(document.example)}")
+        if is_completed(target):
+            logger.info(f"♻️ VERBOSE: Document {document_id}" + (f" query {query_id}" if query_id else "") + " already formatted - nothing to do")
+            return {"status": "success", "document_id": document_id, "query_id": query_id, "resumed": True}
         
-        # Verificação final do texto extraído
-        logger.info(f"🔍 VERBOSE: Final check - extracted_text length: {len(document.extracted_text) if document.extracted_text else 0}")
+        run_format_stage(db, document, target)
         
-        # Format response
-        formatted_response = format_llm_response(
-            document.llm_response,
-            document.format_response,
-            document.example
-        )
+        return {"status": "success", "document_id": document_id, "query_id": query_id}
         
-        # Update document in database
-        logger.info(f"💾 VERBOSE: Saving final formatted response...")
-        document.formatted_response = formatted_response
-        document.status = DocumentStatus.COMPLETED
-        document.completed_at = datetime.utcnow()
-        document.updated_at = datetime.utcnow()
-        db.commit()
+    except Exception as e:
+        logger.error(f"❌ VERBOSE: Error formatting response for document {document_id}: {e}")
+        handle_task_failure(self, db, locals().get("target"), e, "response formatting")
+    finally:
+        db.close()
+
+@celery_app.task(bind=True, max_retries=3)
+def ocr_page_range_task(self, document_id: int, first_page: int, last_page: int):
+    """OCR one page range of a fanned-out PDF
+    
+    Cada página é gravada ao terminar: uma falha repete só as páginas que faltam desta
+    faixa. Esgotadas as tentativas, devolve o erro em vez de levantar a exceção, para
+    que o merge marque o documento com erro.
+    """
+    db = SessionLocal()
+    try:
+        document = db.query(Document).filter(Document.id == document_id).first()
+        if not document:
+            raise PermanentError(f"Document with id {document_id} not found")
+        return {"first_page": first_page, "texts": ocr_pdf_with_checkpoints(db, document, first_page, last_page)}
+    except Exception as e:
+        logger.error(f"❌ VERBOSE: OCR of pages {first_page + 1}-{last_page + 1} of document {document_id} failed: {e}")
+        error_class = classify_error(e)
+        max_retries = max_retries_for(error_class)
+        if self.request.retries < max_retries:
+            countdown = retry_countdown(error_class, self.request.retries)
+            logger.info(f"🔄 VERBOSE: Retrying pages {first_page + 1}-{last_page + 1} of document {document_id} in {countdown}s ({error_class}, attempt {self.request.retries + 1}/{max_retries})")
+            raise self.retry(countdown=countdown, max_retries=max_retries)
+        return {"first_page": first_page, "error": f"Pages {first_page + 1}-{last_page + 1}: {e}"}
+    finally:
+        db.close()
+
+@celery_app.task
+def merge_ocr_pages_task(results: list, document_id: int):
+    """Chord callback: join the page ranges in order and continue the pipeline"""
+    db = SessionLocal()
+    try:
+        document = db.query(Document).filter(Document.id == document_id).first()
+        if not document:
+            raise PermanentError(f"Document with id {document_id} not found")
         
-        # Verificação final
-        db.refresh(document)
-        logger.info(f"✅ VERBOSE: Final verification - status: {document.status}")
-        logger.info(f"✅ VERBOSE: Final verification - extracted_text length: {len(document.extracted_text) if document.extracted_text else 0}")
-        logger.info(f"✅ VERBOSE: Final verification - formatted_response length: {len(document.formatted_response) if document.formatted_response else 0}")
+        errors = [result["error"] for result in results if result.get("error")]
+        if errors:
+            raise Exception(f"OCR failed for {len(errors)} page range(s): {'; '.join(errors)}")
         
-        logger.info(f"🎉 VERBOSE: Response formatting completed for document {document_id}")
-        logger.info(f"✅ VERBOSE: Document processing pipeline completed successfully!")
-        logger.info(f"📊 VERBOSE: Final response length: {len(formatted_response)} characters")
+        results = sorted(results, key=lambda result: result["first_page"])
+        page_texts = [text for result in results for text in result["texts"]]
+        extracted_text = join_page_texts(page_texts)
         
-        return {"status": "success", "document_id": document_id}
+        fanout_info = document.get_processing_info().get("ocr_fanout", {})
+        if fanout_info.get("started_at"):
+            fanout_info["seconds"] = round(time.time() - fanout_info.pop("started_at"), 3)
+            document.set_processing_info("ocr_fanout", fanout_info)
+        logger.info(f"🧩 VERBOSE: Merged {len(page_texts)} OCR pages of document {document_id} from {len(results)} tasks")
         
-    except Exception as e:
-        logger.error(f"❌ VERBOSE: Error formatting response for document {document_id}: {e}")
+        if not extracted_text:
+            extracted_text = f"[ERRO: Não foi possível extrair texto do arquivo {document.filename}]"
+        save_extracted_text(db, document, extracted_text, verify=False)
+        llm_skipped = continue_after_extraction(db, document, extracted_text)
+        
+        return {"status": "success", "document_id": document_id, "extracted_length": len(extracted_text), "llm_skipped": llm_skipped}
         
-        # Update document status to error
+    except Exception as e:
+        logger.error(f"❌ VERBOSE: Error merging OCR pages for document {document_id}: {e}")
         try:
-            if 'document' in locals():
+            if 'document' in locals() and document is not None:
                 document.status = DocumentStatus.ERROR
                 document.error_message = str(e)
                 document.updated_at = datetime.utcnow()
                 db.commit()
+                release_followers(db, document)
         except Exception as db_error:
             logger.error(f"❌ VERBOSE: Failed to save error status: {db_error}")
+        raise e
+    finally:
+        db.close()
+
+@celery_app.task(bind=True, max_retries=3)
+def process_document_task(self, document_id: int, dispatch_id: str = None):
+    """Run extraction, LLM and formatting back to back in one task (fused pipeline)
+    
+    Evita as idas e voltas pelo broker entre as etapas: uma sessão, uma consulta
+    do documento e o texto extraído mantido em memória. Cada etapa ainda grava
+    seu checkpoint (status), então uma nova tentativa retoma da última etapa concluída.
+    Na fila ocr (PDFs e imagens) só a extração roda aqui: o restante é despachado
+    para a fila llm e retoma do checkpoint text_extracted.
+    """
+    stale = skip_stale_dispatch(self, document_id, dispatch_id)
+    if stale:
+        return stale
+    db = SessionLocal()
+    try:
+        document = db.query(Document).filter(Document.id == document_id).first()
+        if not document:
+            raise PermanentError(f"Document with id {document_id} not found")
         
-        # Retry logic
-        if self.request.retries < self.max_retries:
-            logger.info(f"🔄 VERBOSE: Retrying response formatting for document {document_id} (attempt {self.request.retries + 1})")
-            raise self.retry(countdown=60 * (2 ** self.request.retries))
+        logger.info(f"⚡ VERBOSE: Fused pipeline for document {document_id} (status {document.status.value})")
+        # Tempos de etapas de uma execução anterior (ex: extração na fila ocr) são mantidos
+        previous_info = document.get_processing_info().get("pipeline") or {}
+        pipeline_info = {"mode": "fused", "stage_seconds": dict(previous_info.get("stage_seconds", {}))}
+        if previous_info.get("handed_off"):
+            pipeline_info["handed_off"] = previous_info["handed_off"]
         
-        raise e
+        # Checkpoints: etapas já concluídas em uma tentativa anterior não são refeitas
+        if is_completed(document):
+            return {"status": "success", "document_id": document_id, "mode": "fused", "resumed": True}
+        if has_current_extraction(document):
+            pipeline_info["resumed_from"] = "prompt_processed" if has_llm_response(document) else "text_extracted"
+            extracted_text = document.extracted_text
+        else:
+            stage_start = time.time()
+            if uses_progressive_extraction(document):
+                extracted_text, _ = run_progressive_extraction(db, document)
+            else:
+                extracted_text = run_extraction_stage(db, document, verify=False)
+            pipeline_info["stage_seconds"]["extraction"] = round(time.time() - stage_start, 3)
+            if is_completed(document):
+                # Respondido pelas regras durante a extração progressiva
+                document.set_processing_info("pipeline", pipeline_info)
+                db.commit()
+                return {"status": "success", "document_id": document_id, "mode": "fused", "llm_skipped": True}
+        
+        # Regras determinísticas: se todas as chaves foram resolvidas, a LLM não é chamada
+        if not has_llm_response(document) and answer_with_rules(document, extracted_text):
+            document.set_processing_info("pipeline", pipeline_info)
+            db.commit()
+            release_followers(db, document)
+            return {"status": "success", "document_id": document_id, "mode": "fused", "llm_skipped": True}
+        
+        if delivery_queue(self) == CELERY_OCR_QUEUE:
+            # OCR concluído: LLM e formatação seguem na fila llm, sem prender um processo de OCR durante a chamada
+            pipeline_info["handed_off"] = CELERY_LLM_QUEUE
+            document.set_processing_info("pipeline", pipeline_info)
+            db.commit()
+            dispatch(process_document_task, document_id, stage_priority(document), args=(document_id,),
+                     queue=CELERY_LLM_QUEUE)
+            logger.info(f"📨 VERBOSE: Document {document_id} extracted on '{CELERY_OCR_QUEUE}', LLM stage handed off to '{CELERY_LLM_QUEUE}'")
+            return {"status": "success", "document_id": document_id, "mode": "fused", "handed_off": CELERY_LLM_QUEUE}
+        
+        if not has_llm_response(document):
+            ensure_llm_available(document_id, document)
+            stage_start = time.time()
+            run_prompt_stage(db, document, document, extracted_text=extracted_text, verify=False)
+            pipeline_info["stage_seconds"]["llm"] = round(time.time() - stage_start, 3)
+        
+        stage_start = time.time()
+        document.set_processing_info("pipeline", pipeline_info)
+        run_format_stage(db, document, document, verify=False)
+        pipeline_info["stage_seconds"]["formatting"] = round(time.time() - stage_start, 3)
+        document.set_processing_info("pipeline", pipeline_info)
+        db.commit()
+        
+        return {"status": "success", "document_id": document_id, "mode": "fused"}
+        
+    except Exception as e:
+        logger.error(f"❌ VERBOSE: Error in fused pipeline for document {document_id}: {e}")
+        handle_task_failure(self, db, locals().get("document"), e, "fused pipeline")
     finally:
         db.close()
 
@@ -366,8 +1093,19 @@ def cleanup_task():
                 Document.completed_at < cutoff_time
             ).delete()
             
+            # Delete old queries and queries whose document was removed
+            deleted_queries = db.query(DocumentQuery).filter(
+                (DocumentQuery.completed_at < cutoff_time) |
+                ~DocumentQuery.document_id.in_(db.query(Document.id))
+            ).delete(synchronize_session=False)
+            
+            # Checkpoints de páginas de documentos removidos
+            db.query(DocumentPage).filter(
+                ~DocumentPage.document_id.in_(db.query(Document.id))
+            ).delete(synchronize_session=False)
+            
             db.commit()
-            logger.info(f"Cleaned up {deleted_count} old database records")
+            logger.info(f"Cleaned up {deleted_count} old database records and {deleted_queries} old queries")
             
         finally:
             db.close()
@@ -379,6 +1117,95 @@ def cleanup_task():
         logger.error(f"Error during cleanup: {e}")
         raise e
 
+@celery_app.task
+def promote_jobs_task():
+    """Periodic aging: re-dispatch jobs waiting in the queue with a more urgent priority"""
+    return {"status": "success", "promoted": promote_waiting_jobs(celery_app)}
+
+def requeue_from_checkpoint(document: Document) -> str:
+    """Enqueue the stage after the last checkpoint of the document. Returns the stage name"""
+    if has_llm_response(document):
+        enqueue_format_task(document.id, document)
+        return "formatting"
+    if has_current_extraction(document):
+        enqueue_prompt_task(document.id, document.model, document.ai_provider, priority=stage_priority(document))
+        return "llm"
+    requested_mode = document.get_processing_info().get("pipeline", {}).get("mode")
+    start_document_pipeline(document.id, document.file_path, document.file_type, requested_mode,
+                            priority=stage_priority(document))
+    return "extraction"
+
+def reap_document(db: Session, document: Document) -> str:
+    """Recover one overdue document with no live task. Returns the action taken"""
+    leader_id = document.get_processing_info().get("coalescing", {}).get("leader_id")
+    if leader_id:
+        # Cópia coalescida: depende do líder, que é recuperado por conta própria
+        leader = db.query(Document).filter(Document.id == leader_id).first()
+        if leader is not None and leader.status not in (DocumentStatus.COMPLETED, DocumentStatus.ERROR):
+            return None
+        if leader is not None:
+            copy_leader_result(leader, document)
+            db.commit()
+            return "copied_leader"
+    
+    reaper_info = document.get_processing_info().get("reaper", {"requeues": 0})
+    stuck_seconds = (datetime.utcnow() - last_status_change(document)).total_seconds()
+    if reaper_info["requeues"] >= REAPER_MAX_REQUEUES:
+        document.error_message = (f"Stuck in {document.status.value} for {stuck_seconds:.0f}s "
+                                  f"after {reaper_info['requeues']} automatic requeue(s)")
+        document.status = DocumentStatus.ERROR
+        document.updated_at = datetime.utcnow()
+        db.commit()
+        release_followers(db, document)
+        logger.error(f"❌ VERBOSE: Document {document.id} still stuck after {reaper_info['requeues']} requeue(s) - giving up")
+        return "failed"
+    
+    # updated_at reinicia o timeout da etapa; a mensagem antiga (se reaparecer) vira despacho obsoleto
+    document.updated_at = datetime.utcnow()
+    reaper_info["requeues"] += 1
+    reaper_info["last_status"] = document.status.value
+    reaper_info["last_requeued_at"] = time.time()
+    document.set_processing_info("reaper", reaper_info)
+    db.commit()
+    stage = requeue_from_checkpoint(document)
+    logger.warning(f"🪦 VERBOSE: Document {document.id} stuck in {reaper_info['last_status']} for {stuck_seconds:.0f}s "
+                   f"with no live task - requeued from {stage} ({reaper_info['requeues']}/{REAPER_MAX_REQUEUES})")
+    return stage
+
+@celery_app.task
+def reap_stuck_documents_task():
+    """Periodic reaper: requeue documents stuck in a stage whose task died (OOM kill, lost worker)"""
+    if not REAPER_ENABLED:
+        return {"status": "disabled"}
+    db = SessionLocal()
+    try:
+        candidates = [document for document in db.query(Document).filter(
+            Document.status.in_([DocumentStatus.UPLOADED, DocumentStatus.TEXT_EXTRACTED,
+                                 DocumentStatus.PROMPT_PROCESSED, DocumentStatus.RETRYING]),
+            # Documento recém-criado ainda sem updated_at: conta desde o upload
+            func.coalesce(Document.updated_at, Document.created_at) < overdue_cutoff()
+        ).all() if is_overdue(document.status, last_status_change(document))]
+        if not candidates:
+            return {"status": "success", "overdue": 0}
+        
+        live_ids = live_task_document_ids(celery_app)
+        if live_ids is None:
+            logger.warning("⚠️ VERBOSE: Reaper got no reply from the workers - skipping this round")
+            return {"status": "skipped", "reason": "no worker replied"}
+        live_ids |= pending_document_ids()
+        
+        actions = {}
+        for document in candidates:
+            if document.id in live_ids:
+                continue
+            action = reap_document(db, document)
+            if action:
+                actions[action] = actions.get(action, 0) + 1
+                metrics.incr(f"reaper.{action}")
+        return {"status": "success", "overdue": len(candidates), "actions": actions}
+    finally:
+        db.close()
+
 # Configure periodic tasks
 from celery.schedules import crontab
 
@@ -387,6 +1214,14 @@ celery_app.conf.beat_schedule = {
         'task': 'workers.cleanup_task',
         'schedule': crontab(minute=0),  # Run every hour
     },
+    'promote-waiting-jobs': {
+        'task': 'workers.promote_jobs_task',
+        'schedule': max(SCHEDULER_AGING_SECONDS / 2, 1),  # Aging: metade do período para não atrasar a promoção
+    },
+    'reap-stuck-documents': {
+        'task': 'workers.reap_stuck_documents_task',
+        'schedule': REAPER_INTERVAL_SECONDS,
+    },
 }
 
 if __name__ == '__main__':